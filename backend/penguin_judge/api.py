@@ -1,33 +1,50 @@
 from base64 import b64encode, b64decode
 from datetime import datetime, timezone, timedelta
-from typing import Any, Union, Tuple, Optional, Dict, List
+from functools import partial
+from typing import (
+    Any, Callable, Union, Tuple, Optional, Dict, Iterator, List, Set)
 import pickle
-from hashlib import pbkdf2_hmac
+from hashlib import pbkdf2_hmac, sha256
 import os
-from itertools import groupby
 import secrets
+import time
 
-import pika  # type: ignore
 from flask import Flask, abort, request, Response, make_response, send_file
-from zstandard import ZstdCompressor, ZstdDecompressor  # type: ignore
 from openapi_core import create_spec  # type: ignore
 from openapi_core.shortcuts import RequestValidator  # type: ignore
 from openapi_core.contrib.flask import FlaskOpenAPIRequest  # type: ignore
 import yaml
-from sqlalchemy import func
+from sqlalchemy import and_, event, exists, func, inspect, or_
+from sqlalchemy.orm import object_session
+from werkzeug.http import parse_set_header
 
+from penguin_judge.blob import get_blob_store
+from penguin_judge.compression import compress_code, decompress_code
+from penguin_judge.events import Subscription, subscribe
 from penguin_judge.models import (
-    transaction, scoped_session, Contest, Environment, JudgeResult,
-    JudgeStatus, Problem, Submission, TestCase, Token, User, Worker)
-from penguin_judge.mq import get_mq_conn_params
-from penguin_judge.utils import json_dumps, pagination_header
+    transaction, scoped_session, Session, CodeDictionary, Contest, Environment,
+    JudgeResult, JudgeStatus, Problem, Standing, Submission, TestCase, Token,
+    User, Worker, get_standings_version, summarize_judge_results,
+    update_standings)
+from penguin_judge.mq import (
+    publish, get_message_counts, JUDGE_QUEUES, LIVE_QUEUE, REJUDGE_QUEUE)
+from penguin_judge.utils import (
+    json_dumps, pagination_header, compress, decode_cursor, encode_cursor,
+    keyset_filter, CompressibleBody, TTLCache, VersionedCache,
+    COMPRESS_ENCODINGS)
+from penguin_judge.validation import CompiledRequestValidator
 
 DEFAULT_MEMORY_LIMIT = 256  # MiB
+_EVENT_STREAM_KEEPALIVE = 15.0  # [sec]
 
 app = Flask(__name__)
 with open(os.path.join(os.path.dirname(__file__), 'schema.yaml'), 'r') as f:
-    _spec = create_spec(yaml.safe_load(f))
+    _spec_dict = yaml.safe_load(f)
+_spec = create_spec(_spec_dict)
 _request_validator = RequestValidator(_spec)
+_compiled_validator = CompiledRequestValidator(_spec_dict)
+_rankings_cache: VersionedCache[str, CompressibleBody] = VersionedCache()
+_token_cache: Optional[TTLCache[bytes, Tuple[datetime, dict]]] = None
 
 
 def response204() -> Response:
@@ -44,17 +61,89 @@ def jsonify(resp: Union[dict, list], *,
         status=status, headers=headers)
 
 
+def _negotiate_encoding(resp: Response, size: int) -> Optional[str]:
+    """Accept-Encodingに従ってレスポンス本文の圧縮方式を選ぶ
+
+    本文がcompress_min_sizeバイト未満の場合は圧縮しない(0で常に無効)
+    """
+    min_size = app.config.get('compress_min_size', 1024)
+    if min_size <= 0 or size < min_size:
+        return None
+    vary = parse_set_header(resp.headers.get('Vary', ''))
+    vary.add('Accept-Encoding')
+    resp.headers['Vary'] = vary.to_header()
+    return request.accept_encodings.best_match(  # type: ignore
+        COMPRESS_ENCODINGS)
+
+
+@app.after_request
+def _compress_response(resp: Response) -> Response:
+    if (resp.direct_passthrough or resp.is_streamed or
+            not 200 <= resp.status_code < 300 or
+            'Content-Encoding' in resp.headers or
+            resp.mimetype != app.config['JSONIFY_MIMETYPE']):
+        return resp
+    data = resp.get_data()
+    encoding = _negotiate_encoding(resp, len(data))
+    if encoding:
+        resp.set_data(compress(data, encoding))
+        _set_content_encoding(resp, encoding)
+    return resp
+
+
+def _set_content_encoding(resp: Response, encoding: str) -> None:
+    resp.headers['Content-Encoding'] = encoding
+    # 圧縮後の本文は異なるのでETagもエンコーディング毎に変える
+    etag, weak = resp.get_etag()
+    if etag:
+        resp.set_etag('{}-{}'.format(etag, encoding), weak)
+
+
 def _kdf(password: str, salt: bytes) -> bytes:
     return pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 100000)
 
 
 def _validate_request() -> Tuple[Any, Any]:
+    # 正しいリクエストは事前構築した検証器で処理し、
+    # それ以外はエラーを判定するためにRequestValidatorで検証する
+    compiled = _compiled_validator.validate(request)
+    if compiled is not None:
+        return compiled
     ret = _request_validator.validate(FlaskOpenAPIRequest(request))
     if ret.errors:
         abort(400)
     return ret.parameters, ret.body
 
 
+def _paginate(q: Any, params: Any, keys: List[Tuple[Any, bool]]
+              ) -> Tuple[List[Any], Dict[str, Any]]:
+    """一覧の1ページ分の行とレスポンスヘッダを返す
+
+    cursorが指定された場合はキーセットページネーションで取得し、
+    全件数の計算(X-Total, X-Total-Pages)を省略する。
+    keysは(カラム, 降順か)のリストで、最後のキーで行が一意に定まること
+    """
+    per_page = params.query['per_page']
+    cursor = params.query.get('cursor')
+    order_by = [col.desc() if desc else col for col, desc in keys]
+    if cursor is None:
+        page = params.query['page']
+        headers = pagination_header(q.count(), page, per_page)
+        q = q.order_by(*order_by).offset((page - 1) * per_page)
+    else:
+        try:
+            values = decode_cursor(cursor, keys)
+        except ValueError:
+            abort(400)
+        q = q.filter(keyset_filter(keys, values)).order_by(*order_by)
+        headers = {'X-Per-Page': per_page}
+    rows = q.limit(per_page + 1).all()
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        headers['X-Next-Cursor'] = encode_cursor(rows[-1], keys)
+    return rows, headers
+
+
 def _validate_token(
         s: Optional[scoped_session] = None, required: bool = False,
         admin_required: bool = False) -> Optional[dict]:
@@ -77,16 +166,23 @@ def _validate_token(
     utc_now = datetime.now(tz=timezone.utc)
 
     def _check(s: scoped_session) -> Optional[dict]:
-        ret = s.query(Token.expires, User).filter(
-            Token.token == token_bytes, Token.user_id == User.id).first()
+        ret = _get_token_cache().get(token_bytes)
+        if not ret:
+            row = s.query(Token.expires, User).options(
+                User.load_summary_only()).filter(
+                Token.token == token_bytes, Token.user_id == User.id).first()
+            if row:
+                ret = (row[0], row[1].to_summary_dict())
+                _get_token_cache().put(token_bytes, ret, min(
+                    app.config.get('token_cache_ttl', 10.0),
+                    (row[0] - utc_now).total_seconds()))
         if not ret or ret[0] <= utc_now:
             if required or admin_required:
                 abort(401)
-            else:
-                return None
-        if admin_required and not ret[1].admin:
+            return None
+        if admin_required and not ret[1]['admin']:
             abort(401)
-        tmp = ret[1].to_summary_dict()
+        tmp = dict(ret[1])
         tmp['_token_bytes'] = token_bytes
         return tmp
     if s:
@@ -95,6 +191,70 @@ def _validate_token(
         return _check(s)
 
 
+def _get_token_cache() -> TTLCache[bytes, Tuple[datetime, dict]]:
+    """トークンからユーザ情報を引くキャッシュ(APIプロセス毎)
+
+    他のプロセスでのトークン削除や権限変更は token_cache_ttl 秒以内に反映される
+    """
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = TTLCache(app.config.get('token_cache_size', 10000))
+    return _token_cache
+
+
+_TOKEN_CACHE_INVALIDATIONS = 'token_cache_invalidations'
+
+
+def _invalidate_token_cache_on_commit(
+        s: Any, invalidate: Callable[[TTLCache[bytes, Tuple[datetime, dict]]],
+                                     None]) -> None:
+    # 他のリクエストがコミット前の状態を再びキャッシュしないよう
+    # キャッシュの破棄はコミット後に行う
+    if s is None:
+        invalidate(_get_token_cache())
+        return
+    s.info.setdefault(_TOKEN_CACHE_INVALIDATIONS, []).append(invalidate)
+
+
+@event.listens_for(User, 'after_update')
+def _invalidate_token_cache_by_user(_: Any, __: Any, target: User) -> None:
+    if inspect(target).attrs.admin.history.has_changes():
+        _invalidate_token_cache_on_commit(
+            object_session(target),
+            lambda c: c.remove_if(lambda v: v[1]['id'] == target.id))
+
+
+@event.listens_for(Token, 'after_update')
+@event.listens_for(Token, 'after_delete')
+def _invalidate_token_cache_by_token(_: Any, __: Any, target: Token) -> None:
+    token = target.token
+    _invalidate_token_cache_on_commit(
+        object_session(target), lambda c: c.pop(token))
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _invalidate_token_cache_by_query(update_context: Any) -> None:
+    # クエリによる一括更新/削除は対象を特定できないのですべて破棄する
+    if update_context.mapper.class_ in (Token, User):
+        _invalidate_token_cache_on_commit(
+            update_context.session, lambda c: c.clear())
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_token_cache_invalidations(s: Any) -> None:
+    if s.transaction is not None and s.transaction.nested:
+        return
+    for invalidate in s.info.pop(_TOKEN_CACHE_INVALIDATIONS, []):
+        invalidate(_get_token_cache())
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_token_cache_invalidations(s: Any, tx: Any) -> None:
+    if tx.parent is None:
+        s.info.pop(_TOKEN_CACHE_INVALIDATIONS, None)
+
+
 @app.route('/auth', methods=['POST'])
 def authenticate() -> Response:
     _, body = _validate_request()
@@ -121,9 +281,11 @@ def deleteToken() -> Response:
     with transaction() as s:
         u = _validate_token(s, required=True)
         assert(u)
-        s.query(Token).filter(
-            Token.token == u['_token_bytes']
-        ).delete(synchronize_session=False)
+        # 一括削除ではキャッシュ全体が破棄されるため対象を読み込んで削除する
+        token = s.query(Token).filter(
+            Token.token == u['_token_bytes']).first()
+        if token:
+            s.delete(token)
     resp = make_response((b'', 204))
     resp.headers.pop('content-type')
     resp.headers.add('Set-Cookie', 'AuthToken=; Max-Age=0')
@@ -175,7 +337,8 @@ def list_environments() -> Response:
         is_admin = u and u['admin']
         q = s.query(Environment)
         if not is_admin:
-            q = q.filter(Environment.published.is_(True))
+            q = q.options(Environment.load_summary_only()).filter(
+                Environment.published.is_(True))
         for c in q:
             ret.append(c.to_dict() if is_admin else c.to_summary_dict())
     return jsonify(ret)
@@ -228,11 +391,9 @@ def delete_environment(environment_id: str) -> Response:
 @app.route('/contests')
 def list_contests() -> Response:
     params, _ = _validate_request()
-    page, per_page = params.query['page'], params.query['per_page']
-    ret = []
     with transaction() as s:
         u = _validate_token(s)
-        q = s.query(Contest)
+        q = s.query(Contest).options(Contest.load_summary_only())
         if not (u and u['admin']):
             q = q.filter(Contest.published.is_(True))
 
@@ -248,11 +409,10 @@ def list_contests() -> Response:
             elif v == 'finished':
                 q = q.filter(Contest.end_time <= now)
 
-        count = q.count()
-        q = q.order_by(Contest.start_time.desc())
-        for c in q.offset((page - 1) * per_page).limit(per_page):
-            ret.append(c.to_summary_dict())
-    return jsonify(ret, headers=pagination_header(count, page, per_page))
+        rows, headers = _paginate(
+            q, params, [(Contest.start_time, True), (Contest.id, True)])
+        ret = [c.to_summary_dict() for c in rows]
+    return jsonify(ret, headers=headers)
 
 
 @app.route('/contests', methods=['POST'])
@@ -268,7 +428,9 @@ def create_contest() -> Response:
             description=body.description,
             start_time=body.start_time,
             end_time=body.end_time,
-            published=getattr(body, 'published', None))
+            published=bool(getattr(body, 'published', False)),
+            reuse_judge_results=bool(
+                getattr(body, 'reuse_judge_results', True)))
         s.add(contest)
         s.flush()
         ret = contest.to_dict()
@@ -342,7 +504,8 @@ def create_problem(contest_id: str) -> Response:
             time_limit=body.time_limit,
             memory_limit=getattr(body, 'memory_limit', DEFAULT_MEMORY_LIMIT),
             description=body.description,
-            score=body.score)
+            score=body.score,
+            fail_fast=getattr(body, 'fail_fast', False))
         s.add(problem)
         s.flush()
         ret = problem.to_dict()
@@ -358,10 +521,23 @@ def update_problem(contest_id: str, problem_id: str) -> Response:
                                           Problem.id == problem_id).first()
         if not problem:
             abort(404)
+        judge_changed = False
         for key in Problem.__updatable_keys__:
             if not hasattr(body, key):
                 continue
+            if (key in Problem.__judge_keys__ and
+                    getattr(problem, key) != getattr(body, key)):
+                judge_changed = True
             setattr(problem, key, getattr(body, key))
+        if judge_changed:
+            # 制限値等の変更はすべてのテストケースの結果に影響する
+            problem.tests_version = Problem.tests_version + 1
+            s.flush()
+            s.query(TestCase).filter(
+                TestCase.contest_id == contest_id,
+                TestCase.problem_id == problem_id,
+            ).update({TestCase.version: problem.tests_version},
+                     synchronize_session=False)
         ret = problem.to_dict()
     return jsonify(ret)
 
@@ -385,20 +561,18 @@ def get_problem(contest_id: str, problem_id: str) -> Response:
             abort(404)
         if not (contest.is_begun() or (u and u['admin'])):
             abort(404)  # ここは403ではなく404にする
-        ret = s.query(Problem).filter(
+        problem = s.query(Problem).filter(
             Problem.contest_id == contest_id,
             Problem.id == problem_id).first()
-        if not ret:
+        if not problem:
             abort(404)
-        ret = ret.to_dict()
+        ret = problem.to_dict()
     return jsonify(ret)
 
 
 @app.route('/contests/<contest_id>/submissions')
 def list_submissions(contest_id: str) -> Response:
     params, body = _validate_request()
-    page, per_page = params.query['page'], params.query['per_page']
-    ret = []
     with transaction() as s:
         u = _validate_token(s)
         contest = s.query(Contest).filter(Contest.id == contest_id).first()
@@ -408,7 +582,9 @@ def list_submissions(contest_id: str) -> Response:
         if not (contest.is_begun() or is_admin):
             abort(403)
 
-        q = s.query(Submission).filter(Submission.contest_id == contest_id)
+        q = s.query(Submission).options(
+            Submission.load_summary_only()).filter(
+            Submission.contest_id == contest_id)
         if not (contest.is_finished() or is_admin):
             if not u:
                 # 未ログイン時は開催中コンテストの投稿一覧は見えない
@@ -427,22 +603,13 @@ def list_submissions(contest_id: str) -> Response:
                 continue
             q = q.filter(expr(v))  # type: ignore
 
-        count = q.count()
-
-        if params.query.get('sort'):
-            sort_keys = []
-            for key in params.query['sort']:
-                f = getattr(Submission, key.lstrip('-'))
-                if key[0] == '-':
-                    f = f.desc()
-                sort_keys.append(f)
-            q = q.order_by(*sort_keys)
-        else:
-            q = q.order_by(Submission.created)
-
-        for c in q.offset((page - 1) * per_page).limit(per_page):
-            ret.append(c.to_summary_dict())
-    return jsonify(ret, headers=pagination_header(count, page, per_page))
+        sort_keys = [
+            (getattr(Submission, key.lstrip('-')), key[0] == '-')
+            for key in (params.query.get('sort') or ['created'])]
+        sort_keys.append((Submission.id, False))
+        rows, headers = _paginate(q, params, sort_keys)
+        ret = [c.to_summary_dict() for c in rows]
+    return jsonify(ret, headers=headers)
 
 
 @app.route('/contests/<contest_id>/submissions', methods=['POST'])
@@ -450,48 +617,207 @@ def post_submission(contest_id: str) -> Response:
     _, body = _validate_request()
     problem_id, code, env_id = body.problem_id, body.code, body.environment_id
 
-    cctx = ZstdCompressor()
     code_encoded = code.encode('utf8')
-    code = cctx.compress(code_encoded)
 
     with transaction() as s:
         u = _validate_token(s, required=True)
         assert(u)
-        if not s.query(Environment).filter(Environment.id == env_id).count():
+        # 存在チェックとジャッジ待ちの提出数の確認を1回のクエリで行う
+        # (提出数は部分インデックスを使い、上限+1件まで数える)
+        limit = app.config['user_judge_queue_limit']
+        queued = s.query(Submission.id).filter(
+            Submission.user_id == u['id'],
+            Submission.status.in_([JudgeStatus.Waiting, JudgeStatus.Running])
+        ).limit(limit + 1).subquery()
+        (env_exists, contest_exists, problem_exists, queued_count,
+         dictionary_id) = s.query(
+            s.query(Environment).filter(Environment.id == env_id).exists(),
+            s.query(Contest).filter(Contest.id == contest_id).exists(),
+            s.query(Problem).filter(
+                Problem.contest_id == contest_id,
+                Problem.id == problem_id).exists(),
+            s.query(func.count()).select_from(queued).as_scalar(),
+            s.query(func.max(CodeDictionary.id)).filter(
+                CodeDictionary.environment_id == env_id).as_scalar()).one()
+        if not env_exists:
             abort(400)  # bodyが不正なので400
-        if not s.query(Contest).filter(Contest.id == contest_id).count():
+        if not contest_exists:
             abort(404)  # contest_idはURLに含まれるため404
-        if not s.query(Problem).filter(Problem.contest_id == contest_id,
-                                       Problem.id == problem_id).count():
+        if not problem_exists:
             abort(400)  # bodyが不正なので400
-        queued_submission_count = s.query(Submission).filter(
-            Submission.user_id == u['id'],
-            Submission.status.in_([JudgeStatus.Waiting, JudgeStatus.Running])
-        ).count()
-        if queued_submission_count > app.config['user_judge_queue_limit']:
+        if queued_count > limit:
             abort(429)
         submission = Submission(
             contest_id=contest_id, problem_id=problem_id, user_id=u['id'],
-            code=code, code_bytes=len(code_encoded), environment_id=env_id)
+            code=compress_code(code_encoded, dictionary_id),
+            code_dictionary_id=dictionary_id, code_bytes=len(code_encoded),
+            code_hash=sha256(code_encoded).digest(), environment_id=env_id)
         s.add(submission)
         s.flush()
         ret = submission.to_summary_dict()
 
-    conn = pika.BlockingConnection(get_mq_conn_params())
-    ch = conn.channel()
-    ch.queue_declare(queue='judge_queue')
-    ch.basic_publish(
-        exchange='', routing_key='judge_queue', body=pickle.dumps(
-            (contest_id, problem_id, ret['id'])))
-    ch.close()
-    conn.close()
+    publish(LIVE_QUEUE, [pickle.dumps((contest_id, problem_id, ret['id']))])
     return jsonify(ret, status=201)
 
 
+@app.route('/contests/<contest_id>/submissions/events')
+def list_submission_events(contest_id: str) -> Response:
+    _validate_request()
+    with transaction() as s:
+        u = _validate_token(s, required=True)
+        assert(u)
+        contest = s.query(Contest).filter(Contest.id == contest_id).first()
+        if not (contest and contest.is_accessible(u)):
+            abort(404)
+        if not (contest.is_begun() or u['admin']):
+            abort(403)
+        hide_details = not (contest.is_finished() or u['admin'])
+
+        # 購読を開始してから現在の状態を読み込むことで変化を取りこぼさない
+        sub = subscribe(contest_id, u['id'])
+        try:
+            cursor = _parse_event_id(request.headers.get('Last-Event-ID'))
+            q = s.query(Submission).options(
+                Submission.load_summary_only()).filter(
+                Submission.contest_id == contest_id,
+                Submission.user_id == u['id'])
+            if cursor is None:
+                # 初回の接続では現在の状態を返さず、以降の変化のみを返す
+                snapshots: List[dict] = []
+                cursor = (s.query(func.max(Submission.id)).filter(
+                    Submission.contest_id == contest_id,
+                    Submission.user_id == u['id']).scalar() or 0, set())
+            else:
+                # 再接続時は切断中に追加またはジャッジが進んだ可能性のある
+                # 提出の現在の状態を返す
+                max_id, pending = cursor
+                snapshots = [x.to_summary_dict() for x in q.filter(or_(
+                    Submission.id > max_id, Submission.id.in_(pending)
+                )).order_by(Submission.id)]
+        except Exception:
+            sub.close()
+            raise
+    return _event_stream(sub, snapshots, None, hide_details, cursor)
+
+
+@app.route('/contests/<contest_id>/submissions/<submission_id>/events')
+def get_submission_events(contest_id: str, submission_id: str) -> Response:
+    _validate_request()
+    with transaction() as s:
+        u = _validate_token(s)
+        contest = s.query(Contest).filter(Contest.id == contest_id).first()
+        if not (contest and contest.is_accessible(u)):
+            abort(404)
+        submission = s.query(Submission).options(
+            Submission.load_summary_only()).filter(
+            Submission.contest_id == contest_id,
+            Submission.id == submission_id).first()
+        if not (submission and submission.is_accessible(contest, u)):
+            abort(404)
+        hide_details = not (contest.is_finished() or (u and u['admin']))
+
+        # 購読を開始してから現在の状態を読み込むことで変化を取りこぼさない
+        sub = subscribe(contest_id, submission.user_id)
+        try:
+            s.refresh(submission, ['status', 'max_time', 'max_memory'])
+            snapshot = submission.to_summary_dict()
+            snapshot['tests'] = [dict(
+                id=r.test_id, status=r.status, time=r.time, memory=r.memory)
+                for r in s.query(
+                    JudgeResult.test_id, JudgeResult.status,
+                    JudgeResult.time, JudgeResult.memory).filter(
+                    JudgeResult.contest_id == contest_id,
+                    JudgeResult.submission_id == submission.id).order_by(
+                    JudgeResult.test_id)]
+        except Exception:
+            sub.close()
+            raise
+    return _event_stream(sub, [snapshot], snapshot['id'], hide_details)
+
+
+def _parse_event_id(
+        event_id: Optional[str]) -> Optional[Tuple[int, Set[int]]]:
+    """Last-Event-IDから(通知済みの最大の提出ID, ジャッジ中の提出ID)を返す"""
+    if not event_id:
+        return None
+    try:
+        ids = [int(x) for x in event_id.split(',')]
+    except ValueError:
+        return None
+    return ids[0], set(ids[1:])
+
+
+def _event_stream(sub: Subscription, snapshots: List[dict],
+                  submission_id: Optional[int], hide_details: bool,
+                  cursor: Optional[Tuple[int, Set[int]]] = None
+                  ) -> Response:
+    """購読した通知をServer-Sent Eventsで返す
+
+    submission_idを指定した場合はその提出の通知のみを返し、ジャッジが
+    完了した時点で終了する。event_stream_timeout秒経過した場合も終了するので
+    クライアントは再接続すること。
+    cursorを指定した場合は通知済みの最大の提出IDとジャッジ中の提出IDを
+    イベントIDとして返し、再接続時のLast-Event-IDで切断中の変化を返す
+    """
+    timeout = app.config.get('event_stream_timeout', 15.0)
+
+    def _is_finished(e: dict) -> bool:
+        status = e.get('status', JudgeStatus.Running.name)
+        if isinstance(status, JudgeStatus):
+            status = status.name
+        return status not in (
+            JudgeStatus.Waiting.name, JudgeStatus.Running.name)
+
+    def _event_id(e: Optional[dict]) -> str:
+        nonlocal cursor
+        if cursor is None:
+            return ''
+        max_id, pending = cursor
+        if e is not None:
+            max_id = max(max_id, e['id'])
+            if _is_finished(e):
+                pending.discard(e['id'])
+            else:
+                pending.add(e['id'])
+            cursor = (max_id, pending)
+        return 'id: {}\n'.format(
+            ','.join(str(x) for x in (max_id, *sorted(pending))))
+
+    def _generate() -> Iterator[str]:
+        with sub:
+            deadline = time.monotonic() + timeout
+            yield 'retry: 3000\n{}\n'.format(_event_id(None))
+            events = list(snapshots)
+            while True:
+                for e in events:
+                    if submission_id not in (None, e['id']):
+                        continue
+                    if hide_details:
+                        for t in e.get('tests', ()):
+                            t.pop('time', None)
+                            t.pop('memory', None)
+                    yield '{}data: {}\n\n'.format(_event_id(e), json_dumps(e))
+                    if submission_id is not None and _is_finished(e):
+                        return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                ev = sub.get(min(remaining, _EVENT_STREAM_KEEPALIVE))
+                events = [ev] if ev is not None else []
+                if ev is None:
+                    yield ': keepalive\n\n'
+
+    resp = Response(_generate(), mimetype='text/event-stream')
+    resp.call_on_close(sub.close)
+    resp.headers['Cache-Control'] = 'no-cache'
+    # リバースプロキシによるバッファリングを無効にする
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+
 @app.route('/contests/<contest_id>/submissions/<submission_id>')
 def get_submission(contest_id: str, submission_id: str) -> Response:
     params, _ = _validate_request()
-    zctx = ZstdDecompressor()
     with transaction() as s:
         u = _validate_token(s)
         contest = s.query(Contest).filter(Contest.id == contest_id).first()
@@ -525,7 +851,10 @@ def get_submission(contest_id: str, submission_id: str) -> Response:
                 t.pop('memory', None)
             ret['tests'].append(t)
 
-    ret['code'] = zctx.decompress(ret['code']).decode('utf-8')
+    for key in ('code_hash', 'compile_image_name', 'test_image_name'):
+        ret.pop(key, None)
+    ret['code'] = decompress_code(
+        ret['code'], ret.pop('code_dictionary_id', None)).decode('utf-8')
     return jsonify(ret)
 
 
@@ -538,6 +867,40 @@ def list_rankings(contest_id: str) -> Response:
             abort(404)
         if not contest.is_begun():
             abort(403)
+
+        # 順位表の内容に影響する値からETagを生成する
+        # (ユーザの追加/削除は全コンテスト共通のバージョンに含まれる)
+        problems = s.query(Problem.id, Problem.score).filter(
+            Problem.contest_id == contest_id).order_by(Problem.id).all()
+        etag = sha256(repr((
+            get_standings_version(s, contest_id), contest.start_time,
+            contest.penalty, problems,
+        )).encode('utf8')).hexdigest()
+
+    # 圧縮結果もキャッシュに保持するので、2回目以降は生成も圧縮もしない
+    # (304も200と同じETag/Varyを返すため本文の大きさから圧縮方式を決める)
+    body = _rankings_cache.get(
+        contest_id, etag, partial(_compute_rankings, contest_id))
+    resp = app.response_class(mimetype=app.config["JSONIFY_MIMETYPE"])
+    encoding = _negotiate_encoding(resp, len(body.data))
+    if encoding:
+        # 圧縮後の本文は異なるのでETagもエンコーディング毎に変える
+        etag = '{}-{}'.format(etag, encoding)
+        resp.headers['Content-Encoding'] = encoding
+    if request.if_none_match.contains(etag):
+        # クライアントが最新の順位表を保持しているので本文は返さない
+        resp.status_code = 304
+        resp.headers.pop('Content-Encoding', None)
+    else:
+        resp.set_data(body.get(encoding))
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+def _compute_rankings(contest_id: str) -> CompressibleBody:
+    with transaction() as s:
+        contest = s.query(Contest).filter(Contest.id == contest_id).one()
         contest_penalty = contest.penalty
         contest_start_time = contest.start_time
 
@@ -546,49 +909,48 @@ def list_rankings(contest_id: str) -> Response:
         }
 
         # 一度も提出していない人をランキングに載せるために利用
+        # (提出したユーザは順位表のセルから求まるので読み込まない)
         users_never_submitted = {
             u.id: u.to_summary_dict()
-            for u in s.query(User).filter(User.admin.is_(False))}
-
+            for u in s.query(User).options(User.load_summary_only()).filter(
+                User.admin.is_(False),
+                ~exists().where(and_(
+                    Standing.contest_id == contest_id,
+                    Standing.user_id == User.id)))}
+
+        # 提出の集計は順位表テーブル(update_standings)で済んでいるので
+        # ユーザ x 問題のセルを読み込むだけで良い
         q = s.query(
-            Submission.user_id, Submission.problem_id,
-            Submission.status, Submission.created,
+            Standing.user_id, Standing.problem_id, Standing.penalties,
+            Standing.accepted, Standing.first_submitted,
         ).filter(
-            Submission.contest_id == contest_id,
-            Submission.created >= contest.start_time,
-            Submission.created < contest.end_time,
-        )
+            Standing.contest_id == contest_id,
+        ).order_by(Standing.user_id, Standing.problem_id)
 
-        users: Dict[str, List[Tuple[str, timedelta, JudgeStatus]]] = {}
-        for (uid, pid, st, t) in q:
+        users: Dict[str, List[Tuple[str, int, Optional[datetime]]]] = {}
+        first_submitted: Dict[str, datetime] = {}
+        for (uid, pid, n_penalties, accepted_time, t) in q:
             if uid not in users:
                 users[uid] = []
+                first_submitted[uid] = t
                 users_never_submitted.pop(uid, None)
-            users[uid].append((pid, t, st))
+            users[uid].append((pid, n_penalties, accepted_time))
+            first_submitted[uid] = min(first_submitted[uid], t)
 
     results = []
-    for uid, all_submission in users.items():
-        all_submission.sort(key=lambda x: (x[0], x[1]))
+    for uid in sorted(users, key=lambda x: (first_submitted[x], x)):
         max_time = contest_start_time
         total_score = 0
         total_penalties = 0
         ret = dict(user_id=uid, problems={})
-        for problem_id, submissions in groupby(
-                all_submission, key=lambda x: x[0]):
-            n_penalties = 0
+        for problem_id, n_penalties, accepted_time in users[uid]:
             tmp: Dict[str, Union[float, int, timedelta]] = {}
-            for (_, submit_time, submit_status) in submissions:
-                if submit_status == JudgeStatus.Accepted:
-                    tmp['time'] = submit_time - contest_start_time
-                    score = tmp['score'] = problems[problem_id]
-                    max_time = max(max_time, submit_time)
-                    total_score += score
-                    total_penalties += n_penalties
-                    break
-                elif submit_status not in (
-                        JudgeStatus.CompilationError,
-                        JudgeStatus.InternalError):
-                    n_penalties += 1
+            if accepted_time is not None:
+                tmp['time'] = accepted_time - contest_start_time
+                score = tmp['score'] = problems[problem_id]
+                max_time = max(max_time, accepted_time)
+                total_score += score
+                total_penalties += n_penalties
             tmp['penalties'] = n_penalties
             ret['problems'][problem_id] = tmp
         total_time = max_time - contest_start_time
@@ -610,7 +972,7 @@ def list_rankings(contest_id: str) -> Response:
         results.append(dict(
             ranking=ranking, user_id=u['id'], problems={}))
 
-    return jsonify(results)
+    return CompressibleBody(json_dumps(results).encode('utf8'))
 
 
 @app.route('/contests/<contest_id>/problems/<problem_id>/tests')
@@ -636,7 +998,7 @@ def upload_test_dataset(contest_id: str, problem_id: str) -> Response:
     from contextlib import ExitStack
     from tempfile import TemporaryFile
 
-    zctx = ZstdCompressor()
+    store = get_blob_store()
     test_cases = []
     ret = []
     with ExitStack() as stack:
@@ -658,49 +1020,74 @@ def upload_test_dataset(contest_id: str, problem_id: str) -> Response:
                 continue
             try:
                 with z.open(path_mapping[k + '.in']) as zi:
-                    in_data = zctx.compress(zi.read())
+                    in_raw = zi.read()
                 with z.open(path_mapping[k + '.out']) as zo:
-                    out_data = zctx.compress(zo.read())
+                    out_raw = zo.read()
             except Exception:
                 continue
             test_cases.append(dict(
                 contest_id=contest_id,
                 problem_id=problem_id,
                 id=k,
-                input=in_data,
-                output=out_data))
+                input_hash=store.put(in_raw),
+                output_hash=store.put(out_raw),
+                input_size=len(in_raw),
+                output_size=len(out_raw)))
             ret.append(k)
 
-    # 参照がないテストケースのみを削除し、
-    # 参照があるテストケースはUPDATE、
-    # 新規テストケースはINSERTする
-    from sqlalchemy import exists
+    # 内容が変わったテストケースと新規テストケースのみを更新し、
+    # tests_versionを増やしてそのバージョンを記録する
+    # (リジャッジはバージョンが提出のジャッジ時点より新しいテストのみ再実行する)
     with transaction() as s:
         _ = _validate_token(s, admin_required=True)
-        s.query(TestCase).filter(
-            TestCase.contest_id == contest_id,
-            TestCase.problem_id == problem_id,
-            ~exists().where(JudgeResult.test_id == TestCase.id)
-        ).delete(synchronize_session=False)
-        for kwargs in test_cases:
-            q = s.query(TestCase).filter(
+        problem = s.query(Problem).with_for_update().filter(
+            Problem.contest_id == contest_id,
+            Problem.id == problem_id).first()
+        if not problem:
+            abort(404)
+        current = {
+            test_id: (input_hash, output_hash)
+            for test_id, input_hash, output_hash in s.query(
+                TestCase.id, TestCase.input_hash, TestCase.output_hash
+            ).filter(
+                TestCase.contest_id == contest_id,
+                TestCase.problem_id == problem_id)}
+        changed = [kwargs for kwargs in test_cases if current.get(
+            kwargs['id']) != (kwargs['input_hash'], kwargs['output_hash'])]
+        removed = set(current.keys()) - set(ret)
+        if not changed and not removed:
+            return jsonify(ret)
+        problem.tests_version += 1
+        if removed:
+            # 削除したテストケースの結果は提出のステータスに含めない
+            s.query(JudgeResult).filter(
+                JudgeResult.contest_id == contest_id,
+                JudgeResult.problem_id == problem_id,
+                JudgeResult.test_id.in_(removed)
+            ).delete(synchronize_session=False)
+            s.query(TestCase).filter(
                 TestCase.contest_id == contest_id,
                 TestCase.problem_id == problem_id,
-                TestCase.id == kwargs['id'])
-            if q.count() == 0:
+                TestCase.id.in_(removed)
+            ).delete(synchronize_session=False)
+        for kwargs in changed:
+            kwargs['version'] = problem.tests_version
+            if kwargs['id'] not in current:
                 s.add(TestCase(**kwargs))
-            else:
-                kwargs.pop('contest_id')
-                kwargs.pop('problem_id')
-                kwargs.pop('id')
-                q.update(kwargs, synchronize_session=False)
+                continue
+            test_id = kwargs.pop('id')
+            kwargs.pop('contest_id')
+            kwargs.pop('problem_id')
+            s.query(TestCase).filter(
+                TestCase.contest_id == contest_id,
+                TestCase.problem_id == problem_id,
+                TestCase.id == test_id
+            ).update(kwargs, synchronize_session=False)
     return jsonify(ret)
 
 
 def _get_test_data(contest_id: str, problem_id: str, test_id: str,
                    is_input: bool) -> Response:
-    zctx = ZstdDecompressor()
-    from io import BytesIO
     with transaction() as s:
         _ = _validate_token(s, admin_required=True)
         tc = s.query(TestCase).filter(
@@ -709,7 +1096,8 @@ def _get_test_data(contest_id: str, problem_id: str, test_id: str,
             TestCase.id == test_id).first()
         if not tc:
             abort(404)
-        f = BytesIO(zctx.decompress(tc.input if is_input else tc.output))
+        f = get_blob_store().open(
+            tc.input_hash if is_input else tc.output_hash)
         return send_file(
             f, as_attachment=True, attachment_filename='{}.{}'.format(
                 test_id, 'in' if is_input else 'out'))
@@ -730,40 +1118,110 @@ def get_test_output_data(contest_id: str, problem_id: str,
 @app.route('/contests/<contest_id>/problems/<problem_id>/rejudge',
            methods=['POST'])
 def rejudge(contest_id: str, problem_id: str) -> Response:
+    """提出をリジャッジする
+
+    既定ではジャッジ後に内容が変わったテストケース/追加されたテストケースと
+    ジャッジが完了しなかったテストケースのみを再実行し、その他の提出は
+    保存済みの結果からステータスを再計算する。
+    full=trueの場合はすべての提出のすべてのテストケースを再実行する
+    """
+    params, _ = _validate_request()
     with transaction() as s:
         _ = _validate_token(s, admin_required=True)
-        s.query(JudgeResult).filter(
-            JudgeResult.contest_id == contest_id,
-            JudgeResult.problem_id == problem_id
-        ).delete(synchronize_session=False)
-        s.query(Submission).filter(
-            Submission.contest_id == contest_id,
-            Submission.problem_id == problem_id
-        ).update({
-            Submission.status: JudgeStatus.Waiting,
-        }, synchronize_session=False)
-        q = s.query(Submission.id).filter(
+        problem = s.query(Problem).filter(
+            Problem.contest_id == contest_id,
+            Problem.id == problem_id).first()
+        if not problem:
+            abort(404)
+        results = JudgeResult.__table__
+        submissions = Submission.__table__
+        tests = TestCase.__table__
+        conds = [results.c.contest_id == contest_id,
+                 results.c.problem_id == problem_id]
+        if not params.query.get('full'):
+            conds += [
+                submissions.c.id == results.c.submission_id,
+                tests.c.contest_id == results.c.contest_id,
+                tests.c.problem_id == results.c.problem_id,
+                tests.c.id == results.c.test_id,
+                or_(submissions.c.tests_version.is_(None),
+                    tests.c.version > submissions.c.tests_version,
+                    results.c.status.in_([
+                        JudgeStatus.Waiting.name, JudgeStatus.Running.name,
+                        JudgeStatus.InternalError.name]))]
+        rejudge_ids = set(submission_id for submission_id, in s.execute(
+            results.delete().where(and_(*conds)).returning(
+                results.c.submission_id)))
+        # fail_fastで省略したテストは、再実行するテストの結果次第で
+        # 実行が必要になるので再実行する
+        if rejudge_ids:
+            s.query(JudgeResult).filter(
+                JudgeResult.contest_id == contest_id,
+                JudgeResult.problem_id == problem_id,
+                JudgeResult.submission_id.in_(rejudge_ids),
+                JudgeResult.status == JudgeStatus.Skipped,
+            ).delete(synchronize_session=False)
+        # 結果のないテストケース(追加されたテストケース)がある提出
+        rejudge_ids.update(submission_id for submission_id, in s.query(
+            Submission.id
+        ).filter(
             Submission.contest_id == contest_id,
-            Submission.problem_id == problem_id
-        )
-        rejudge_list = [x for x, in q]
-
-    conn = pika.BlockingConnection(get_mq_conn_params())
-    ch = conn.channel()
-    ch.queue_declare(queue='judge_queue')
-    for submission_id in rejudge_list:
-        ch.basic_publish(
-            exchange='', routing_key='judge_queue', body=pickle.dumps(
-                (contest_id, problem_id, submission_id)))
-    ch.close()
-    conn.close()
+            Submission.problem_id == problem_id,
+            exists().where(and_(
+                TestCase.contest_id == contest_id,
+                TestCase.problem_id == problem_id,
+                ~exists().where(and_(
+                    JudgeResult.contest_id == contest_id,
+                    JudgeResult.problem_id == problem_id,
+                    JudgeResult.submission_id == Submission.id,
+                    JudgeResult.test_id == TestCase.id))))))
+        if rejudge_ids:
+            s.query(Submission).filter(
+                Submission.id.in_(rejudge_ids)
+            ).update({
+                Submission.status: JudgeStatus.Waiting,
+            }, synchronize_session=False)
+
+        # テストケースの削除等でジャッジ後にtests_versionが変わった提出は
+        # 保存済みの結果からステータスを再計算する
+        stale: Dict[int, List[Any]] = {
+            submission_id: [] for submission_id, in s.query(
+                Submission.id
+            ).filter(
+                Submission.contest_id == contest_id,
+                Submission.problem_id == problem_id,
+                Submission.tests_version != problem.tests_version,
+                Submission.status.notin_([
+                    JudgeStatus.Waiting, JudgeStatus.Running]))
+            if submission_id not in rejudge_ids}
+        if stale:
+            for submission_id, status, time_, memory in s.query(
+                    JudgeResult.submission_id, JudgeResult.status,
+                    JudgeResult.time, JudgeResult.memory).filter(
+                        JudgeResult.contest_id == contest_id,
+                        JudgeResult.problem_id == problem_id,
+                        JudgeResult.submission_id.in_(stale.keys())):
+                stale[submission_id].append((status, time_, memory))
+            mappings = []
+            for submission_id, lst in stale.items():
+                status, max_time, max_memory = summarize_judge_results(lst)
+                mappings.append(dict(
+                    id=submission_id, status=status, max_time=max_time,
+                    max_memory=max_memory,
+                    tests_version=problem.tests_version))
+            s.bulk_update_mappings(Submission, mappings)
+        update_standings(s, contest_id, problem_id)
+
+    publish(REJUDGE_QUEUE, [
+        pickle.dumps((contest_id, problem_id, submission_id))
+        for submission_id in sorted(rejudge_ids)])
 
     return jsonify({})
 
 
 @app.route('/status')
 def get_status() -> Response:
-    ret = {}
+    ret: Dict[str, Any] = {}
     with transaction() as s:
         _ = _validate_token(s, admin_required=True)
         ret['workers'] = [
@@ -771,10 +1229,16 @@ def get_status() -> Response:
                 func.now() - Worker.last_contact < timedelta(seconds=60 * 10),
             ).order_by(Worker.startup_time)]
 
-    conn = pika.BlockingConnection(get_mq_conn_params())
-    ch = conn.channel()
-    queue = ch.queue_declare(queue='judge_queue')
-    ret['queued'] = queue.method.message_count
-    ch.close()
-    conn.close()
+    token_cache = _get_token_cache()
+    ret['caches'] = {
+        'token': {'hits': token_cache.hits, 'misses': token_cache.misses,
+                  'size': len(token_cache)},
+        'rankings': {'hits': _rankings_cache.hits,
+                     'misses': _rankings_cache.misses},
+    }
+
+    counts = get_message_counts([name for _, name in JUDGE_QUEUES])
+    ret['queues'] = {
+        kind: n for (kind, _), n in zip(JUDGE_QUEUES, counts)}
+    ret['queued'] = sum(counts)
     return jsonify(ret)
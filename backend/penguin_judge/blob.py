@@ -0,0 +1,135 @@
+"""テストデータ等のバイナリをDBの外に保存するストア
+
+データは展開済みの内容のSHA256をアドレスとして保存する。内容が同じデータは
+1つだけ保存され、保存済みのデータが書き換えられることはない。
+ストアはblob_storeに指定したURLのスキームで選択する
+(file:///path/to/dir のみ対応)。APIサーバとワーカーで同じストアを
+参照できるようにすること。
+"""
+from abc import ABCMeta, abstractmethod
+from hashlib import sha256
+from logging import getLogger
+import mmap
+import os
+import tempfile
+from typing import BinaryIO, Dict, Optional, Type
+from urllib.parse import urlparse
+
+LOGGER = getLogger(__name__)
+_DEFAULT_DIR = os.path.join(tempfile.gettempdir(), 'penguin_judge', 'blobs')
+_store: Optional['BlobStore'] = None
+_explicit = False
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+class BlobStore(metaclass=ABCMeta):
+    @abstractmethod
+    def put(self, data: bytes) -> bytes:
+        """データを保存してアドレス(SHA256)を返す"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def open(self, digest: bytes) -> BinaryIO:
+        """データを読み込むファイルオブジェクトを返す
+
+        存在しない場合はBlobNotFoundを送出する
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def contains(self, digest: bytes) -> bool:
+        raise NotImplementedError
+
+    def get(self, digest: bytes) -> bytes:
+        with self.open(digest) as f:
+            return f.read()
+
+    def map(self, digest: bytes) -> memoryview:
+        """データをコピーせずに参照する(対応していないストアではget)"""
+        return memoryview(self.get(digest))
+
+
+class LocalBlobStore(BlobStore):
+    """ローカル(またはNFS等の共有)ファイルシステム上のストア
+
+    <ルート>/<SHA256の先頭2文字>/<SHA256の残り> に保存する
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+
+    def put(self, data: bytes) -> bytes:
+        digest = sha256(data).digest()
+        path = self._file_path(digest)
+        if os.path.exists(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 書き込み途中のファイルを参照されないように一時ファイルから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self._path, prefix='~')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return digest
+
+    def open(self, digest: bytes) -> BinaryIO:
+        try:
+            return open(self._file_path(digest), 'rb')
+        except FileNotFoundError:
+            raise BlobNotFound(digest.hex())
+
+    def contains(self, digest: bytes) -> bool:
+        return os.path.exists(self._file_path(digest))
+
+    def map(self, digest: bytes) -> memoryview:
+        with self.open(digest) as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # 長さ0のファイルはmmapできない
+                return memoryview(b'')
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(m)  # type: ignore
+
+    def _file_path(self, digest: bytes) -> str:
+        h = digest.hex()
+        return os.path.join(self._path, h[:2], h[2:])
+
+
+_BACKENDS: Dict[str, Type[BlobStore]] = {
+    'file': LocalBlobStore,
+}
+
+
+def configure(**kwargs: str) -> None:
+    global _store, _explicit
+    _explicit = bool(kwargs.get('blob_store'))
+    if not _explicit:
+        LOGGER.warning(
+            'blob_store is not set. test data is stored in {} and may be '
+            'lost by tmp cleanup or reboot'.format(_DEFAULT_DIR))
+    url = urlparse(kwargs.get('blob_store') or 'file://' + _DEFAULT_DIR)
+    backend = _BACKENDS.get(url.scheme)
+    if backend is None:
+        raise RuntimeError(
+            'config error: unsupported blob_store: {}'.format(url.scheme))
+    _store = backend(url.path)  # type: ignore
+
+
+def is_configured() -> bool:
+    """blob_storeが明示的に指定されているか(一時ディレクトリでないか)"""
+    return _explicit
+
+
+def get_blob_store() -> BlobStore:
+    if _store is None:
+        configure()
+    assert(_store)
+    return _store
@@ -1,6 +1,7 @@
+from typing import Union
 
 
-def equal_binary(answer: bytes, output: bytes) -> bool:
+def equal_binary(answer: Union[bytes, memoryview], output: bytes) -> bool:
     if answer == output:
         return True
     return False
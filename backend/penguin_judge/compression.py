@@ -0,0 +1,121 @@
+"""提出コードの圧縮
+
+提出コードは小さく、1件ずつ独立に圧縮すると圧縮率が低いため、
+言語環境毎に過去の提出から学習したzstdの辞書を使って圧縮する。
+辞書は学習し直す毎に新しいIDでDBに追加し(既存の辞書は変更しない)、
+提出には圧縮に使った辞書のIDを記録する。
+辞書は変更されないので、プロセス内で辞書とスレッド毎の圧縮/展開の
+コンテキストをキャッシュする。
+"""
+from logging import getLogger
+import threading
+from typing import Any, Dict, Optional
+
+from sqlalchemy import func, select
+from zstandard import (  # type: ignore
+    ZstdCompressionDict, ZstdCompressor, ZstdDecompressor, ZstdError,
+    train_dictionary)
+
+from penguin_judge.models import (
+    CodeDictionary, Session, Submission, transaction)
+
+LOGGER = getLogger(__name__)
+_lock = threading.Lock()
+_dictionaries: Dict[int, ZstdCompressionDict] = {}
+_contexts = threading.local()
+
+
+def _get_dictionary(dictionary_id: int) -> ZstdCompressionDict:
+    with _lock:
+        d = _dictionaries.get(dictionary_id)
+    if d is not None:
+        return d
+    # 呼び出し元のトランザクションに影響しないようにSessionとは別の接続で読む
+    table = CodeDictionary.__table__
+    data = Session.get_bind().execute(select([table.c.data]).where(
+        table.c.id == dictionary_id)).scalar()
+    if data is None:
+        raise RuntimeError('dictionary not found: {}'.format(dictionary_id))
+    d = ZstdCompressionDict(data)
+    with _lock:
+        return _dictionaries.setdefault(dictionary_id, d)
+
+
+def _dict_kwargs(dictionary_id: Optional[int]) -> Dict[str, Any]:
+    # zstandard 0.12はdict_data=Noneを受け付けないため辞書が無い場合は省く
+    if dictionary_id is None:
+        return {}
+    return dict(dict_data=_get_dictionary(dictionary_id))
+
+
+def get_compressor(dictionary_id: Optional[int]) -> ZstdCompressor:
+    contexts = getattr(_contexts, 'compressors', None)
+    if contexts is None:
+        contexts = _contexts.compressors = {}
+    cctx = contexts.get(dictionary_id)
+    if cctx is None:
+        cctx = contexts[dictionary_id] = ZstdCompressor(
+            **_dict_kwargs(dictionary_id))
+    return cctx
+
+
+def get_decompressor(dictionary_id: Optional[int]) -> ZstdDecompressor:
+    contexts = getattr(_contexts, 'decompressors', None)
+    if contexts is None:
+        contexts = _contexts.decompressors = {}
+    dctx = contexts.get(dictionary_id)
+    if dctx is None:
+        dctx = contexts[dictionary_id] = ZstdDecompressor(
+            **_dict_kwargs(dictionary_id))
+    return dctx
+
+
+def compress_code(code: bytes, dictionary_id: Optional[int]) -> bytes:
+    return get_compressor(dictionary_id).compress(code)
+
+
+def decompress_code(data: bytes, dictionary_id: Optional[int]) -> bytes:
+    return get_decompressor(dictionary_id).decompress(data)
+
+
+def train_code_dictionary(environment_id: int, max_samples: int = 5000,
+                          dict_size: int = 16384) -> Optional[int]:
+    """言語環境の最近の提出から辞書を学習してDBに追加する
+
+    学習に使わなかった提出(5件に1件)の圧縮後のサイズが現在の辞書より
+    小さくなる場合のみ追加し、追加した辞書のIDを返す
+    """
+    with transaction() as s:
+        rows = s.query(
+            Submission.code, Submission.code_dictionary_id
+        ).filter(
+            Submission.environment_id == environment_id
+        ).order_by(Submission.id.desc()).limit(max_samples).all()
+        current = s.query(func.max(CodeDictionary.id)).filter(
+            CodeDictionary.environment_id == environment_id).scalar()
+    samples = [decompress_code(code, d) for code, d in rows]
+    training = [x for i, x in enumerate(samples) if i % 5]
+    evaluation = samples[::5]
+    if not evaluation:
+        return None
+    try:
+        d = train_dictionary(dict_size, training)
+    except ZstdError:
+        LOGGER.info('cannot train dictionary (environment_id={})'.format(
+            environment_id), exc_info=True)
+        return None
+
+    def _size(cctx: ZstdCompressor) -> int:
+        return sum(len(cctx.compress(x)) for x in evaluation)
+    new_size = _size(ZstdCompressor(dict_data=d))
+    current_size = _size(get_compressor(current))
+    LOGGER.info('trained dictionary (environment_id={}): {} -> {} bytes '
+                '({} samples)'.format(environment_id, current_size,
+                                      new_size, len(evaluation)))
+    if new_size >= current_size:
+        return None
+    with transaction() as s:
+        cd = CodeDictionary(environment_id=environment_id, data=d.as_bytes())
+        s.add(cd)
+        s.flush()
+        return cd.id  # type: ignore
@@ -0,0 +1,175 @@
+"""提出のジャッジ状況の変化の通知
+
+ジャッジ側はSubmission/JudgeResultを更新するトランザクション内で
+notify_submissionを呼び出し、PostgreSQLのNOTIFYで変更内容を送る。
+NOTIFYはコミット時に配送されるため、通知を受け取った時点で変更はDBに
+反映済みであり、ロールバックされた変更は通知されない。
+
+APIプロセスはプロセス毎に1本のLISTEN接続を持ち、subscribeで登録された
+購読者に (contest_id, user_id) 単位で振り分ける。
+"""
+from logging import getLogger
+import json
+import os
+import queue
+import select as _select
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from penguin_judge.models import Session, scoped_session
+from penguin_judge.utils import json_dumps
+
+LOGGER = getLogger(__name__)
+CHANNEL = 'submission_events'
+# NOTIFYのペイロードは8000バイト未満に制限されるため
+# テストケース毎の結果はシリアライズ後のサイズで分割して送る
+_MAX_PAYLOAD_BYTES = 7000
+
+
+def notify_submission(s: scoped_session, contest_id: str, problem_id: str,
+                      submission_id: int, user_id: str,
+                      tests: Optional[List[Dict[str, Any]]] = None,
+                      **values: Any) -> None:
+    """提出の状態(status等)やテストケースの結果の変化を通知する
+
+    testsは {'id': テストケースID, 'status': ..., ...} のリスト。
+    通知はセーブポイント内で送るので、送信に失敗しても呼び出し元の
+    トランザクション(ジャッジ結果の書き込み)は中断しない
+    """
+    event = dict(contest_id=contest_id, problem_id=problem_id,
+                 id=submission_id, user_id=user_id)
+    limit = _MAX_PAYLOAD_BYTES - len(
+        json_dumps(dict(event, tests=[], **values)).encode())
+    chunks: List[List[Dict[str, Any]]] = [[]]
+    size = 0
+    for t in tests or []:
+        n = len(json_dumps(t).encode()) + 1
+        if chunks[-1] and size + n > limit:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(t)
+        size += n
+    payloads = [dict(event, tests=x) if x else dict(event) for x in chunks]
+    # 提出の状態はテストケースの結果と同時か後に通知する
+    payloads[-1].update(values)
+    try:
+        with s.begin_nested():
+            for p in payloads:
+                s.execute(select([func.pg_notify(CHANNEL, json_dumps(p))]))
+    except SQLAlchemyError:
+        LOGGER.warning('cannot notify submission event (id={})'.format(
+            submission_id), exc_info=True)
+
+
+class Subscription(object):
+    def __init__(self, listener: '_Listener',
+                 key: Tuple[str, str]) -> None:
+        self.key = key
+        self._listener = listener
+        self._queue: 'queue.Queue[dict]' = queue.Queue()
+
+    def __enter__(self) -> 'Subscription':
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close()
+
+    def get(self, timeout: float) -> Optional[dict]:
+        """次のイベントを返す。timeout秒以内に届かなければNoneを返す"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def put(self, event: dict) -> None:
+        self._queue.put(event)
+
+    def close(self) -> None:
+        self._listener.unsubscribe(self)
+
+
+class _Listener(object):
+    """LISTEN接続を保持し、受信した通知を購読者に配る
+
+    スレッドは最初の購読時に起動する(gunicornのfork後に起動するため)
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._subscribers: Dict[Tuple[str, str], Set[Subscription]] = {}
+        self._pid: Optional[int] = None
+        self._ready = threading.Event()
+
+    def subscribe(self, contest_id: str, user_id: str,
+                  wait: float = 5.0) -> Subscription:
+        """購読を開始する
+
+        LISTENの開始前に発生した変更を取りこぼさないように、
+        LISTEN接続が確立するまで最大wait秒待つ
+        """
+        sub = Subscription(self, (contest_id, user_id))
+        with self._lock:
+            self._subscribers.setdefault(sub.key, set()).add(sub)
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._ready.clear()
+                threading.Thread(target=self._run, daemon=True).start()
+        self._ready.wait(wait)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            subs = self._subscribers.get(sub.key)
+            if subs is None:
+                return
+            subs.discard(sub)
+            if not subs:
+                del self._subscribers[sub.key]
+
+    def _dispatch(self, payload: str) -> None:
+        try:
+            event = json.loads(payload)
+            key = (event['contest_id'], event['user_id'])
+        except Exception:
+            LOGGER.warning('invalid event: {}'.format(payload))
+            return
+        with self._lock:
+            subs = list(self._subscribers.get(key, ()))
+        for sub in subs:
+            sub.put(event)
+
+    def _run(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = Session.get_bind().raw_connection()
+                dbapi_conn = conn.connection
+                dbapi_conn.autocommit = True
+                with dbapi_conn.cursor() as cur:
+                    cur.execute('LISTEN {}'.format(CHANNEL))
+                self._ready.set()
+                while True:
+                    _select.select([dbapi_conn], [], [], 60)
+                    dbapi_conn.poll()
+                    while dbapi_conn.notifies:
+                        self._dispatch(dbapi_conn.notifies.pop(0).payload)
+            except Exception:
+                LOGGER.warning('LISTEN connection failed', exc_info=True)
+            if conn is not None:
+                try:
+                    conn.invalidate()
+                except Exception:
+                    pass
+            time.sleep(1)
+
+
+_listener = _Listener()
+
+
+def subscribe(contest_id: str, user_id: str) -> Subscription:
+    """指定したユーザのコンテスト内の提出に関する通知を購読する"""
+    return _listener.subscribe(contest_id, user_id)
@@ -1,5 +1,5 @@
 from abc import ABCMeta, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import timedelta
 from io import BufferedIOBase
 import struct
@@ -14,8 +14,11 @@ from penguin_judge.models import JudgeStatus
 @dataclass
 class JudgeTestInfo(object):
     id: str
-    input: bytes
-    output: bytes
+    input_hash: bytes
+    output_hash: bytes
+    # テストデータはジャッジを行うプロセスでblobストアから読み込む
+    input: Union[bytes, memoryview] = b''
+    output: Union[bytes, memoryview] = b''
 
 
 @dataclass
@@ -31,6 +34,14 @@ class JudgeTask(object):
     memory_limit: int
     tests: List[JudgeTestInfo]
     compile_time: Optional[timedelta] = None
+    # codeの圧縮に使った辞書(ジャッジを行うプロセスで展開する)
+    code_dictionary_id: Optional[int] = None
+    # テストケースを並列に実行する数(1の場合は逐次実行)
+    parallelism: int = 1
+    fail_fast: bool = False
+    # ワーカーが事前に起動済みのコンテナを割り当てた場合に設定される
+    compile_container_id: Optional[str] = None
+    test_container_ids: List[str] = field(default_factory=list)
 
 
 class AgentCompilationResult(NamedTuple):
@@ -50,15 +61,31 @@ class AgentError(NamedTuple):
 
 T = TypeVar('T')
 TStartTestCallback = Callable[[str], None]
+# Falseを返した場合は残りのテストを実行しない
 TJudgeCallback = Callable[
-    [JudgeTestInfo, Union[AgentTestResult, AgentError]], None]
+    [JudgeTestInfo, Union[AgentTestResult, AgentError]], bool]
 CompileResult = AgentCompilationResult
 
 
 class JudgeDriver(metaclass=ABCMeta):
+    def take_containers(self, task: JudgeTask) -> None:
+        """ワーカーがtaskに割り当てた起動済みコンテナを引き取る
+
+        ジャッジの開始前に呼び出す。引き取ったコンテナは利用しなかった
+        場合も含めて__exit__で破棄する
+        """
+        pass
+
     def prepare(self, task: JudgeTask) -> None:
         pass
 
+    def image_id(self, image_name: str) -> Optional[str]:
+        """イメージを一意に識別するID(ダイジェスト)を返す
+
+        Noneを返す場合はコンパイル結果をキャッシュしない
+        """
+        return None
+
     @abstractmethod
     def compile(self, task: JudgeTask) -> Union[JudgeStatus, CompileResult]:
         raise NotImplementedError
@@ -87,13 +114,7 @@ class JudgeDriver(metaclass=ABCMeta):
 
     def __recv_agent_resp(
             self, strm: BufferedIOBase, cls: Type[T]) -> Union[T, AgentError]:
-        o = self.__recv(strm)
-        if not isinstance(o, dict) or 'type' not in o:
-            raise ValueError('invalid agent response')
-        if o['type'] == 'Error':
-            return AgentError(kind=o['kind'])
-        args = [o[n] for n in cls._fields]  # type: ignore
-        return cls(*args)
+        return _to_agent_resp(self.__recv(strm), cls)
 
     def _recv_compile_result(self, strm: BufferedIOBase) -> Union[
             AgentCompilationResult, AgentError]:
@@ -102,3 +123,75 @@ class JudgeDriver(metaclass=ABCMeta):
     def _recv_test_result(self, strm: BufferedIOBase) -> Union[
             AgentTestResult, AgentError]:
         return self.__recv_agent_resp(strm, AgentTestResult)
+
+
+class AsyncAgentStream(metaclass=ABCMeta):
+    """エージェントと通信するための非同期ストリーム"""
+
+    @abstractmethod
+    async def readexactly(self, n: int) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def write(self, data: bytes) -> None:
+        raise NotImplementedError
+
+
+class AsyncJudgeDriver(metaclass=ABCMeta):
+    """JudgeDriverのasyncio版
+
+    ワーカーのイベントループ上で複数のジャッジを並行に実行するために使う
+    """
+
+    def take_containers(self, task: JudgeTask) -> None:
+        """JudgeDriver.take_containersを参照"""
+        pass
+
+    async def prepare(self, task: JudgeTask) -> None:
+        pass
+
+    async def image_id(self, image_name: str) -> Optional[str]:
+        return None
+
+    @abstractmethod
+    async def compile(
+            self, task: JudgeTask) -> Union[JudgeStatus, CompileResult]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def tests(self, task: JudgeTask,
+                    start_test_callback: TStartTestCallback,
+                    judge_complete_callback: TJudgeCallback) -> None:
+        raise NotImplementedError
+
+    async def __aenter__(self) -> 'AsyncJudgeDriver':
+        return self
+
+    async def __aexit__(self, exc_type: Any, exc_value: Any,
+                        traceback: Any) -> None:
+        pass
+
+    async def _send(self, strm: AsyncAgentStream, obj: Any) -> None:
+        b = msgpack.packb(obj, use_bin_type=True)
+        await strm.write(struct.pack('<I', len(b)) + b)
+
+    async def __recv(self, strm: AsyncAgentStream) -> dict:
+        sz = struct.unpack('<I', await strm.readexactly(4))[0]
+        return msgpack.unpackb(await strm.readexactly(sz), raw=False)
+
+    async def _recv_compile_result(self, strm: AsyncAgentStream) -> Union[
+            AgentCompilationResult, AgentError]:
+        return _to_agent_resp(await self.__recv(strm), AgentCompilationResult)
+
+    async def _recv_test_result(self, strm: AsyncAgentStream) -> Union[
+            AgentTestResult, AgentError]:
+        return _to_agent_resp(await self.__recv(strm), AgentTestResult)
+
+
+def _to_agent_resp(o: Any, cls: Type[T]) -> Union[T, AgentError]:
+    if not isinstance(o, dict) or 'type' not in o:
+        raise ValueError('invalid agent response')
+    if o['type'] == 'Error':
+        return AgentError(kind=o['kind'])
+    args = [o[n] for n in cls._fields]  # type: ignore
+    return cls(*args)
@@ -0,0 +1,165 @@
+from contextlib import contextmanager
+import fcntl
+from hashlib import sha256
+from logging import getLogger
+import os
+import tempfile
+import time
+from typing import Any, Iterator, Optional, Tuple
+
+LOGGER = getLogger(__name__)
+_DEFAULT_DIR = os.path.join(tempfile.gettempdir(), 'penguin_judge')
+_binary_cache: Optional['FileCache'] = None
+_blob_cache: Optional['FileCache'] = None
+
+
+class FileCache(object):
+    """ローカルディスク上のLRUキャッシュ
+
+    同一ホスト上の複数プロセスから共有して利用する。
+    エントリはキーのハッシュ値をファイル名として保存し、参照時にmtimeを
+    更新する。合計サイズが max_bytes を超えた場合は参照が古い順に削除する。
+    max_bytes が0の場合はキャッシュしない。
+
+    合計サイズとLRU順序はプロセス毎には持たず、格納時にディレクトリ上の
+    ロックファイルをflockした状態でディレクトリを走査して求める。
+    そのため複数プロセスが格納してもディレクトリ全体で max_bytes に収まる。
+    """
+
+    _LOCK_FILE = '.lock'
+
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self._path = path
+        self._max_bytes = max_bytes
+        if max_bytes > 0:
+            os.makedirs(path, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_bytes > 0
+
+    def get(self, key: Tuple[Any, ...]) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        path = self._file_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            _touch(path)
+        except OSError:
+            # 読み込んだ後に他プロセスが削除した
+            pass
+        return data
+
+    def put(self, key: Tuple[Any, ...], data: bytes) -> None:
+        """キャッシュに格納する
+
+        キーの最後の要素以外が一致するエントリ(内容が更新される前の古い
+        エントリ)は削除する
+        """
+        if not self.enabled or len(data) > self._max_bytes:
+            return
+        path = self._file_path(key)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self._path, prefix='~')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            with self._locked():
+                os.replace(tmp_path, path)
+                _touch(path)
+                self._evict(os.path.basename(path))
+        except OSError:
+            LOGGER.warning('cannot write cache entry', exc_info=True)
+
+    def _file_path(self, key: Tuple[Any, ...]) -> str:
+        def _digest(o: Any) -> str:
+            return sha256(repr(o).encode('utf8')).hexdigest()
+        return os.path.join(self._path, '{}.{}'.format(
+            _digest(key[:-1]), _digest(key[-1])))
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with open(os.path.join(self._path, self._LOCK_FILE), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _evict(self, added: str) -> None:
+        """ディレクトリを走査し、同じキーの古いエントリと
+        max_bytes を超えた分を参照が古い順に削除する"""
+        prefix = added.split('.')[0]
+        entries = []
+        for entry in os.scandir(self._path):
+            if entry.name.startswith(('~', '.')):
+                continue
+            if entry.name != added and entry.name.split('.')[0] == prefix:
+                self._unlink(entry.name)
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            # 格納したエントリは最後に削除する
+            entries.append((entry.name == added, st.st_mtime, entry.name,
+                            st.st_size))
+        entries.sort()
+        total = sum(e[3] for e in entries)
+        for _, _, name, size in entries:
+            if total <= self._max_bytes:
+                break
+            self._unlink(name)
+            total -= size
+
+    def _unlink(self, name: str) -> None:
+        try:
+            os.unlink(os.path.join(self._path, name))
+        except OSError:
+            pass
+
+
+def _touch(path: str) -> None:
+    # ファイルシステムのタイムスタンプの粒度では連続した参照の順序が
+    # 区別できないため、現在時刻をナノ秒単位で明示する
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+def configure(**kwargs: str) -> None:
+    global _binary_cache, _blob_cache
+    _binary_cache = FileCache(
+        kwargs.get('binary_cache_dir', os.path.join(_DEFAULT_DIR, 'binaries')),
+        int(kwargs.get('binary_cache_size', 1024)) * (2**20))
+    _blob_cache = FileCache(
+        kwargs.get('blob_cache_dir', os.path.join(_DEFAULT_DIR, 'blobs')),
+        int(kwargs.get('blob_cache_size', 0)) * (2**20))
+
+
+def get_binary_cache() -> FileCache:
+    global _binary_cache
+    if _binary_cache is None:
+        _binary_cache = FileCache('', 0)
+    return _binary_cache
+
+
+def get_blob_cache() -> FileCache:
+    global _blob_cache
+    if _blob_cache is None:
+        _blob_cache = FileCache('', 0)
+    return _blob_cache
+
+
+def binary_key(compile_image_name: str, image_id: str,
+               code: bytes) -> Tuple[Any, ...]:
+    # イメージが更新された場合は古いバイナリを削除するため
+    # イメージIDを最後の要素にする
+    return (compile_image_name, sha256(code).digest(), image_id)
+
+
+def blob_key(digest: bytes) -> Tuple[Any, ...]:
+    # blobの内容は変更されないので置き換え対象となる最後の要素は固定する
+    return (digest, None)
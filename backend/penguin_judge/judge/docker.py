@@ -1,70 +1,283 @@
+import asyncio
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from io import RawIOBase, BufferedReader, BufferedWriter
-from typing import Any, Union, MutableSequence
+from typing import (
+    Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple, Union,
+    MutableSequence)
 import struct
+import threading
+import time
+from urllib.parse import urlparse
 from logging import getLogger
 
 import docker  # type: ignore
 
 from penguin_judge.models import JudgeStatus
 from penguin_judge.judge import (
-    JudgeDriver, JudgeTask, TStartTestCallback, TJudgeCallback,
-    AgentCompilationResult, CompileResult)
+    T, JudgeDriver, JudgeTask, JudgeTestInfo, TStartTestCallback,
+    TJudgeCallback, AgentCompilationResult, AgentTestResult, AgentError,
+    CompileResult, AsyncJudgeDriver, AsyncAgentStream)
 
 LOGGER = getLogger(__name__)
 
 
+COMPILE_MEMORY_LIMIT = 2**30  # TODO(*): 1GB上限
+# コンパイル時にエージェントへ渡す制限値
+COMPILE_TIME_LIMIT = 60  # [sec] TODO(*): コンパイル時間の上限をえいやで1分に
+COMPILE_AGENT_MEMORY_LIMIT = COMPILE_MEMORY_LIMIT // 2**20  # [MiB]
+# プールのコンテナ作成に失敗したイメージを再試行するまでの最大待ち時間
+REFILL_MAX_BACKOFF = 300  # [sec]
+
+
+def docker_client() -> docker.APIClient:
+    """環境変数(DOCKER_HOST等)に従ってDockerのAPIクライアントを作る"""
+    return docker.APIClient(**docker.utils.kwargs_from_env())
+
+
+def docker_socket_path() -> str:
+    """DockerAttachStreamが接続するUNIXソケットのパス
+
+    docker_clientと同じくDOCKER_HOSTに従う(UNIXソケットのみ対応)
+    """
+    url = urlparse(docker.utils.kwargs_from_env().get(
+        'base_url', docker.constants.DEFAULT_UNIX_SOCKET))
+    if url.scheme not in ('unix', 'http+unix'):
+        raise RuntimeError(
+            'async_judge requires unix socket DOCKER_HOST: {}'.format(
+                url.geturl()))
+    return url.path
+
+
+def _create_container(client: docker.APIClient, image_name: str, kind: str,
+                      mem_limit: int = COMPILE_MEMORY_LIMIT) -> str:
+    host_cfg = dict(
+        mem_limit=mem_limit,
+        memswap_limit=mem_limit,
+        auto_remove=True,
+        cap_drop=['ALL'])
+    if kind == 'test':
+        # pids_limit:
+        #    go-langは7, nodejsは8, jdk14は17程度, それ以外は3が最低限。
+        #    余裕を見て20を指定しておく
+        host_cfg['pids_limit'] = 20
+    container = client.create_container(
+        image_name,
+        host_config=client.create_host_config(**host_cfg),
+        stdin_open=True,
+        network_disabled=True)
+    client.start(container)
+    return container['Id']
+
+
+class DockerContainerPool(object):
+    """起動済みの使い捨てコンテナをイメージ毎に保持するプール
+
+    バックグラウンドスレッドが各イメージのコンテナ数を指定された数まで
+    補充し、ジャッジ開始時には takeで起動済みのコンテナを払い出す。
+    払い出したコンテナの後始末(kill)は受け取った側の責任とする。
+    """
+
+    def __init__(self, default_size: int,
+                 sizes: Optional[Dict[str, int]] = None) -> None:
+        self._client = docker_client()
+        self._default_size = default_size
+        self._sizes = sizes or {}
+        self._ready: Dict[Tuple[str, str], Deque[str]] = {}
+        self._hits: Dict[Tuple[str, str], int] = {}
+        self._misses: Dict[Tuple[str, str], int] = {}
+        # 作成に失敗したキー毎の (次に試行する時刻, 待ち時間[sec])
+        self._backoff: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._refill_loop, name='container-pool', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            containers = [c for q in self._ready.values() for c in q]
+            self._ready.clear()
+        self._wakeup.set()
+        for c in containers:
+            try:
+                self._client.kill(c)
+            except Exception:
+                pass
+
+    def size(self, image_name: str) -> int:
+        return self._sizes.get(image_name, self._default_size)
+
+    def set_images(self, compile_images: Iterable[str],
+                   test_images: Iterable[str]) -> None:
+        """プールを維持するイメージを設定する
+
+        一覧に含まれないイメージの待機中コンテナは破棄する
+        """
+        keys = set(
+            [('compile', n) for n in compile_images if n] +
+            [('test', n) for n in test_images if n])
+        removed: List[str] = []
+        with self._lock:
+            for key in list(self._ready.keys()):
+                if key not in keys:
+                    removed.extend(self._ready.pop(key))
+                    self._backoff.pop(key, None)
+            for key in keys:
+                if key not in self._ready:
+                    self._ready[key] = deque()
+        for c in removed:
+            try:
+                self._client.kill(c)
+            except Exception:
+                pass
+        self._wakeup.set()
+
+    def take(self, image_name: str, kind: str) -> Optional[str]:
+        """起動済みのコンテナIDを返す。無い場合はNoneを返す"""
+        key = (kind, image_name)
+        with self._lock:
+            q = self._ready.get(key)
+            container = q.popleft() if q else None
+            counter = self._hits if container else self._misses
+            counter[key] = counter.get(key, 0) + 1
+        self._wakeup.set()
+        return container
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            keys = set(self._ready.keys()) | set(self._hits.keys()) | set(
+                self._misses.keys())
+            return {
+                '{}:{}'.format(*key): dict(
+                    ready=len(self._ready.get(key, ())),
+                    hits=self._hits.get(key, 0),
+                    misses=self._misses.get(key, 0))
+                for key in keys}
+
+    def _next_shortage(self) -> Tuple[Optional[Tuple[str, str]], float]:
+        """補充が必要なキーと、無い場合に待機する秒数を返す
+
+        特定のキーばかり補充しないよう走査の開始位置を毎回ずらし、
+        作成に失敗したキーはバックオフが明けるまで飛ばす
+        """
+        now = time.monotonic()
+        wait = 60.0
+        with self._lock:
+            keys = list(self._ready.keys())
+            for i in range(len(keys)):
+                key = keys[(self._cursor + i) % len(keys)]
+                if len(self._ready[key]) >= self.size(key[1]):
+                    continue
+                retry_at = self._backoff.get(key, (0.0, 0.0))[0]
+                if retry_at > now:
+                    wait = min(wait, retry_at - now)
+                    continue
+                self._cursor = (self._cursor + i + 1) % len(keys)
+                return key, 0.0
+        return None, wait
+
+    def _refill_loop(self) -> None:
+        while not self._closed:
+            self._wakeup.clear()
+            key, wait = self._next_shortage()
+            if key is None:
+                self._wakeup.wait(wait)
+                continue
+            container: Optional[str] = None
+            try:
+                container = _create_container(self._client, key[1], key[0])
+            except Exception:
+                LOGGER.warning(
+                    'cannot create pooled container ({})'.format(key[1]),
+                    exc_info=True)
+                with self._lock:
+                    delay = self._backoff.get(key, (0.0, 2.5))[1] * 2
+                    delay = min(delay, REFILL_MAX_BACKOFF)
+                    self._backoff[key] = (time.monotonic() + delay, delay)
+                continue
+            with self._lock:
+                self._backoff.pop(key, None)
+                q = self._ready.get(key)
+                if q is not None and not self._closed:
+                    q.append(container)
+                    container = None
+            if container:
+                try:
+                    self._client.kill(container)
+                except Exception:
+                    pass
+
+
 class DockerJudgeDriver(JudgeDriver):
     def __init__(self) -> None:
-        self.client = docker.APIClient()
-        self.compile_container = None
-        self.test_container = None
+        self.client = docker_client()
+        self.compile_container: Optional[str] = None
+        self.test_containers: List[str] = []
+        # 引き取ったがまだ利用していない起動済みコンテナ
+        self._pooled: List[str] = []
+
+    def take_containers(self, task: JudgeTask) -> None:
+        self._pooled = [c for c in (
+            task.compile_container_id, *task.test_container_ids) if c]
 
     def prepare(self, task: JudgeTask) -> None:
-        mem_limit = task.memory_limit * (2**20)
-        common_host_cfg = dict(
-            auto_remove=True,
-            cap_drop=['ALL'])
-        common_cfg = dict(
-            stdin_open=True,
-            network_disabled=True,
-        )
         if task.compile_image_name:
-            compile_cfg = dict(
-                host_config=self.client.create_host_config(**dict(
-                    mem_limit=2**30,  # TODO(*): 1GB上限
-                    memswap_limit=2**30,  # TODO(*): 1GB上限
-                    **common_host_cfg)),
-                **common_cfg,
-            )
-            self.compile_container = self.client.create_container(
-                task.compile_image_name, **compile_cfg)
-            self.client.start(self.compile_container)
+            self.compile_container = self._get_container(
+                task.compile_container_id, task.compile_image_name,
+                'compile', COMPILE_MEMORY_LIMIT)
+        else:
+            self._kill([task.compile_container_id])
+        # 並列実行時はテストケースを分割して複数のコンテナで実行する
+        n_containers = max(1, min(task.parallelism, len(task.tests)))
+        pooled = list(task.test_container_ids)
+        for _ in range(n_containers):
+            self.test_containers.append(self._get_container(
+                pooled.pop(0) if pooled else None, task.test_image_name,
+                'test', task.memory_limit * (2**20)))
+        self._kill(pooled)
 
-        # pids_limit:
-        #    go-langは7, nodejsは8, jdk14は17程度, それ以外は3が最低限。
-        #    余裕を見て20を指定しておく
-        test_cfg = dict(
-            host_config=self.client.create_host_config(**dict(
-                mem_limit=mem_limit,
-                memswap_limit=mem_limit,
-                pids_limit=20,
-                **common_host_cfg)),
-            **common_cfg,
-        )
-        self.test_container = self.client.create_container(
-            task.test_image_name, **test_cfg)
-        self.client.start(self.test_container)
+    def image_id(self, image_name: str) -> Optional[str]:
+        return self.client.inspect_image(image_name)['Id']
 
-    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
-        for c in (self.compile_container, self.test_container):
+    def _get_container(self, pooled: Optional[str], image_name: str,
+                       kind: str, mem_limit: int) -> str:
+        # プールから払い出されたコンテナはメモリ制限を問題にあわせて更新する。
+        # 更新に失敗した場合(コンテナが停止している等)は新規に作成する
+        if pooled:
+            try:
+                self.client.update_container(
+                    pooled, mem_limit=mem_limit, memswap_limit=mem_limit)
+                self._pooled.remove(pooled)
+                return pooled
+            except Exception:
+                LOGGER.warning(
+                    'pooled container is unavailable', exc_info=True)
+                self._kill([pooled])
+        return _create_container(self.client, image_name, kind, mem_limit)
+
+    def _kill(self, containers: Iterable[Optional[str]]) -> None:
+        for c in containers:
             if not c:
                 continue
+            if c in self._pooled:
+                self._pooled.remove(c)
             try:
                 self.client.kill(c)
             except Exception:
                 pass
 
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self._kill([
+            self.compile_container, *self.test_containers, *self._pooled])
+
     def compile(self, task: JudgeTask) -> Union[JudgeStatus, CompileResult]:
         s = self.client.attach_socket(
             self.compile_container,
@@ -74,8 +287,8 @@ class DockerJudgeDriver(JudgeDriver):
         self._send(writer, {
             'type': 'Compilation',
             'code': task.code,
-            'time_limit': 60,  # TODO(*): コンパイル時間の上限をえいやで1分に
-            'memory_limit': 1024,  # TODO(*): 1GB上限(docker側の制限とあわせる)
+            'time_limit': COMPILE_TIME_LIMIT,
+            'memory_limit': COMPILE_AGENT_MEMORY_LIMIT,
         })
         resp = self._recv_compile_result(reader)
         if isinstance(resp, AgentCompilationResult):
@@ -85,9 +298,44 @@ class DockerJudgeDriver(JudgeDriver):
     def tests(self, task: JudgeTask,
               start_test_callback: TStartTestCallback,
               judge_complete_callback: TJudgeCallback) -> None:
+        n = len(self.test_containers)
+        if n == 1:
+            self._run_tests(
+                self.test_containers[0], task, task.tests,
+                start_test_callback, judge_complete_callback)
+            return
+
+        # コールバックは呼び出し元から見て直列に呼ばれるようにする
+        lock = threading.Lock()
+        stopped = False
+
+        def _start(test_id: str) -> None:
+            with lock:
+                start_test_callback(test_id)
+
+        def _complete(test: JudgeTestInfo,
+                      resp: Union[AgentTestResult, AgentError]) -> bool:
+            nonlocal stopped
+            with lock:
+                if not judge_complete_callback(test, resp):
+                    stopped = True
+                return not stopped
+
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            futures = [
+                executor.submit(
+                    self._run_tests, container, task, task.tests[i::n],
+                    _start, _complete)
+                for i, container in enumerate(self.test_containers)]
+        for f in futures:
+            f.result()
+
+    def _run_tests(self, container: str, task: JudgeTask,
+                   tests: List[JudgeTestInfo],
+                   start_test_callback: TStartTestCallback,
+                   judge_complete_callback: TJudgeCallback) -> None:
         s = self.client.attach_socket(
-            self.test_container,
-            params={'stdin': 1, 'stdout': 1, 'stream': 1})
+            container, params={'stdin': 1, 'stdout': 1, 'stream': 1})
         reader = BufferedReader(DockerStdoutReader(s))
         writer = BufferedWriter(DockerStdinWriter(s))
         self._send(writer, {
@@ -97,14 +345,157 @@ class DockerJudgeDriver(JudgeDriver):
             'memory_limit': task.memory_limit,
             'output_limit': 1,
         })
-        for test in task.tests:
+        for test in tests:
             start_test_callback(test.id)
             self._send(writer, {
                 'type': 'Test',
                 'input': test.input
             })
             resp = self._recv_test_result(reader)
-            judge_complete_callback(test, resp)
+            if not judge_complete_callback(test, resp):
+                break
+
+
+class AsyncDockerJudgeDriver(AsyncJudgeDriver):
+    """DockerJudgeDriverのasyncio版
+
+    コンテナの作成/削除等の短時間で終わるAPI呼び出しはスレッドプールで
+    実行し、エージェントとの通信はattachしたソケットを非同期に読み書きする
+    """
+
+    def __init__(self) -> None:
+        self._driver = DockerJudgeDriver()
+
+    def take_containers(self, task: JudgeTask) -> None:
+        self._driver.take_containers(task)
+
+    async def prepare(self, task: JudgeTask) -> None:
+        await self._call(self._driver.prepare, task)
+
+    async def image_id(self, image_name: str) -> Optional[str]:
+        return await self._call(self._driver.image_id, image_name)
+
+    async def __aexit__(self, exc_type: Any, exc_value: Any,
+                        traceback: Any) -> None:
+        await self._call(
+            self._driver.__exit__, exc_type, exc_value, traceback)
+
+    async def compile(
+            self, task: JudgeTask) -> Union[JudgeStatus, CompileResult]:
+        assert self._driver.compile_container
+        async with DockerAttachStream(self._driver.compile_container) as strm:
+            await self._send(strm, {
+                'type': 'Compilation',
+                'code': task.code,
+                'time_limit': COMPILE_TIME_LIMIT,
+                'memory_limit': COMPILE_AGENT_MEMORY_LIMIT,
+            })
+            resp = await self._recv_compile_result(strm)
+        if isinstance(resp, AgentCompilationResult):
+            return resp
+        return JudgeStatus.CompilationError
+
+    async def tests(self, task: JudgeTask,
+                    start_test_callback: TStartTestCallback,
+                    judge_complete_callback: TJudgeCallback) -> None:
+        containers = self._driver.test_containers
+        n = len(containers)
+        stopped = False
+
+        def _complete(test: JudgeTestInfo,
+                      resp: Union[AgentTestResult, AgentError]) -> bool:
+            nonlocal stopped
+            if not judge_complete_callback(test, resp):
+                stopped = True
+            return not stopped
+
+        await asyncio.gather(*[
+            self._run_tests(
+                container, task, task.tests[i::n], start_test_callback,
+                _complete)
+            for i, container in enumerate(containers)])
+
+    async def _run_tests(self, container: str, task: JudgeTask,
+                         tests: List[JudgeTestInfo],
+                         start_test_callback: TStartTestCallback,
+                         judge_complete_callback: TJudgeCallback) -> None:
+        async with DockerAttachStream(container) as strm:
+            await self._send(strm, {
+                'type': 'Preparation',
+                'code': task.code,
+                'time_limit': task.time_limit,
+                'memory_limit': task.memory_limit,
+                'output_limit': 1,
+            })
+            for test in tests:
+                start_test_callback(test.id)
+                await self._send(strm, {
+                    'type': 'Test',
+                    'input': test.input
+                })
+                resp = await self._recv_test_result(strm)
+                if not judge_complete_callback(test, resp):
+                    break
+
+    async def _call(self, f: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_event_loop().run_in_executor(
+            None, partial(f, *args))
+
+
+class DockerAttachStream(AsyncAgentStream):
+    """コンテナの標準入出力にattachした非同期ストリーム
+
+    標準出力はDockerの多重化フォーマット(8バイトのヘッダ+ペイロード)から
+    取り出して返す
+    """
+
+    def __init__(self, container: str,
+                 socket_path: Optional[str] = None) -> None:
+        self._container = container
+        self._socket_path = socket_path or docker_socket_path()
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._buf = bytearray()
+
+    async def __aenter__(self) -> 'DockerAttachStream':
+        reader, writer = await asyncio.open_unix_connection(self._socket_path)
+        self._reader, self._writer = reader, writer
+        writer.write((
+            'POST /containers/{}/attach?stdin=1&stdout=1&stream=1 HTTP/1.1\r\n'
+            'Host: docker\r\n'
+            'Connection: Upgrade\r\n'
+            'Upgrade: tcp\r\n'
+            'Content-Length: 0\r\n\r\n').format(self._container).encode())
+        await writer.drain()
+        status_line = await reader.readline()
+        items = status_line.split()
+        if len(items) < 2 or items[1] not in (b'101', b'200'):
+            raise IOError('cannot attach container: {!r}'.format(status_line))
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        return self
+
+    async def __aexit__(self, exc_type: Any, exc_value: Any,
+                        traceback: Any) -> None:
+        if self._writer:
+            self._writer.close()
+
+    async def readexactly(self, n: int) -> bytes:
+        assert self._reader
+        while len(self._buf) < n:
+            header = await self._reader.readexactly(8)
+            sz = struct.unpack('>I', header[4:])[0]
+            body = await self._reader.readexactly(sz)
+            if header[0] == 0x01:
+                self._buf.extend(body)
+        ret = bytes(self._buf[:n])
+        del self._buf[:n]
+        return ret
+
+    async def write(self, data: bytes) -> None:
+        assert self._writer
+        self._writer.write(data)
+        await self._writer.drain()
 
 
 class DockerStdoutReader(RawIOBase):
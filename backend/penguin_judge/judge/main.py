@@ -1,40 +1,56 @@
+import asyncio
+from contextlib import contextmanager
 from datetime import timedelta
+from functools import partial
 from logging import getLogger
-from typing import Callable, Union, List, Tuple, Optional
+import threading
+from typing import (
+    Any, Awaitable, Callable, Dict, Iterator, Union, Set, Tuple, Optional)
 
-from zstandard import ZstdDecompressor  # type: ignore
+import msgpack  # type: ignore
 
+from penguin_judge.blob import get_blob_store
 from penguin_judge.check_result import equal_binary
+from penguin_judge.compression import decompress_code
+from penguin_judge.events import notify_submission
 from penguin_judge.models import (
-    JudgeStatus, Submission, JudgeResult, transaction, scoped_session)
+    JudgeStatus, Submission, JudgeResult, transaction,
+    scoped_session, summarize_judge_results, update_standings)
 from penguin_judge.judge import (
-    T, JudgeDriver, JudgeTask, JudgeTestInfo, AgentTestResult, AgentError)
+    T, JudgeDriver, AsyncJudgeDriver, JudgeTask, JudgeTestInfo,
+    AgentTestResult, AgentError, CompileResult)
+from penguin_judge.judge.cache import (
+    get_binary_cache, get_blob_cache, binary_key, blob_key)
 
 LOGGER = getLogger(__name__)
+_flush_interval = 1.0  # [sec]
+_flush_size = 20
+
+
+def configure(**kwargs: str) -> None:
+    global _flush_interval, _flush_size
+    _flush_interval = float(kwargs.get(
+        'judge_result_flush_interval', _flush_interval))
+    _flush_size = int(kwargs.get('judge_result_flush_size', _flush_size))
 
 
 def run(judge_class: Callable[[], JudgeDriver],
         task: JudgeTask) -> JudgeStatus:
-    LOGGER.info('judge start (contest_id: {}, problem_id: {}, '
-                'submission_id: {}, user_id: {}'.format(
-                    task.contest_id, task.problem_id, task.id, task.user_id))
-    zctx = ZstdDecompressor()
-    try:
-        task.code = zctx.decompress(task.code)
-        for test in task.tests:
-            test.input = zctx.decompress(test.input)
-            test.output = zctx.decompress(test.output)
-    except Exception:
-        LOGGER.warning('decompress failed', exc_info=True)
-        with transaction() as s:
-            return _update_submission_status(s, task,
-                                             JudgeStatus.InternalError)
     with judge_class() as judge:
+        # 割り当て済みのコンテナはジャッジを開始できなかった場合も破棄する
+        judge.take_containers(task)
+        ret = _start(task)
+        if ret:
+            return ret
+        cache_key = None
+        if task.compile_image_name:
+            cache_key = _load_compiled_binary(
+                task, _image_id(judge.image_id, task.compile_image_name))
         ret = _prepare(judge, task)
         if ret:
             return ret
         if task.compile_image_name:
-            ret = _compile(judge, task)
+            ret = _compile(judge, task, cache_key)
             if ret:
                 return ret
         ret = _tests(judge, task)
@@ -42,23 +58,161 @@ def run(judge_class: Callable[[], JudgeDriver],
     return ret
 
 
+async def run_async(judge_class: Callable[[], AsyncJudgeDriver],
+                    task: JudgeTask) -> JudgeStatus:
+    """runのasyncio版
+
+    ジャッジ処理は呼び出し元のイベントループ上で実行し、
+    DBアクセスやキャッシュの読み書きはスレッドプールで実行する
+    """
+    loop = asyncio.get_event_loop()
+
+    def _call(f: Callable[..., T], *args: Any) -> Awaitable[T]:
+        return loop.run_in_executor(None, partial(f, *args))
+
+    async with judge_class() as judge:
+        judge.take_containers(task)
+        ret = await _call(_start, task)
+        if ret:
+            return ret
+        cache_key = None
+        if task.compile_image_name:
+            try:
+                image_id = await judge.image_id(task.compile_image_name)
+            except Exception:
+                LOGGER.warning('cannot get image id', exc_info=True)
+                image_id = None
+            cache_key = await _call(_load_compiled_binary, task, image_id)
+        try:
+            await judge.prepare(task)
+        except Exception:
+            LOGGER.warning('prepare failed', exc_info=True)
+            return await _call(_prepare_failed, task)
+        if task.compile_image_name:
+            try:
+                compile_ret = await judge.compile(task)
+            except Exception:
+                LOGGER.warning('compile failed', exc_info=True)
+                compile_ret = JudgeStatus.InternalError
+            ret = await _call(_compiled, task, compile_ret, cache_key)
+            if ret:
+                return ret
+        results = _TestResults(task)
+        try:
+            await judge.tests(task, results.start, results.complete)
+        except Exception:
+            results.error()
+        status = await _call(results.finish)
+    LOGGER.info('judge finished (submission_id={}): {}'.format(
+        task.id, status))
+    return status
+
+
+def _start(task: JudgeTask) -> Optional[JudgeStatus]:
+    LOGGER.info('judge start (contest_id: {}, problem_id: {}, '
+                'submission_id: {}, user_id: {}'.format(
+                    task.contest_id, task.problem_id, task.id, task.user_id))
+    try:
+        task.code = decompress_code(task.code, task.code_dictionary_id)
+        _load_tests(task)
+        return None
+    except Exception:
+        LOGGER.warning('cannot load code or test data', exc_info=True)
+        with transaction() as s:
+            return _update_submission_status(s, task,
+                                             JudgeStatus.InternalError)
+
+
+def _load_tests(task: JudgeTask) -> None:
+    """テストデータをblobストアから読み込む
+
+    ローカルのストアではmmapで参照するので、テストデータはコピーしない。
+    NFS等の共有ストアではblob_cache_sizeを指定すると、読み込んだデータを
+    ホスト内のワーカーで共有するローカルディスクにキャッシュする
+    """
+    store, cache = get_blob_store(), get_blob_cache()
+
+    def _load(digest: bytes) -> Union[bytes, memoryview]:
+        if not cache.enabled:
+            return store.map(digest)
+        key = blob_key(digest)
+        data = cache.get(key)
+        if data is None:
+            data = store.get(digest)
+            cache.put(key, data)
+        return data
+
+    for test in task.tests:
+        test.input = _load(test.input_hash)
+        test.output = _load(test.output_hash)
+
+
+def _image_id(f: Callable[[str], Optional[str]],
+              image_name: str) -> Optional[str]:
+    if not get_binary_cache().enabled:
+        return None
+    try:
+        return f(image_name)
+    except Exception:
+        LOGGER.warning('cannot get image id', exc_info=True)
+        return None
+
+
+def _load_compiled_binary(
+        task: JudgeTask, image_id: Optional[str]
+) -> Optional[Tuple[Any, ...]]:
+    """コンパイル済みバイナリをキャッシュから読み込む
+
+    キャッシュのキーを返す。イメージIDが取得できない場合はNoneを返す
+    """
+    assert task.compile_image_name
+    if not image_id or not get_binary_cache().enabled:
+        return None
+    cache_key = binary_key(task.compile_image_name, image_id, task.code)
+    data = get_binary_cache().get(cache_key)
+    if data is None:
+        return cache_key
+    try:
+        cached = msgpack.unpackb(data, raw=False)
+        binary, compile_time = cached['binary'], cached['time']
+    except Exception:
+        LOGGER.warning('broken binary cache entry', exc_info=True)
+        return cache_key
+    LOGGER.info('use cached binary (submission_id={})'.format(task.id))
+    task.code, task.compile_time = binary, timedelta(seconds=compile_time)
+    # コンパイル済みなのでコンパイル用コンテナの起動とコンパイルを省略する
+    task.compile_image_name = None
+    return cache_key
+
+
 def _prepare(judge: JudgeDriver, task: JudgeTask) -> Union[JudgeStatus, None]:
     try:
         judge.prepare(task)
         return None
     except Exception:
         LOGGER.warning('prepare failed', exc_info=True)
-        with transaction() as s:
-            return _update_submission_status(
-                s, task, JudgeStatus.InternalError)
+        return _prepare_failed(task)
+
 
+def _prepare_failed(task: JudgeTask) -> JudgeStatus:
+    with transaction() as s:
+        return _update_submission_status(s, task, JudgeStatus.InternalError)
 
-def _compile(judge: JudgeDriver, task: JudgeTask) -> Union[JudgeStatus, None]:
+
+def _compile(judge: JudgeDriver, task: JudgeTask,
+             cache_key: Optional[Tuple[Any, ...]] = None
+             ) -> Union[JudgeStatus, None]:
     try:
         ret = judge.compile(task)
     except Exception:
         LOGGER.warning('compile failed', exc_info=True)
         ret = JudgeStatus.InternalError
+    return _compiled(task, ret, cache_key)
+
+
+def _compiled(task: JudgeTask, ret: Union[JudgeStatus, CompileResult],
+              cache_key: Optional[Tuple[Any, ...]]
+              ) -> Union[JudgeStatus, None]:
     if isinstance(ret, JudgeStatus):
         with transaction() as s:
             _update_submission_status(s, task, ret)
@@ -72,17 +226,135 @@ def _compile(judge: JudgeDriver, task: JudgeTask) -> Union[JudgeStatus, None]:
                 task.id, ret))
         return ret
     task.code, task.compile_time = ret.binary, timedelta(seconds=ret.time)
+    if cache_key:
+        get_binary_cache().put(cache_key, msgpack.packb(
+            {'binary': ret.binary, 'time': ret.time}, use_bin_type=True))
     return None
 
 
+class _JudgeResultWriter(object):
+    """テストケース毎のJudgeResultの更新をまとめて書き込むバッファ
+
+    同一テストケースへの更新は最後の値に集約し、件数が flush_size に
+    達した時点、もしくは flush_interval 毎にバックグラウンドで
+    一括UPDATEする。updateは呼び出し元をDBアクセスで待たせない。
+    """
+
+    def __init__(self, task: JudgeTask, interval: float,
+                 batch_size: int) -> None:
+        self._task = task
+        self._interval = interval
+        self._batch_size = batch_size
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> '_JudgeResultWriter':
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+
+    def update(self, test_id: str, **values: Any) -> None:
+        with self._lock:
+            self._pending.setdefault(test_id, {}).update(values)
+            if len(self._pending) >= self._batch_size:
+                self._wakeup.set()
+
+    def flush(self) -> None:
+        """バッファの内容を書き込んでコミットする
+
+        コミットに失敗した場合はバッファに残し、次回のflushで再度書き込む。
+        書き込み中にupdateされたテストケースはバッファに残す
+        """
+        with self._lock:
+            if not self._pending:
+                return
+        with self.flushing():
+            pass
+
+    @contextmanager
+    def flushing(self) -> Iterator[scoped_session]:
+        """バッファの内容を書き込んだトランザクションのセッションを返す
+
+        呼び出し元が同じトランザクションで行った変更と共にコミットし、
+        コミットに成功した場合のみバッファから取り除く
+        """
+        with self._flush_lock:
+            with self._lock:
+                snapshot = {
+                    test_id: dict(values)
+                    for test_id, values in self._pending.items()}
+            with transaction() as s:
+                if snapshot:
+                    self._write(s, snapshot)
+                yield s
+            with self._lock:
+                for test_id, values in snapshot.items():
+                    if self._pending.get(test_id) == values:
+                        del self._pending[test_id]
+
+    def _write(self, s: scoped_session,
+               pending: Dict[str, Dict[str, Any]]) -> None:
+        task = self._task
+        s.bulk_update_mappings(JudgeResult, [dict(
+            contest_id=task.contest_id,
+            problem_id=task.problem_id,
+            submission_id=task.id,
+            test_id=test_id,
+            **values) for test_id, values in pending.items()])
+        notify_submission(
+            s, task.contest_id, task.problem_id, task.id, task.user_id,
+            tests=[dict(id=test_id, **values)
+                   for test_id, values in pending.items()])
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.flush()
+            except Exception:
+                LOGGER.warning('flush failed', exc_info=True)
+
+
 def _tests(judge: JudgeDriver, task: JudgeTask) -> JudgeStatus:
-    judge_results: List[
-        Tuple[JudgeStatus, Optional[timedelta], Optional[int]]] = []
+    results = _TestResults(task)
+    try:
+        judge.tests(task, results.start, results.complete)
+    except Exception:
+        results.error()
+    return results.finish()
 
-    def judge_test_cmpl(
-            test: JudgeTestInfo,
-            resp: Union[AgentTestResult, AgentError]
-    ) -> None:
+
+class _TestResults(object):
+    """テストケースの実行結果を集計し、JudgeResult/Submissionに書き込む
+
+    start/completeをJudgeDriver.testsのコールバックとして渡し、
+    テスト完了後にfinishを呼び出す
+    """
+
+    def __init__(self, task: JudgeTask) -> None:
+        self._task = task
+        self._errored = False
+        self._completed: Set[str] = set()
+        self._stopped = False
+        self._writer = _JudgeResultWriter(task, _flush_interval, _flush_size)
+        self._writer.__enter__()
+
+    def start(self, test_id: str) -> None:
+        self._writer.update(test_id, status=JudgeStatus.Running)
+
+    def complete(self, test: JudgeTestInfo,
+                 resp: Union[AgentTestResult, AgentError]) -> bool:
         time: Optional[timedelta] = None
         memory_kb: Optional[int] = None
         if isinstance(resp, AgentTestResult):
@@ -96,74 +368,57 @@ def _tests(judge: JudgeDriver, task: JudgeTask) -> JudgeStatus:
                 status = JudgeStatus.WrongAnswer
         else:
             status = JudgeStatus.from_str(resp.kind)
-        judge_results.append((status, time, memory_kb))
-        with transaction() as s:
-            s.query(JudgeResult).filter(
-                JudgeResult.contest_id == task.contest_id,
-                JudgeResult.problem_id == task.problem_id,
-                JudgeResult.submission_id == task.id,
-                JudgeResult.test_id == test.id,
-            ).update({
-                JudgeResult.status: status,
-                JudgeResult.time: time,
-                JudgeResult.memory: memory_kb,
-            }, synchronize_session=False)
+        self._completed.add(test.id)
+        self._writer.update(
+            test.id, status=status, time=time, memory=memory_kb)
+        if self._task.fail_fast and status != JudgeStatus.Accepted:
+            self._stopped = True
+        return not self._stopped
 
-    def start_test_func(test_id: str) -> None:
-        with transaction() as s:
-            s.query(JudgeResult).filter(
+    def error(self) -> None:
+        LOGGER.warning(
+            'test failed (submission_id={})'.format(self._task.id),
+            exc_info=True)
+        self._errored = True
+
+    def finish(self) -> JudgeStatus:
+        task, writer = self._task, self._writer
+        writer.__exit__(None, None, None)
+        if self._stopped:
+            for test in task.tests:
+                if test.id not in self._completed:
+                    writer.update(test.id, status=JudgeStatus.Skipped)
+
+        # 残りのテストケースの結果は提出のステータスと同じトランザクションで
+        # 書き込み、集計した結果と一致させる
+        with writer.flushing() as s:
+            # リジャッジで再実行しなかったテストの結果も含めて集計する
+            results = s.query(
+                JudgeResult.status, JudgeResult.time, JudgeResult.memory
+            ).filter(
                 JudgeResult.contest_id == task.contest_id,
                 JudgeResult.problem_id == task.problem_id,
-                JudgeResult.submission_id == task.id,
-                JudgeResult.test_id == test_id,
+                JudgeResult.submission_id == task.id).all()
+            if self._errored:
+                results.append((JudgeStatus.InternalError, None, None))
+            submission_status, max_time, max_memory = summarize_judge_results(
+                results)
+            s.query(Submission).filter(
+                Submission.contest_id == task.contest_id,
+                Submission.problem_id == task.problem_id,
+                Submission.id == task.id
             ).update({
-                JudgeResult.status: JudgeStatus.Running
+                Submission.status: submission_status,
+                Submission.compile_time: task.compile_time,
+                Submission.max_time: max_time,
+                Submission.max_memory: max_memory,
             }, synchronize_session=False)
-
-    try:
-        judge.tests(task, start_test_func, judge_test_cmpl)
-    except Exception:
-        LOGGER.warning(
-            'test failed (submission_id={})'.format(task.id), exc_info=True)
-        judge_results.append((JudgeStatus.InternalError, None, None))
-
-    def get_submission_status() -> JudgeStatus:
-        judge_status = set([s for s, _, _ in judge_results])
-        if len(judge_status) == 1:
-            return list(judge_status)[0]
-        for x in (JudgeStatus.InternalError, JudgeStatus.RuntimeError,
-                  JudgeStatus.WrongAnswer, JudgeStatus.MemoryLimitExceeded,
-                  JudgeStatus.TimeLimitExceeded,
-                  JudgeStatus.OutputLimitExceeded):
-            if x in judge_status:
-                return x
-        return JudgeStatus.InternalError  # pragma: no cover
-
-    def max_value(lst: List[T]) -> Optional[T]:
-        ret = None
-        for x in lst:
-            if x is None:
-                continue
-            if ret is None or ret < x:
-                ret = x
-        return ret
-
-    submission_status = get_submission_status()
-    max_time = max_value([t for _, t, _ in judge_results])
-    max_memory = max_value([m for _, _, m in judge_results])
-
-    with transaction() as s:
-        s.query(Submission).filter(
-            Submission.contest_id == task.contest_id,
-            Submission.problem_id == task.problem_id,
-            Submission.id == task.id
-        ).update({
-            Submission.status: submission_status,
-            Submission.compile_time: task.compile_time,
-            Submission.max_time: max_time,
-            Submission.max_memory: max_memory,
-        }, synchronize_session=False)
-    return submission_status
+            update_standings(s, task.contest_id, task.problem_id, task.user_id)
+            notify_submission(
+                s, task.contest_id, task.problem_id, task.id, task.user_id,
+                status=submission_status, max_time=max_time,
+                max_memory=max_memory)
+        return submission_status
 
 
 def _update_submission_status(
@@ -174,4 +429,8 @@ def _update_submission_status(
         Submission.problem_id == task.problem_id,
         Submission.id == task.id,
     ).update({Submission.status: status}, synchronize_session=False)
+    update_standings(s, task.contest_id, task.problem_id, task.user_id)
+    notify_submission(
+        s, task.contest_id, task.problem_id, task.id, task.user_id,
+        status=status)
     return status
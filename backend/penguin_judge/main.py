@@ -3,7 +3,8 @@ from configparser import ConfigParser
 from os import sched_getaffinity
 from typing import Any, Mapping
 
-from penguin_judge.models import configure, get_db_config
+from penguin_judge.blob import configure as configure_blob, is_configured
+from penguin_judge.models import configure
 from penguin_judge.mq import configure as configure_mq
 
 
@@ -32,6 +33,10 @@ def _configure_app(config: Mapping[str, str]) -> None:
     from penguin_judge.api import app
     defines = [
         ('user_judge_queue_limit', '10', int),
+        ('token_cache_ttl', '10', float),
+        ('token_cache_size', '10000', int),
+        ('event_stream_timeout', '15', float),
+        ('compress_min_size', '1024', int),
     ]
     for name, default_value, parser in defines:
         app.config[name] = parser(config.get(name, default_value))
@@ -42,6 +47,7 @@ def start_api(args: Namespace) -> None:
     from penguin_judge.api import app
 
     config = _load_config(args, 'api')
+    configure_blob(**config)
     configure_mq(**config)
     _configure_app(config)
 
@@ -50,6 +56,11 @@ def start_api(args: Namespace) -> None:
             config = _load_config(args, 'gunicorn', exclude_defaults=True)
             for key, value in config.items():
                 self.cfg.set(key.lower(), value)
+            # syncワーカーはtimeout秒応答しないと強制終了されるため
+            # Server-Sent Eventsの接続時間をその半分に制限する
+            if self.cfg.worker_class_str == 'sync':
+                app.config['event_stream_timeout'] = min(
+                    app.config['event_stream_timeout'], self.cfg.timeout / 2)
 
         def load(self) -> Any:
             # DBはプロセス単位で初期化する必要がある
@@ -61,13 +72,44 @@ def start_api(args: Namespace) -> None:
 
 def start_worker(args: Namespace) -> None:
     from penguin_judge.worker import main as worker_main
+    from penguin_judge.judge.cache import configure as configure_cache
     config = _load_config(args, 'worker')
+    configure_blob(**config)
+    if not is_configured():
+        # 一時ディレクトリはAPIサーバと共有されず、全てのジャッジが失敗する
+        raise RuntimeError('config error: blob_store must be specified')
     configure(**config)
     configure_mq(**config)
+    configure_cache(**config)
     max_processes = int(config.get('max_processes', 0))
     if max_processes <= 0:
         max_processes = len(sched_getaffinity(0))
-    worker_main(get_db_config(), max_processes)
+    worker_main(config, max_processes)
+
+
+def start_migrate(args: Namespace) -> None:
+    from sqlalchemy import engine_from_config
+    from penguin_judge.models import migrate
+    config = _load_config(args, 'api')
+    configure_blob(**config)
+    # 起動時の移行はインデックス作成中に書き込みを止めるので、
+    # 大きなデータベースではサーバの更新前にこちらで移行しておく
+    migrate(engine_from_config(config), concurrently=True)
+
+
+def start_train_dictionaries(args: Namespace) -> None:
+    from penguin_judge.compression import train_code_dictionary
+    from penguin_judge.models import Environment, transaction
+    config = _load_config(args, 'api')
+    configure(**config)
+    with transaction() as s:
+        environment_ids = [x for x, in s.query(Environment.id)]
+    for environment_id in environment_ids:
+        dictionary_id = train_code_dictionary(
+            environment_id, args.samples, args.dict_size)
+        print('environment {}: {}'.format(
+            environment_id, 'dictionary {} added'.format(dictionary_id)
+            if dictionary_id else 'not updated'))
 
 
 def main() -> None:
@@ -87,6 +129,19 @@ def main() -> None:
         'worker', help='Judge Worker'))
     worker_parser.set_defaults(start=start_worker)
 
+    migrate_parser = add_common_args(subparsers.add_parser(
+        'migrate', help='Migrate Database'))
+    migrate_parser.set_defaults(start=start_migrate)
+
+    train_parser = add_common_args(subparsers.add_parser(
+        'train-dictionaries',
+        help='Train zstd dictionaries for submission code'))
+    train_parser.add_argument('--samples', type=int, default=5000,
+                              help='max submissions per environment')
+    train_parser.add_argument('--dict-size', type=int, default=16384,
+                              help='dictionary size in bytes')
+    train_parser.set_defaults(start=start_train_dictionaries)
+
     args = parser.parse_args()
     if hasattr(args, 'start'):
         args.start(args)
@@ -1,14 +1,25 @@
 from contextlib import contextmanager
 import datetime
 import enum
-from typing import Dict, Iterator, Optional, List
+from inspect import getattr_static
+import operator
+from typing import (
+    Any, Dict, Iterable, Iterator, Optional, List, Set, Tuple)
+import warnings
 
 from sqlalchemy import (
     Boolean, Column, DateTime, Integer, String, LargeBinary, Interval, Enum,
-    func, ForeignKeyConstraint, Index)
-from sqlalchemy.exc import IntegrityError, ProgrammingError
+    func, ForeignKeyConstraint, Index, and_, bindparam, event, inspect,
+    select)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError, ProgrammingError, SAWarning
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from sqlalchemy.orm import Load, scoped_session, sessionmaker
+from sqlalchemy.orm.attributes import QueryableAttribute
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import (
+    BinaryExpression, BindParameter, BooleanClauseList, ClauseList, Grouping)
 
 Base = declarative_base()
 Session = scoped_session(sessionmaker())
@@ -25,6 +36,7 @@ class JudgeStatus(enum.Enum):
     MemoryLimitExceeded = 0x30
     TimeLimitExceeded = 0x31
     OutputLimitExceeded = 0x32
+    Skipped = 0x40
     InternalError = 0xFF
 
     @staticmethod
@@ -41,16 +53,49 @@ class _Exportable(object):
         str, int, list, dict, float, bool, bytes,
         datetime.datetime, datetime.timedelta, enum.Enum)
 
+    @classmethod
+    def _export_keys(cls) -> List[str]:
+        """to_dictで出力する可能性のある属性名(dir順)
+
+        メソッドやメタデータ等の出力されない属性を除いてクラス毎に
+        一度だけ計算する
+        """
+        keys = cls.__dict__.get('_export_keys_cache')
+        if keys is None:
+            keys = [
+                k for k in dir(cls) if not k.startswith('_') and (
+                    isinstance(getattr_static(cls, k),
+                               (QueryableAttribute, property)) or
+                    isinstance(getattr(cls, k), cls.VALID_TYPES))]
+            setattr(cls, '_export_keys_cache', keys)
+        return keys
+
     def to_dict(self, *, keys: Optional[List[str]] = None) -> dict:
         if not keys:
-            keys = [k for k in dir(self) if not k.startswith('_')]
-        return {
-            k: getattr(self, k) for k in keys
-            if isinstance(getattr(self, k), self.VALID_TYPES)}
+            keys = self._export_keys()
+        # ロード済みの属性はインスタンスの__dict__から直接読み出す
+        # (未ロードの属性は通常通りgetattrでロードする)
+        loaded = self.__dict__
+        ret = {}
+        for k in keys:
+            v = loaded[k] if k in loaded else getattr(self, k)
+            if isinstance(v, self.VALID_TYPES):
+                ret[k] = v
+        return ret
 
     def to_summary_dict(self) -> dict:
         return self.to_dict(keys=getattr(self, '__summary_keys__', None))
 
+    @classmethod
+    def load_summary_only(cls) -> Load:
+        """__summary_keys__のカラムのみを読み込むクエリオプション
+
+        to_summary_dictしか呼ばない一覧取得で、提出コード等の
+        不要なカラムの転送とORMへの展開を省略するために使う
+        """
+        return Load(cls).load_only(  # type: ignore
+            *getattr(cls, '__summary_keys__'))
+
 
 class User(Base, _Exportable):
     __tablename__ = 'users'
@@ -90,7 +135,8 @@ class Environment(Base, _Exportable):
 class Contest(Base, _Exportable):
     __tablename__ = 'contests'
     __updatable_keys__ = [
-        'title', 'description', 'start_time', 'end_time', 'published']
+        'title', 'description', 'start_time', 'end_time', 'published',
+        'reuse_judge_results']
     __summary_keys__ = ['id', 'title', 'start_time', 'end_time', 'published']
     id = Column(String, primary_key=True)
     title = Column(String, nullable=False)
@@ -99,6 +145,9 @@ class Contest(Base, _Exportable):
     end_time = Column(DateTime(timezone=True), nullable=False)
     published = Column(Boolean, server_default='False', nullable=False)
     penalty = Column(Interval, server_default='300', nullable=False)
+    # 同じコードの提出のジャッジ結果を流用する
+    reuse_judge_results = Column(
+        Boolean, server_default='True', nullable=False)
 
     def is_begun(self) -> bool:
         now = datetime.datetime.now(tz=datetime.timezone.utc)
@@ -116,7 +165,8 @@ class Contest(Base, _Exportable):
 class Problem(Base, _Exportable):
     __tablename__ = 'problems'
     __updatable_keys__ = [
-        'title', 'description', 'time_limit', 'memory_limit', 'score']
+        'title', 'description', 'time_limit', 'memory_limit', 'score',
+        'fail_fast']
     contest_id = Column(String, primary_key=True)
     id = Column(String, primary_key=True)
     title = Column(String, nullable=False)
@@ -124,9 +174,15 @@ class Problem(Base, _Exportable):
     memory_limit = Column(Integer, nullable=False)  # MiB
     description = Column(String, nullable=False)
     score = Column(Integer, nullable=False)
+    # 最初に不正解となった時点で残りのテストを省略する
+    fail_fast = Column(Boolean, server_default='False', nullable=False)
+    # ジャッジ結果に影響する変更(テストデータや制限値)の毎に増やす
+    tests_version = Column(Integer, server_default='1', nullable=False)
     __table_args__ = (
         ForeignKeyConstraint([contest_id], [Contest.id]),  # type: ignore
     )
+    # tests_versionを増やす変更
+    __judge_keys__ = ['time_limit', 'memory_limit', 'fail_fast']
 
 
 class TestCase(Base, _Exportable):
@@ -134,14 +190,33 @@ class TestCase(Base, _Exportable):
     contest_id = Column(String, primary_key=True)
     problem_id = Column(String, primary_key=True)
     id = Column(String, primary_key=True)
-    input = Column(LargeBinary, nullable=False)
-    output = Column(LargeBinary, nullable=False)
+    # テストデータの内容はblobストアに保存し、SHA256(アドレス)とサイズを持つ
+    input_hash = Column(LargeBinary(32), nullable=False)
+    output_hash = Column(LargeBinary(32), nullable=False)
+    input_size = Column(Integer, nullable=False)
+    output_size = Column(Integer, nullable=False)
+    # 内容を最後に変更した時点の問題のtests_version
+    version = Column(Integer, server_default='1', nullable=False)
     __table_args__ = (
         ForeignKeyConstraint([contest_id, problem_id],  # type: ignore
                              [Problem.contest_id, Problem.id]),
     )
 
 
+class CodeDictionary(Base):
+    """提出コードの圧縮に使うzstdの辞書(言語環境毎、追加のみ)"""
+    __tablename__ = 'code_dictionaries'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    environment_id = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    created = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False)
+    __table_args__ = (
+        ForeignKeyConstraint(
+            [environment_id], [Environment.id]),  # type: ignore
+    )
+
+
 class Submission(Base, _Exportable):
     __tablename__ = 'submissions'
     __summary_keys__ = [
@@ -152,7 +227,10 @@ class Submission(Base, _Exportable):
     problem_id = Column(String, nullable=False)
     user_id = Column(String, nullable=False)
     code = Column(LargeBinary, nullable=False)
+    # codeの圧縮に使った辞書(NULLの場合は辞書なし)
+    code_dictionary_id = Column(Integer, nullable=True)
     code_bytes = Column(Integer, nullable=False)
+    code_hash = Column(LargeBinary(32), nullable=True)  # 展開後のSHA256
     environment_id = Column(Integer, nullable=False)
     status = Column(
         Enum(JudgeStatus), server_default=JudgeStatus.Waiting.name,
@@ -162,6 +240,11 @@ class Submission(Base, _Exportable):
     max_memory = Column(Integer, nullable=True)  # KiB
     created = Column(
         DateTime(timezone=True), server_default=func.now(), nullable=False)
+    # ジャッジした時点の問題のtests_version
+    tests_version = Column(Integer, nullable=True)
+    # ジャッジした時点の言語環境のイメージ
+    compile_image_name = Column(String, nullable=True)
+    test_image_name = Column(String, nullable=True)
     __table_args__ = (
         ForeignKeyConstraint(
             [contest_id, problem_id],  # type: ignore
@@ -170,8 +253,22 @@ class Submission(Base, _Exportable):
             [user_id], [User.id]),  # type: ignore
         ForeignKeyConstraint(
             [environment_id], [Environment.id]),  # type: ignore
+        ForeignKeyConstraint(
+            [code_dictionary_id], [CodeDictionary.id]),  # type: ignore
         Index('submissions_contest_problem_idx', contest_id, problem_id),
+        # 提出一覧(作成日時順)とコンテスト期間内の提出の集計
+        Index('submissions_contest_created_idx', contest_id, created, id),
+        # 自分の提出一覧とユーザ/問題単位の順位表の再計算
+        Index('submissions_contest_user_idx',
+              contest_id, user_id, problem_id),
+        # 同じコードのジャッジ済みの提出の検索
+        Index('submissions_code_hash_idx', code_hash),
+        # ジャッジ待ち/ジャッジ中の提出数をユーザ毎に数えるための部分インデックス
+        Index('submissions_inflight_idx', user_id, postgresql_where=status.in_(
+            [JudgeStatus.Waiting.name, JudgeStatus.Running.name])),
     )
+    # status/created等のサーバ側デフォルト値をINSERT時にRETURNINGで取得する
+    __mapper_args__ = {'eager_defaults': True}
 
     def is_accessible(self, contest: Contest,
                       user_info: Optional[dict]) -> bool:
@@ -198,9 +295,48 @@ class JudgeResult(Base, _Exportable):
         ForeignKeyConstraint(
             [contest_id, problem_id, test_id],  # type: ignore
             [TestCase.contest_id, TestCase.problem_id, TestCase.id]),
+        # 提出IDのみで提出のテストケース毎の結果を取得する
+        Index('judge_results_submission_idx', submission_id),
     )
 
 
+class Standing(Base):
+    """順位表のセル(ユーザ x 問題)
+
+    コンテスト期間中の提出から集計した値を保持する。
+    Submissionの追加/ステータス変更時に update_standings で再計算する
+    """
+    __tablename__ = 'standings'
+    contest_id = Column(String, primary_key=True)
+    user_id = Column(String, primary_key=True)
+    problem_id = Column(String, primary_key=True)
+    penalties = Column(Integer, nullable=False)
+    # 最初に正解した提出の日時(未正解の場合はNULL)
+    accepted = Column(DateTime(timezone=True), nullable=True)
+    first_submitted = Column(DateTime(timezone=True), nullable=False)
+    __table_args__ = (
+        ForeignKeyConstraint(
+            [contest_id, problem_id],  # type: ignore
+            [Problem.contest_id, Problem.id]),
+        ForeignKeyConstraint(
+            [user_id], [User.id]),  # type: ignore
+    )
+
+
+class StandingsVersion(Base):
+    """順位表の更新回数
+
+    update_standings でセルが変化したトランザクションのコミット直前に加算する
+    (順位表APIのETagに利用)。
+    contest_id が ALL_CONTESTS の行は、ユーザの追加/削除等の全コンテストの
+    順位表に影響する更新の回数を表す
+    """
+    __tablename__ = 'standings_versions'
+    # コンテストを作り直した場合もバージョンが戻らないよう外部キーは設定しない
+    contest_id = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
 class Worker(Base, _Exportable):
     __tablename__ = 'workers'
     hostname = Column(String, primary_key=True)
@@ -210,6 +346,8 @@ class Worker(Base, _Exportable):
     last_contact = Column(DateTime(timezone=True), nullable=False)
     processed = Column(Integer, nullable=False)
     errors = Column(Integer, nullable=False)
+    # 同じコードの提出のジャッジ結果を流用した数
+    reused = Column(Integer, server_default='0', nullable=False)
 
 
 def configure(**kwargs: str) -> None:
@@ -220,6 +358,7 @@ def configure(**kwargs: str) -> None:
     engine = engine_from_config(kwargs)
     if drop_all:
         Base.metadata.drop_all(engine)
+    has_standings = engine.has_table(Standing.__tablename__)
     while True:
         try:
             Base.metadata.create_all(engine)
@@ -229,8 +368,148 @@ def configure(**kwargs: str) -> None:
             import time
             import random
             time.sleep(random.uniform(0.05, 0.1))
+    migrate(engine)
     Session.configure(bind=engine)  # type: ignore
     _insert_initial_data()
+    if not has_standings:
+        # 順位表テーブルを新規作成した場合は既存の提出から構築する
+        with transaction() as s:
+            for contest_id, in s.query(Contest.id):
+                update_standings(s, contest_id)
+
+
+def migrate(engine: Any, concurrently: bool = False) -> None:
+    """既存のデータベースを現在のモデル定義に追従させる
+
+    create_allは既存のテーブルを変更しないため、後から追加した
+    列挙値・カラム・インデックスをここで追加する。
+    concurrentlyを指定するとインデックスをCREATE INDEX CONCURRENTLYで
+    作成するので、大きなテーブルでも書き込みを止めずに実行できる。
+    DBに保存していたテストデータはblobストアに移す。
+    """
+    _migrate_test_data(engine)
+    # ALTER TYPE ... ADD VALUEとCREATE INDEX CONCURRENTLYは
+    # トランザクション内で実行できない
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as conn:
+        inspector = inspect(conn)
+        enums = {
+            e['name']: set(e['labels'])
+            for e in inspector.get_enums()}  # type: ignore
+        for table in Base.metadata.sorted_tables:
+            for column in table.columns:
+                labels = enums.get(getattr(column.type, 'name', None))
+                if not isinstance(column.type, Enum) or labels is None:
+                    continue
+                for label in column.type.enums:
+                    if label not in labels:
+                        labels.add(label)
+                        conn.execute("ALTER TYPE {} ADD VALUE IF NOT EXISTS "
+                                     "'{}'".format(column.type.name, label))
+
+        tables = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in tables:
+                # 新しいテーブルはcreate_allで作成する
+                continue
+            existing_columns = {
+                c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    conn.execute('ALTER TABLE {} ADD COLUMN IF NOT EXISTS {}'
+                                 .format(table.name, CreateColumn(column)
+                                         .compile(dialect=conn.dialect)))
+
+            invalid = {name for name, in conn.execute(
+                'SELECT i.relname FROM pg_index x '
+                'JOIN pg_class i ON i.oid = x.indexrelid '
+                'JOIN pg_class t ON t.oid = x.indrelid '
+                'WHERE t.relname = %s AND NOT x.indisvalid', table.name)}
+            with warnings.catch_warnings():
+                # 部分インデックスの条件式はリフレクションできない旨の警告を抑制
+                warnings.simplefilter('ignore', SAWarning)
+                existing = {
+                    i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing and index.name not in invalid:
+                    continue
+                if index.name in invalid:
+                    # 中断したCONCURRENTLYによる作成途中のインデックス
+                    conn.execute('DROP INDEX {}{}'.format(
+                        'CONCURRENTLY ' if concurrently else '', index.name))
+                ddl = str(CreateIndex(index).compile(  # type: ignore
+                    dialect=conn.dialect))
+                if concurrently:
+                    ddl = ddl.replace(
+                        'CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+                try:
+                    conn.execute(ddl)
+                except ProgrammingError:
+                    # 同時起動した別プロセスが作成済み
+                    pass
+
+
+def _migrate_test_data(engine: Any) -> None:
+    """DBに保存していたテストデータ(zstd圧縮)をblobストアに移す
+
+    移行後はDBからテストデータを削除するので、blob_storeが明示的に
+    指定されていない場合(一時ディレクトリ)は移行せずにエラーとする
+    """
+    from zstandard import ZstdDecompressor  # type: ignore
+    from penguin_judge.blob import get_blob_store, is_configured
+
+    def _is_legacy(conn: Any) -> bool:
+        return bool(conn.execute(
+            "SELECT count(*) FROM information_schema.columns "
+            "WHERE table_name = 'tests' AND column_name = 'input'").scalar())
+
+    with engine.connect() as conn:
+        if not _is_legacy(conn):
+            return
+    if not is_configured():
+        raise RuntimeError(
+            'config error: blob_store must be set to migrate test data '
+            'stored in the database')
+    store = get_blob_store()
+    zctx = ZstdDecompressor()
+    with engine.begin() as conn:
+        # 同時起動した別プロセスが移行済みの場合がある
+        conn.execute('LOCK TABLE tests IN ACCESS EXCLUSIVE MODE')
+        if not _is_legacy(conn):
+            return
+        conn.execute('ALTER TABLE tests '
+                     'ADD COLUMN IF NOT EXISTS input_hash BYTEA, '
+                     'ADD COLUMN IF NOT EXISTS output_hash BYTEA, '
+                     'ADD COLUMN input_size INTEGER, '
+                     'ADD COLUMN output_size INTEGER')
+        keys = conn.execute(
+            'SELECT contest_id, problem_id, id FROM tests').fetchall()
+        for key in keys:
+            # 1件ずつ読み込んでメモリ使用量を抑える
+            in_blob, out_blob = conn.execute(
+                'SELECT input, output FROM tests WHERE contest_id = %s '
+                'AND problem_id = %s AND id = %s', *key).first()
+            in_raw = zctx.decompress(in_blob)
+            out_raw = zctx.decompress(out_blob)
+            conn.execute(
+                'UPDATE tests SET input_hash = %s, output_hash = %s, '
+                'input_size = %s, output_size = %s WHERE contest_id = %s '
+                'AND problem_id = %s AND id = %s',
+                store.put(in_raw), store.put(out_raw), len(in_raw),
+                len(out_raw), *key)
+        # 元のデータを削除する前にすべてストアに保存できたことを確認する
+        missing = [bytes(h).hex() for h, in conn.execute(
+            'SELECT input_hash FROM tests UNION SELECT output_hash FROM tests'
+        ) if not store.contains(bytes(h))]
+        if missing:
+            raise RuntimeError(
+                'test data is not found in blob_store: {}'.format(missing))
+        conn.execute('ALTER TABLE tests '
+                     'DROP COLUMN input, DROP COLUMN output, '
+                     'ALTER COLUMN input_hash SET NOT NULL, '
+                     'ALTER COLUMN output_hash SET NOT NULL, '
+                     'ALTER COLUMN input_size SET NOT NULL, '
+                     'ALTER COLUMN output_size SET NOT NULL')
 
 
 def get_db_config() -> Dict[str, str]:
@@ -249,6 +528,263 @@ def transaction() -> Iterator[scoped_session]:
         Session.remove()
 
 
+def update_standings(s: scoped_session, contest_id: str,
+                     problem_id: Optional[str] = None,
+                     user_id: Optional[str] = None) -> None:
+    """順位表のセルを提出から再計算する
+
+    problem_id/user_id を省略した場合はコンテスト(問題)全体を再計算する
+    """
+    contest = s.query(Contest.start_time, Contest.end_time).filter(
+        Contest.id == contest_id).first()
+    if not contest:
+        return
+    table = Standing.__table__
+    conds = [table.c.contest_id == contest_id]
+    filters = [
+        Submission.contest_id == contest_id,
+        Submission.created >= contest.start_time,
+        Submission.created < contest.end_time,
+    ]
+    if problem_id is not None:
+        conds.append(table.c.problem_id == problem_id)
+        filters.append(Submission.problem_id == problem_id)
+    if user_id is not None:
+        conds.append(table.c.user_id == user_id)
+        filters.append(Submission.user_id == user_id)
+
+    # 同じセルを並行して再計算した場合に古い集計結果で上書きしないよう、
+    # セルの行ロックを取得してから提出を集計する
+    # (新規セルは集計結果と必ず異なるpenalties=-1で仮登録する)
+    keys = s.query(Submission.user_id, Submission.problem_id).filter(
+        *filters).distinct().all()
+    if keys:
+        s.execute(pg_insert(table).on_conflict_do_nothing(), [dict(
+            contest_id=contest_id, user_id=uid, problem_id=pid, penalties=-1,
+            first_submitted=contest.start_time) for uid, pid in keys])
+    current = {
+        (uid, pid): (penalties, accepted, first_submitted)
+        for uid, pid, penalties, accepted, first_submitted in s.execute(
+            select([
+                table.c.user_id, table.c.problem_id, table.c.penalties,
+                table.c.accepted, table.c.first_submitted,
+            ]).where(and_(*conds)).with_for_update())}
+
+    cells: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for uid, pid, status, created in s.query(
+            Submission.user_id, Submission.problem_id, Submission.status,
+            Submission.created).filter(*filters).order_by(Submission.created):
+        cell = cells.get((uid, pid))
+        if cell is None:
+            cell = cells[(uid, pid)] = dict(
+                b_user_id=uid, b_problem_id=pid, b_penalties=0,
+                b_accepted=None, b_first_submitted=created)
+        if cell['b_accepted'] is not None:
+            continue
+        if status == JudgeStatus.Accepted:
+            cell['b_accepted'] = created
+        elif status not in (
+                JudgeStatus.CompilationError, JudgeStatus.InternalError):
+            cell['b_penalties'] += 1
+
+    updated = [
+        cell for key, cell in cells.items() if current.get(key) != (
+            cell['b_penalties'], cell['b_accepted'],
+            cell['b_first_submitted'])]
+    if updated:
+        s.execute(table.update().where(and_(
+            table.c.contest_id == contest_id,
+            table.c.user_id == bindparam('b_user_id'),
+            table.c.problem_id == bindparam('b_problem_id'),
+        )).values(
+            penalties=bindparam('b_penalties'),
+            accepted=bindparam('b_accepted'),
+            first_submitted=bindparam('b_first_submitted'),
+        ), updated)
+    removed = [dict(b_user_id=uid, b_problem_id=pid) for uid, pid in current
+               if (uid, pid) not in cells]
+    if removed:
+        s.execute(table.delete().where(and_(
+            table.c.contest_id == contest_id,
+            table.c.user_id == bindparam('b_user_id'),
+            table.c.problem_id == bindparam('b_problem_id'),
+        )), removed)
+    if updated or removed:
+        _bump_standings_version(s, contest_id)
+
+
+_STANDINGS_VERSION_UPDATES = 'standings_version_updates'
+# StandingsVersionで全コンテストを表すcontest_id
+ALL_CONTESTS = ''
+
+
+def _bump_standings_version(s: Any, contest_id: str) -> None:
+    s.info.setdefault(_STANDINGS_VERSION_UPDATES, set()).add(contest_id)
+
+
+@event.listens_for(Session, 'before_commit')
+def _update_standings_versions(s: Any) -> None:
+    # 順位表の変更と同じトランザクションで加算し、変更がコミットされた場合は
+    # 必ずETagが変わるようにする。同じコンテストへのコミットはバージョンの
+    # 行ロックで直列化されるため、ロックを保持する時間が短くなるよう
+    # コミットの直前に加算する
+    if s.transaction.nested:
+        return
+    # コミット時のflushで呼び出される update_standings の分も含めて加算する
+    s.flush()
+    contest_ids = s.info.pop(_STANDINGS_VERSION_UPDATES, None)
+    if not contest_ids:
+        return
+    versions = StandingsVersion.__table__
+    # デッドロックしないようコンテストIDの順にロックする
+    for contest_id in sorted(contest_ids):
+        s.execute(pg_insert(versions).values(
+            contest_id=contest_id, version=1
+        ).on_conflict_do_update(
+            index_elements=[versions.c.contest_id],
+            set_=dict(version=versions.c.version + 1)))
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_standings_versions(s: Any, tx: Any) -> None:
+    if tx.parent is None:
+        s.info.pop(_STANDINGS_VERSION_UPDATES, None)
+
+
+def summarize_judge_results(
+        results: Iterable[Tuple[JudgeStatus, Optional[datetime.timedelta],
+                                Optional[int]]]
+) -> Tuple[JudgeStatus, Optional[datetime.timedelta], Optional[int]]:
+    """テストケース毎の(status, time, memory)から提出のstatus/max_time/
+    max_memoryを求める
+
+    ジャッジが完了していないテストはInternalErrorとして扱い、
+    fail_fastで省略したテスト(Skipped)は無視する
+    """
+    statuses: Set[JudgeStatus] = set()
+    max_time: Optional[datetime.timedelta] = None
+    max_memory: Optional[int] = None
+    for status, time, memory in results:
+        if status in (JudgeStatus.Waiting, JudgeStatus.Running):
+            status = JudgeStatus.InternalError
+        if status != JudgeStatus.Skipped:
+            statuses.add(status)
+        if time is not None and (max_time is None or max_time < time):
+            max_time = time
+        if memory is not None and (max_memory is None or max_memory < memory):
+            max_memory = memory
+    if len(statuses) == 1:
+        return statuses.pop(), max_time, max_memory
+    for x in (JudgeStatus.InternalError, JudgeStatus.RuntimeError,
+              JudgeStatus.WrongAnswer, JudgeStatus.MemoryLimitExceeded,
+              JudgeStatus.TimeLimitExceeded,
+              JudgeStatus.OutputLimitExceeded):
+        if x in statuses:
+            return x, max_time, max_memory
+    return JudgeStatus.InternalError, max_time, max_memory
+
+
+def get_standings_version(s: scoped_session, contest_id: str) -> int:
+    """コンテストの順位表のバージョン
+
+    コンテストの更新回数と全コンテスト共通の更新回数の和を返す
+    """
+    return s.query(func.sum(StandingsVersion.version)).filter(
+        StandingsVersion.contest_id.in_([contest_id, ALL_CONTESTS])
+    ).scalar() or 0
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_standings_on_flush(s: Any, _: Any) -> None:
+    # ORM経由の提出の追加/ステータス変更とコンテスト期間の変更を
+    # 順位表に反映する。クエリによる一括更新の場合は呼び出し側で
+    # update_standings を呼び出すこと
+    contests: Set[str] = set()
+    cells: Set[Tuple[str, str, str]] = set()
+    for obj in s.dirty:
+        if isinstance(obj, Contest) and (
+                inspect(obj).attrs.start_time.history.has_changes() or
+                inspect(obj).attrs.end_time.history.has_changes()):
+            contests.add(obj.id)
+    for obj in list(s.new) + list(s.dirty):
+        if isinstance(obj, Submission) and (
+                obj in s.new or
+                inspect(obj).attrs.status.history.has_changes()):
+            cells.add((obj.contest_id, obj.problem_id, obj.user_id))
+    for contest_id in contests:
+        update_standings(s, contest_id)
+    for contest_id, problem_id, user_id in cells:
+        if contest_id not in contests:
+            update_standings(s, contest_id, problem_id, user_id)
+
+    # 提出していないユーザも順位表に載るので、ユーザの追加/削除と
+    # 管理者(順位表に載らない)の変更は全コンテストの順位表を更新したものとする
+    for obj in list(s.new) + list(s.deleted) + list(s.dirty):
+        if isinstance(obj, User) and (
+                obj not in s.dirty or
+                inspect(obj).attrs.admin.history.has_changes()):
+            _bump_standings_version(s, ALL_CONTESTS)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _update_standings_on_bulk_user_change(update_context: Any) -> None:
+    # クエリによる一括更新/削除は変更内容を特定できないので常に更新する
+    if update_context.mapper.class_ is User:
+        _bump_standings_version(update_context.session, ALL_CONTESTS)
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def _update_standings_on_bulk_delete(delete_context: Any) -> None:
+    # 削除条件でコンテストが指定されていればそのコンテストのみ、
+    # 指定されていなければ順位表のセルが存在するコンテストを再計算する
+    if delete_context.mapper.class_ is not Submission:
+        return
+    s = delete_context.session
+    contest_ids = _criteria_values(
+        delete_context.query.whereclause, Submission.__table__.c.contest_id)
+    if contest_ids is None:
+        contest_ids = [
+            contest_id for contest_id, in
+            s.query(Standing.contest_id).distinct()]
+    for contest_id in contest_ids:
+        update_standings(s, contest_id)
+
+
+def _criteria_values(
+        criteria: Any, column: Column) -> Optional[List[Any]]:
+    """AND条件中の column == 値 / column IN (値...) から値を取り出す
+
+    条件から値を特定できない場合はNoneを返す
+    """
+    if criteria is None:
+        return None
+    if isinstance(criteria, BooleanClauseList) and \
+            criteria.operator is operator.and_:
+        conjuncts = list(criteria.clauses)
+    else:
+        conjuncts = [criteria]
+    c: Any
+    for c in conjuncts:
+        if not (isinstance(c, BinaryExpression) and
+                column.shares_lineage(c.left)):
+            continue
+        if c.operator is operator.eq and isinstance(c.right, BindParameter):
+            return [c.right.effective_value]
+        if c.operator is operators.in_op:
+            right: Any = c.right
+            if getattr(right, 'expanding', False):
+                return list(right.effective_value)
+            while isinstance(right, Grouping):
+                right = right.element
+            if not isinstance(right, ClauseList):
+                continue
+            values: List[Any] = list(right.clauses)
+            if all(isinstance(v, BindParameter) for v in values):
+                return [v.effective_value for v in values]
+    return None
+
+
 def _insert_initial_data() -> None:
     from secrets import token_bytes
     from penguin_judge.api import _kdf
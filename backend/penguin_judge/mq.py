@@ -1,9 +1,29 @@
-from typing import Optional
+import os
+import threading
+import time
+from typing import Iterable, List, Optional, Set
 
+import pika  # type: ignore
 from pika import URLParameters  # type: ignore
+from pika.adapters.blocking_connection import BlockingChannel  # type: ignore
+from pika.exceptions import AMQPError  # type: ignore
 
 _mq_url: Optional[str] = None
 
+# ジャッジキューの一覧(優先度の高い順)
+# live: コンテスト参加者からの提出, rejudge: リジャッジ等のバックグラウンド処理
+JUDGE_QUEUES = (
+    ('live', 'judge_queue'),
+    ('rejudge', 'rejudge_queue'),
+)
+LIVE_QUEUE = JUDGE_QUEUES[0][1]
+REJUDGE_QUEUE = JUDGE_QUEUES[1][1]
+# 1回のコミットでまとめて送信するメッセージ数の上限
+PUBLISH_BATCH_SIZE = 1000
+# アイドル中の接続でハートビートを処理する間隔[秒]
+# (ブローカーのheartbeat(デフォルト60秒)の半分より短くすること)
+KEEPALIVE_INTERVAL = 10
+
 
 def configure(**kwargs: str) -> None:
     global _mq_url
@@ -12,3 +32,130 @@ def configure(**kwargs: str) -> None:
 
 def get_mq_conn_params() -> URLParameters:
     return URLParameters(_mq_url)
+
+
+class _Publisher(object):
+    """プロセス内で接続とチャネルを使い回すパブリッシャ
+
+    接続はfork後のプロセス毎に作成し、切断されていた場合は再接続する。
+    チャネルはトランザクションモードで利用し、publishに渡したメッセージを
+    PUBLISH_BATCH_SIZE件毎にまとめてコミットする。そのため publishが
+    正常に返ったメッセージはブローカーに受理されている。
+    BlockingConnectionはAPIを呼び出している間しかハートビートを処理しない
+    ため、アイドル中の接続がブローカーに切断されないように
+    バックグラウンドのスレッドから定期的に受信したフレームを処理する。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._conn: Optional[pika.BlockingConnection] = None
+        self._ch: Optional[BlockingChannel] = None
+        self._declared: Set[str] = set()
+        self._keepalive_pid: Optional[int] = None
+
+    def publish(self, queue: str, bodies: Iterable[bytes]) -> None:
+        messages = list(bodies)
+        committed = 0
+        with self._lock:
+            for retry in (True, False):
+                try:
+                    ch = self._channel()
+                    self._declare(ch, queue)
+                    while committed < len(messages):
+                        batch = messages[
+                            committed:committed + PUBLISH_BATCH_SIZE]
+                        for body in batch:
+                            ch.basic_publish(
+                                exchange='', routing_key=queue, body=body)
+                        ch.tx_commit()
+                        committed += len(batch)
+                    return
+                except AMQPError:
+                    # コミットしていないメッセージは破棄されるので
+                    # 再接続後にコミット済みの続きから送り直す
+                    self._close()
+                    if not retry:
+                        raise
+
+    def get_message_counts(self, queues: Iterable[str]) -> List[int]:
+        with self._lock:
+            for retry in (True, False):
+                try:
+                    ch = self._channel()
+                    return [
+                        ch.queue_declare(queue=q).method.message_count
+                        for q in queues]
+                except AMQPError:
+                    self._close()
+                    if not retry:
+                        raise
+        raise AssertionError  # pragma: no cover
+
+    def process_data_events(self) -> None:
+        """受信済みのフレームを処理し、ハートビートに応答する"""
+        with self._lock:
+            if self._conn is None or self._pid != os.getpid():
+                return
+            try:
+                self._conn.process_data_events(0)
+            except AMQPError:
+                self._close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def _channel(self) -> BlockingChannel:
+        if self._pid != os.getpid():
+            # fork前の接続は親プロセスのものなので破棄する
+            self._conn, self._ch = None, None
+            self._declared.clear()
+        if self._conn and self._conn.is_open and self._ch and self._ch.is_open:
+            return self._ch
+        self._close()
+        self._conn = pika.BlockingConnection(get_mq_conn_params())
+        self._ch = self._conn.channel()
+        self._ch.tx_select()
+        self._pid = os.getpid()
+        self._start_keepalive()
+        return self._ch
+
+    def _start_keepalive(self) -> None:
+        # スレッドはforkで引き継がれないのでプロセス毎に起動する
+        if self._keepalive_pid == os.getpid():
+            return
+        self._keepalive_pid = os.getpid()
+        threading.Thread(
+            target=self._keepalive, name='mq-keepalive', daemon=True).start()
+
+    def _keepalive(self) -> None:
+        while True:
+            time.sleep(KEEPALIVE_INTERVAL)
+            self.process_data_events()
+
+    def _declare(self, ch: BlockingChannel, queue: str) -> None:
+        if queue not in self._declared:
+            ch.queue_declare(queue=queue)
+            self._declared.add(queue)
+
+    def _close(self) -> None:
+        conn, self._conn, self._ch = self._conn, None, None
+        self._declared.clear()
+        if conn is None or self._pid != os.getpid():
+            return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+_publisher = _Publisher()
+
+
+def publish(queue: str, bodies: Iterable[bytes]) -> None:
+    _publisher.publish(queue, bodies)
+
+
+def get_message_counts(queues: Iterable[str]) -> List[int]:
+    return _publisher.get_message_counts(queues)
@@ -1,27 +1,71 @@
-from base64 import b64encode
+from base64 import b64encode, urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
 import datetime
 from enum import Enum
-from typing import Any, Union
+import threading
+import time
+import zlib
+from typing import (
+    Any, Callable, Dict, Generic, List, Optional, Sequence, Tuple, TypeVar,
+    Union)
 import json
 
+from sqlalchemy import (
+    and_, or_, tuple_, DateTime, Enum as EnumType, Integer, Interval, String)
+from zstandard import ZstdCompressor  # type: ignore
 
-class _JsonEncoder(json.JSONEncoder):
-    def default(self, o: Any) -> Union[str, float]:
-        if isinstance(o, datetime.datetime):
-            return o.astimezone(tz=datetime.timezone.utc).isoformat()
-        if isinstance(o, datetime.timedelta):
-            return o.total_seconds()
-        if isinstance(o, bytes):
-            return b64encode(o).decode('ascii')
-        if isinstance(o, Enum):
-            return o.name
-        return super().default(o)
+K = TypeVar('K')
+V = TypeVar('V')
+
+
+def _encode_datetime(o: datetime.datetime) -> str:
+    return o.astimezone(tz=datetime.timezone.utc).isoformat()
+
+
+def _encode_timedelta(o: datetime.timedelta) -> float:
+    return o.total_seconds()
+
+
+def _encode_bytes(o: bytes) -> str:
+    return b64encode(o).decode('ascii')
+
+
+def _encode_enum(o: Enum) -> str:
+    return o.name
+
+
+# 型毎の変換関数。サブクラスはisinstanceで判定した結果を追加していく
+_Encoder = Callable[[Any], Union[str, float]]
+_base_encoders: List[Tuple[type, _Encoder]] = [
+    (datetime.datetime, _encode_datetime),
+    (datetime.timedelta, _encode_timedelta),
+    (bytes, _encode_bytes),
+    (Enum, _encode_enum),
+]
+_encoders: Dict[type, _Encoder] = dict(_base_encoders[:3])
+
+
+def _json_default(o: Any) -> Union[str, float]:
+    encoder = _encoders.get(type(o))
+    if encoder is None:
+        for t, f in _base_encoders:
+            if isinstance(o, t):
+                encoder = _encoders[type(o)] = f
+                break
+        else:
+            raise TypeError('Object of type {} is not JSON serializable'
+                            .format(type(o).__name__))
+    return encoder(o)
+
+
+# エンコーダはスレッドセーフなので呼び出し毎に作らずに使い回す
+_json_encoder = json.JSONEncoder(separators=(',', ':'), default=_json_default)
 
 
 def json_dumps(o: Union[dict, list]) -> str:
     if isinstance(o, dict):
         o = {k: v for k, v in o.items() if not k.startswith('_')}
-    return json.dumps(o, cls=_JsonEncoder, separators=(',', ':'))
+    return _json_encoder.encode(o)
 
 
 def pagination_header(count: int, page: int, per_page: int) -> dict:
@@ -31,3 +75,215 @@ def pagination_header(count: int, page: int, per_page: int) -> dict:
         'X-Total': count,
         'X-Total-Pages': (count + (per_page - 1)) // per_page,
     }
+
+
+def encode_cursor(row: Any, keys: Sequence[Tuple[Any, bool]]) -> str:
+    """行のソートキーの値を不透明なカーソル文字列にする
+
+    keysは(カラム, 降順か)のリストで、最後のキーで行が一意に定まること
+    """
+    values = json_dumps([getattr(row, col.key) for col, _ in keys])
+    return urlsafe_b64encode(values.encode('utf8')).decode('ascii').rstrip(
+        '=')
+
+
+def decode_cursor(cursor: str, keys: Sequence[Tuple[Any, bool]]) -> List[Any]:
+    """encode_cursorで作成したカーソルを復元する
+
+    不正なカーソルの場合はValueErrorを送出する
+    """
+    try:
+        values = json.loads(urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError('invalid cursor')
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise ValueError('invalid cursor')
+    return [_decode_cursor_value(col, v) for (col, _), v in zip(keys, values)]
+
+
+def _decode_cursor_value(col: Any, v: Any) -> Any:
+    # カーソルは利用者が書き換えられるので、カラムの型と一致しない値は
+    # DBに渡さずValueErrorにする
+    if v is None:
+        if not _nullable(col):
+            raise ValueError('invalid cursor')
+        return None
+    t = col.type
+    if isinstance(t, DateTime) and isinstance(v, str):
+        return datetime.datetime.fromisoformat(v)
+    if isinstance(t, Interval) and isinstance(v, (int, float)) and \
+            not isinstance(v, bool):
+        try:
+            return datetime.timedelta(seconds=v)
+        except OverflowError:
+            raise ValueError('invalid cursor')
+    if isinstance(t, Integer) and isinstance(v, int) and \
+            not isinstance(v, bool):
+        return v
+    if isinstance(t, EnumType):
+        if v not in t.enums:
+            raise ValueError('invalid cursor')
+        return v
+    if isinstance(t, String) and isinstance(v, str) and '\0' not in v:
+        return v
+    raise ValueError('invalid cursor')
+
+
+def _nullable(col: Any) -> bool:
+    return getattr(getattr(col, 'expression', col), 'nullable', True)
+
+
+def keyset_filter(keys: Sequence[Tuple[Any, bool]],
+                  values: Sequence[Any]) -> Any:
+    """ソート順でカーソルの行より後にある行を選択する条件式を作る
+
+    PostgreSQLの既定の並び順(NULLは昇順では最後、降順では最初)を前提とする
+    """
+    if (len({desc for _, desc in keys}) == 1 and None not in values and
+            not any(_nullable(col) for col, _ in keys)):
+        # 行値比較はインデックスの範囲検索になる
+        lhs, rhs = tuple_(*[col for col, _ in keys]), tuple_(*values)
+        return lhs < rhs if keys[0][1] else lhs > rhs
+
+    def _after(col: Any, desc: bool, v: Any) -> Any:
+        if v is None:
+            return col.isnot(None) if desc else None
+        if desc:
+            return col < v
+        return or_(col > v, col.is_(None)) if _nullable(col) else col > v
+
+    def _equal(col: Any, v: Any) -> Any:
+        return col.is_(None) if v is None else col == v
+
+    clauses = []
+    for i, ((col, desc), v) in enumerate(zip(keys, values)):
+        after = _after(col, desc, v)
+        if after is not None:
+            clauses.append(and_(*[
+                _equal(c, x) for (c, _), x in zip(keys[:i], values[:i])],
+                after))
+    return or_(*clauses)
+
+
+# サーバ側で優先するContent-Encodingの順序
+COMPRESS_ENCODINGS = ('zstd', 'gzip')
+_compressors = threading.local()
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Content-Encoding(zstd/gzip)に従って圧縮する
+
+    zstdの圧縮コンテキストはスレッド毎に作成して使い回す
+    """
+    if encoding == 'zstd':
+        cctx = getattr(_compressors, 'zstd', None)
+        if cctx is None:
+            cctx = _compressors.zstd = ZstdCompressor(level=3)
+        return cctx.compress(data)  # type: ignore
+    if encoding == 'gzip':
+        c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
+    raise ValueError(encoding)
+
+
+class CompressibleBody(object):
+    """レスポンス本文と、その圧縮結果をエンコーディング毎に保持する
+
+    キャッシュに格納しておくことで、同じ本文を繰り返し返す場合の圧縮を
+    エンコーディング毎に1回で済ませる
+    """
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self._compressed: Dict[str, bytes] = {}
+
+    def get(self, encoding: Optional[str]) -> bytes:
+        if encoding is None:
+            return self.data
+        ret = self._compressed.get(encoding)
+        if ret is None:
+            ret = self._compressed[encoding] = compress(self.data, encoding)
+        return ret
+
+
+class VersionedCache(Generic[K, V]):
+    """キー毎に最新バージョンの値を1つだけ保持するキャッシュ
+
+    同じキーに対する同時のキャッシュミスは1回の計算にまとめる
+    """
+
+    def __init__(self) -> None:
+        self._entries: Dict[K, Tuple[Any, V]] = {}
+        self._locks: Dict[K, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key: K, version: Any, compute: Callable[[], V]) -> V:
+        entry = self._entries.get(key)
+        if entry and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # ロック待ちの間に他のスレッドが計算済みであればそれを返す
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            value = compute()
+            self._entries[key] = (version, value)
+            return value
+
+
+class TTLCache(Generic[K, V]):
+    """有効期限付きのLRUキャッシュ
+
+    エントリ数が max_size を超えた場合は最も長く参照されていないものを削除する
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._entries: 'OrderedDict[K, Tuple[float, V]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: K, value: V, ttl: float) -> None:
+        if self._max_size <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: K) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def remove_if(self, predicate: Callable[[V], bool]) -> None:
+        with self._lock:
+            for key in [k for k, (_, v) in self._entries.items()
+                        if predicate(v)]:
+                del self._entries[key]
@@ -0,0 +1,325 @@
+"""schema.yamlから事前に構築したリクエスト検証器
+
+openapi_coreのRequestValidatorはリクエスト毎にオペレーションの探索や
+スキーマ検証器の構築を行うため、軽いAPIではCPU時間の多くを占める。
+CompiledRequestValidatorは起動時にオペレーション毎のパラメータ/ボディの
+検証・変換処理を構築しておき、正しいリクエストのみを高速に処理する。
+
+検証に失敗したリクエストや、対応していないスキーマを持つオペレーションでは
+Noneを返すので、呼び出し元はRequestValidatorで検証し直すこと
+(エラー時の挙動をRequestValidatorと一致させるため)。
+"""
+import json
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask import Request
+from openapi_core.extensions.models.models import Model  # type: ignore
+
+_METHODS = ('get', 'put', 'post', 'delete', 'options', 'head', 'patch')
+# http://flask.pocoo.org/docs/1.0/quickstart/#variable-rules
+_PATH_PARAMETER_PATTERN = re.compile(
+    r'<(?:(?:string|int|float|path|uuid):)?(\w+)>')
+_INTEGER_PATTERN = re.compile(r'[0-9]+\Z')
+_ANNOTATIONS = ('description', 'title', 'example')
+
+
+class Unsupported(Exception):
+    """事前構築に対応していないスキーマ"""
+
+
+class _Fallback(Exception):
+    """高速パスでは受理できないリクエスト"""
+
+
+class RequestParameters(object):
+    def __init__(self) -> None:
+        self.path: Dict[str, Any] = {}
+        self.query: Dict[str, Any] = {}
+        self.header: Dict[str, Any] = {}
+        self.cookie: Dict[str, Any] = {}
+
+    def __getitem__(self, location: str) -> Dict[str, Any]:
+        return getattr(self, location)  # type: ignore
+
+
+class _Schema(object):
+    """スカラー値(string/integer/boolean)のスキーマ"""
+
+    def __init__(self, schema: Dict[str, Any]) -> None:
+        supported = {
+            'type', 'pattern', 'minLength', 'minimum', 'maximum', 'enum',
+            'default', 'nullable', *_ANNOTATIONS}
+        if set(schema.keys()) - supported:
+            raise Unsupported(schema)
+        self.type = schema.get('type')
+        if self.type not in ('string', 'integer', 'boolean'):
+            raise Unsupported(schema)
+        self.nullable = schema.get('nullable', False)
+        self.default = schema.get('default')
+        pattern = schema.get('pattern')
+        self._pattern = re.compile(pattern) if pattern else None
+        self._min_length = schema.get('minLength')
+        self._minimum = schema.get('minimum')
+        self._maximum = schema.get('maximum')
+        self._enum = schema.get('enum')
+
+    def from_str(self, value: str) -> Any:
+        """パラメータの文字列表現を変換して検証する"""
+        if self.type == 'integer':
+            if not _INTEGER_PATTERN.match(value):
+                raise _Fallback
+            return self.check(int(value))
+        if self.type == 'string':
+            return self.check(value)
+        raise _Fallback
+
+    def check(self, value: Any) -> Any:
+        if value is None:
+            if not self.nullable:
+                raise _Fallback
+            return None
+        if self.type == 'string':
+            if not isinstance(value, str):
+                raise _Fallback
+            if self._pattern and not self._pattern.search(value):
+                raise _Fallback
+            if self._min_length is not None and len(value) < self._min_length:
+                raise _Fallback
+        elif self.type == 'integer':
+            if not isinstance(value, int) or isinstance(value, bool):
+                raise _Fallback
+            if self._minimum is not None and value < self._minimum:
+                raise _Fallback
+            if self._maximum is not None and value > self._maximum:
+                raise _Fallback
+        elif not isinstance(value, bool):
+            raise _Fallback
+        if self._enum is not None and value not in self._enum:
+            raise _Fallback
+        return value
+
+
+class _Property(object):
+    def __init__(self, name: str, schema: Optional[_Schema]) -> None:
+        # schemaがNoneのプロパティ(日時や配列等)は値があれば高速パスを諦める
+        self.name = name
+        self.schema = schema
+        self.default = schema.default if schema else None
+
+
+class CompiledRequestValidator(object):
+    def __init__(self, spec: Dict[str, Any]) -> None:
+        self._spec = spec
+        self._rules: Dict[str, str] = {}
+        self._operations: Dict[
+            Tuple[str, str],
+            Callable[[Request], Tuple[RequestParameters, Any]]] = {}
+        for path, path_item in spec.get('paths', {}).items():
+            for method, operation in path_item.items():
+                if method not in _METHODS:
+                    continue
+                try:
+                    self._operations[(path, method)] = self._compile(
+                        path_item, operation)
+                except Unsupported:
+                    pass
+
+    def validate(self, request: Request
+                 ) -> Optional[Tuple[RequestParameters, Any]]:
+        """リクエストを検証してパラメータとボディを返す
+
+        高速パスで受理できない場合はNoneを返す
+        """
+        if request.url_rule is None:
+            return None
+        rule = request.url_rule.rule
+        path = self._rules.get(rule)
+        if path is None:
+            path = self._rules[rule] = _PATH_PARAMETER_PATTERN.sub(
+                r'{\1}', rule)
+        operation = self._operations.get((path, request.method.lower()))
+        if operation is None:
+            return None
+        try:
+            return operation(request)
+        except _Fallback:
+            return None
+
+    def _resolve(self, o: Dict[str, Any]) -> Dict[str, Any]:
+        while '$ref' in o:
+            ref = o['$ref']
+            if not ref.startswith('#/'):
+                raise Unsupported(ref)
+            o = self._spec
+            for key in ref[2:].split('/'):
+                o = o[key]
+        return o
+
+    def _compile(self, path_item: Dict[str, Any], operation: Dict[str, Any]
+                 ) -> Callable[[Request], Tuple[RequestParameters, Any]]:
+        # オペレーションのパラメータがパスのパラメータより優先される
+        params: Dict[Tuple[str, str], Callable[..., None]] = {}
+        for p in (operation.get('parameters', []) +
+                  path_item.get('parameters', [])):
+            p = self._resolve(p)
+            key = (p['name'], p['in'])
+            if key not in params:
+                params[key] = self._compile_parameter(p)
+        security = self._compile_security(
+            operation.get('security', self._spec.get('security')))
+        body = self._compile_body(operation.get('requestBody'))
+        param_funcs = list(params.values())
+
+        def _validate(request: Request) -> Tuple[RequestParameters, Any]:
+            if security and not security(request):
+                raise _Fallback
+            parameters = RequestParameters()
+            for f in param_funcs:
+                f(request, parameters)
+            return parameters, (body(request) if body else None)
+        return _validate
+
+    def _compile_parameter(self, param: Dict[str, Any]
+                           ) -> Callable[[Request, RequestParameters], None]:
+        name, location = param['name'], param['in']
+        required = param.get('required', False)
+        if location not in ('path', 'query') or param.get('allowEmptyValue'):
+            raise Unsupported(param)
+        schema = self._resolve(param.get('schema', {}))
+        is_array = schema.get('type') == 'array'
+        if is_array:
+            if location != 'query' or param.get('style', 'form') != 'form':
+                raise Unsupported(param)
+            explode = param.get('explode', True)
+            if set(schema.keys()) - {'type', 'items', *_ANNOTATIONS}:
+                raise Unsupported(param)
+            item = _Schema(self._resolve(schema['items']))
+        else:
+            item = _Schema(schema)
+
+        def _raw_values(request: Request) -> Optional[List[str]]:
+            # 指定されていない場合はNoneを返す
+            if location == 'path':
+                raw = (request.view_args or {}).get(name)
+                if raw is None:
+                    return None
+                if not isinstance(raw, str):
+                    raise _Fallback
+                return [raw]
+            if name not in request.args:
+                return None
+            return request.args.getlist(name)
+
+        def _parse(request: Request, parameters: RequestParameters) -> None:
+            raws = _raw_values(request)
+            if raws is None:
+                if required or (is_array and item.default is not None):
+                    raise _Fallback
+                if item.default is not None:
+                    parameters[location][name] = item.check(item.default)
+                return
+            if not raws or '' in raws:
+                raise _Fallback
+            if is_array:
+                if not explode:
+                    if len(raws) != 1:
+                        raise _Fallback
+                    raws = raws[0].split(',')
+                parameters[location][name] = [item.from_str(x) for x in raws]
+            else:
+                if len(raws) != 1:
+                    raise _Fallback
+                parameters[location][name] = item.from_str(raws[0])
+        return _parse
+
+    def _compile_security(self, requirements: Optional[List[Dict[str, Any]]]
+                          ) -> Optional[Callable[[Request], bool]]:
+        if not requirements or any(not r for r in requirements):
+            return None
+        schemes = self._spec['components']['securitySchemes']
+        checks = []
+        for requirement in requirements:
+            checks.append([
+                self._compile_security_scheme(schemes[name])
+                for name in requirement])
+
+        def _check(request: Request) -> bool:
+            return any(all(f(request) for f in fs) for fs in checks)
+        return _check
+
+    def _compile_security_scheme(self, scheme: Dict[str, Any]
+                                 ) -> Callable[[Request], bool]:
+        if scheme['type'] == 'http' and scheme['scheme'] == 'bearer':
+            def _bearer(request: Request) -> bool:
+                items = request.headers.get('Authorization', '').split(
+                    ' ', maxsplit=1)
+                return len(items) == 2 and items[0].lower() == 'bearer'
+            return _bearer
+        if scheme['type'] == 'apiKey' and scheme['in'] == 'header':
+            return lambda request: scheme['name'] in request.headers
+        if scheme['type'] == 'apiKey' and scheme['in'] == 'cookie':
+            return lambda request: scheme['name'] in request.cookies
+        raise Unsupported(scheme)
+
+    def _compile_body(self, request_body: Optional[Dict[str, Any]]
+                      ) -> Optional[Callable[[Request], Any]]:
+        if request_body is None:
+            return None
+        request_body = self._resolve(request_body)
+        content = request_body.get('content', {})
+        if list(content.keys()) != ['application/json']:
+            raise Unsupported(request_body)
+        props, required = self._collect_properties(
+            self._resolve(content['application/json']['schema']))
+
+        def _parse(request: Request) -> Any:
+            if request.mimetype != 'application/json' or not request.data:
+                raise _Fallback
+            try:
+                value = json.loads(request.data)
+            except ValueError:
+                raise _Fallback
+            if not isinstance(value, dict):
+                raise _Fallback
+            properties = {}
+            for prop in props:
+                if prop.name not in value:
+                    if prop.name in required:
+                        raise _Fallback
+                    if prop.default is None:
+                        continue
+                    v = prop.default
+                elif prop.schema is None:
+                    raise _Fallback
+                else:
+                    v = value[prop.name]
+                properties[prop.name] = prop.schema.check(v)  # type: ignore
+            return Model(properties)
+        return _parse
+
+    def _collect_properties(self, schema: Dict[str, Any]
+                            ) -> Tuple[List[_Property], set]:
+        """オブジェクトのスキーマ(allOfを含む)のプロパティを集める"""
+        if set(schema.keys()) - {
+                'type', 'properties', 'required', 'allOf', *_ANNOTATIONS}:
+            raise Unsupported(schema)
+        if schema.get('type', 'object') != 'object':
+            raise Unsupported(schema)
+        props: Dict[str, _Property] = {}
+        required = set(schema.get('required', []))
+        for sub in schema.get('allOf', []):
+            sub_props, sub_required = self._collect_properties(
+                self._resolve(sub))
+            props.update({p.name: p for p in sub_props})
+            required |= sub_required
+        for name, prop_schema in schema.get('properties', {}).items():
+            prop_schema = self._resolve(prop_schema)
+            try:
+                props[name] = _Property(name, _Schema(prop_schema))
+            except Unsupported:
+                # 省略時に既定値を補完するプロパティは変換結果を再現できない
+                if prop_schema.get('default') is not None:
+                    raise
+                props[name] = _Property(name, None)
+        return list(props.values()), required
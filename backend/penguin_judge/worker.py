@@ -1,9 +1,12 @@
 import asyncio
 from concurrent.futures import ProcessPoolExecutor, Future
 from datetime import timedelta
+import heapq
+from itertools import count
 import multiprocessing as mp
 from functools import partial
-from typing import Any, Optional
+from typing import (
+    Any, Callable, Dict, List, Mapping, Optional, Tuple, Union)
 import pickle
 from random import shuffle, uniform
 from socket import gethostname
@@ -14,45 +17,85 @@ import pika  # type: ignore
 from pika.channel import Channel  # type: ignore
 from pika.exceptions import AMQPError  # type: ignore
 from pika.adapters.asyncio_connection import AsyncioConnection  # type: ignore
-from sqlalchemy import func
+from sqlalchemy import and_, func, literal, select
 
+from penguin_judge.events import notify_submission
 from penguin_judge.models import (
-    Environment, Problem, Submission, JudgeStatus, JudgeResult, TestCase,
-    Worker as WorkerTable, transaction)
-from penguin_judge.mq import get_mq_conn_params
+    Contest, Environment, Problem, Submission, JudgeStatus, JudgeResult,
+    TestCase, Worker as WorkerTable, scoped_session, transaction)
+from penguin_judge.mq import get_mq_conn_params, JUDGE_QUEUES
 from penguin_judge.judge import JudgeTask, JudgeTestInfo
-from penguin_judge.judge.docker import DockerJudgeDriver
-from penguin_judge.judge.main import run
+from penguin_judge.judge.cache import configure as configure_cache
+from penguin_judge.judge.docker import (
+    DockerJudgeDriver, AsyncDockerJudgeDriver, DockerContainerPool)
+from penguin_judge.judge.main import (
+    run, run_async, configure as configure_judge)
 
 LOGGER = getLogger(__name__)
+TFuture = Union[Future, 'asyncio.Future[JudgeStatus]']
 
 
 class Worker(object):
-    def __init__(self, db_config: dict, max_processes: int) -> None:
+    def __init__(self, config: Mapping[str, str], max_processes: int) -> None:
         self._max_processes = max_processes
-        self._executor = ProcessPoolExecutor(
-            max_workers=max_processes,
-            mp_context=mp.get_context('spawn'),
-            initializer=partial(_initializer, db_config))
-        self._queue_name = 'judge_queue'
+        cpu_budget = int(config.get('cpu_budget', 0))
+        if cpu_budget <= 0:
+            cpu_budget = len(os.sched_getaffinity(0))
+        # async_judgeが有効な場合は子プロセスを使わずに
+        # イベントループ上でジャッジする。
+        # 同時ジャッジ数はプロセス数ではなくCPU予算(async_concurrency)で制限する
+        self._executor: Optional[ProcessPoolExecutor] = None
+        if config.get('async_judge', '').lower() in (
+                'true', '1', 'yes', 'on'):
+            configure_judge(**config)
+            self._concurrency = max(1, int(config.get(
+                'async_concurrency', cpu_budget)))
+        else:
+            self._executor = ProcessPoolExecutor(
+                max_workers=max_processes,
+                mp_context=mp.get_context('spawn'),
+                initializer=partial(_initializer, dict(config)))
+            self._concurrency = max_processes
+        # 1タスクあたりのテスト並列数はワーカーのCPU予算を
+        # 同時ジャッジ数で等分した数を上限とする
+        self._test_parallelism = max(1, min(
+            int(config.get('test_parallelism', 1)),
+            cpu_budget // self._concurrency))
+        self._pool = DockerContainerPool(
+            int(config.get('container_pool_size', 1)),
+            _parse_image_sizes(config.get('container_pool_image_sizes', '')))
+        # 優先度の低いキューの同時処理数はprefetchで制限する
+        self._prefetch_counts = {
+            'live': self._concurrency,
+            'rejudge': int(config.get(
+                'rejudge_prefetch', max(1, self._concurrency // 2))),
+        }
+        self._pending: List[Tuple[
+            int, int, JudgeTask, Callable[[Optional[TFuture]], None]]] = []
+        self._pending_seq = count()
+        self._running = 0
         self._conn: AsyncioConnection = None
         self._ch: Channel = None
         self._hostname: Optional[str] = None
         self._pid = os.getpid()
         self._task_processed, self._task_errors = 0, 0
+        self._task_reused = 0
         self._maint_interval = timedelta(seconds=60)
 
     def __enter__(self) -> 'Worker':
         return self
 
     def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
-        self._executor.shutdown(wait=False)
+        if self._executor:
+            self._executor.shutdown(wait=False)
+        self._pool.close()
         if self._ch:
             self._ch.close()
         if self._conn:
             self._conn.close()
 
     def start(self) -> None:
+        self._pool.start()
         self._connect()
         asyncio.get_event_loop().call_soon_threadsafe(self._update_status)
         asyncio.get_event_loop().run_forever()
@@ -76,6 +119,7 @@ class Worker(object):
             last_contact=func.now(),
             processed=self._task_processed,
             errors=self._task_errors,
+            reused=self._task_reused,
         )
         try:
             hostname = self._hostname or gethostname()
@@ -96,7 +140,14 @@ class Worker(object):
                     s.query(WorkerTable).filter(
                         func.now() - WorkerTable.last_contact > threshold
                     ).delete(synchronize_session=False)
+                envs = s.query(
+                    Environment.compile_image_name,
+                    Environment.test_image_name,
+                ).filter(Environment.active.is_(True)).all()
             self._hostname = hostname
+            self._pool.set_images(
+                [c for c, _ in envs], [t for _, t in envs])
+            LOGGER.info('container pool: {}'.format(self._pool.stats()))
         except Exception:
             pass
         self._schedule_update_status()
@@ -118,8 +169,7 @@ class Worker(object):
     def _ch_on_open(self, ch: Channel) -> None:
         self._ch = ch
         ch.add_on_close_callback(self._ch_on_close)
-        ch.queue_declare(
-            queue=self._queue_name, callback=self._on_queue_declared)
+        self._setup_consumer(0)
 
     def _ch_on_close(self, ch: Channel, reason: AMQPError) -> None:
         LOGGER.warning('RabbitMQ channel closed ({})'.format(reason))
@@ -128,32 +178,92 @@ class Worker(object):
         except Exception:
             pass
 
-    def _on_queue_declared(self, method: pika.frame.Method) -> None:
-        self._ch.basic_qos(
-            prefetch_count=self._max_processes, callback=self._on_basic_qos_ok)
+    def _setup_consumer(self, priority: int) -> None:
+        # キュー毎に queue_declare -> basic_qos -> basic_consume を行う
+        # (basic_qosはその後に開始したコンシューマに適用される)
+        if priority >= len(JUDGE_QUEUES):
+            LOGGER.info('Worker started')
+            return
+        kind, queue_name = JUDGE_QUEUES[priority]
+
+        def _on_qos_ok(_: pika.frame.Method) -> None:
+            self._ch.basic_consume(
+                queue_name, on_message_callback=partial(
+                    self._recv_message, priority))
+            self._setup_consumer(priority + 1)
+
+        def _on_queue_declared(_: pika.frame.Method) -> None:
+            self._ch.basic_qos(
+                prefetch_count=self._prefetch_counts[kind],
+                callback=_on_qos_ok)
 
-    def _on_basic_qos_ok(self, method: pika.frame.Method) -> None:
-        self._ch.basic_consume(
-            self._queue_name, on_message_callback=self._recv_message)
-        LOGGER.info('Worker started')
+        self._ch.queue_declare(queue=queue_name, callback=_on_queue_declared)
 
     def _recv_message(
             self,
+            priority: int,
             ch: Channel,
             method: pika.spec.Basic.Return,
             _: pika.spec.BasicProperties,
             body: bytes) -> None:
         try:
-            self._process(ch, method, body)
+            self._process(priority, ch, method, body)
         except Exception:
             LOGGER.warning('', exc_info=True)
 
+    def _enqueue(self, priority: int, task: JudgeTask,
+                 callback: Callable[[Optional[TFuture]], None]) -> None:
+        heapq.heappush(
+            self._pending, (priority, next(self._pending_seq), task, callback))
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        # 空きスロット(子プロセスまたはasync_concurrency)がある場合のみ
+        # 優先度の高いタスクから投入する
+        loop = asyncio.get_event_loop()
+        while self._pending and self._running < self._concurrency:
+            _, _, task, callback = heapq.heappop(self._pending)
+            self._assign_containers(task)
+            self._running += 1
+            if self._executor is None:
+                LOGGER.info('start judge (submission.id={})'.format(task.id))
+                async_future = asyncio.ensure_future(
+                    run_async(AsyncDockerJudgeDriver, task))
+                async_future.add_done_callback(
+                    partial(self._on_task_done, callback))
+                continue
+            LOGGER.info('submit to child process (submission.id={})'.format(
+                task.id))
+            future = self._executor.submit(run, DockerJudgeDriver, task)
+            # 完了通知はイベントループ上で処理する
+            future.add_done_callback(partial(
+                loop.call_soon_threadsafe, self._on_task_done, callback))
+
+    def _on_task_done(self, callback: Callable[[Optional[TFuture]], None],
+                      future: TFuture) -> None:
+        self._running -= 1
+        try:
+            callback(future)
+        finally:
+            self._dispatch()
+
+    def _assign_containers(self, task: JudgeTask) -> None:
+        # 起動済みのコンテナがあれば割り当てる
+        if task.compile_image_name:
+            task.compile_container_id = self._pool.take(
+                task.compile_image_name, 'compile')
+        for _ in range(task.parallelism):
+            test_container_id = self._pool.take(task.test_image_name, 'test')
+            if test_container_id:
+                task.test_container_ids.append(test_container_id)
+
     def _process(
             self,
+            priority: int,
             ch: Channel,
             method: pika.spec.Basic.Return,
             body: bytes) -> None:
-        def _done(fut: Optional[Future]) -> None:
+        def _done(fut: Optional[TFuture]) -> None:
             ch.basic_ack(delivery_tag=method.delivery_tag)
             if fut is None:
                 return
@@ -179,69 +289,162 @@ class Worker(object):
                 LOGGER.warning(
                     'Submission.id "{}" is not found'.format(submission_id))
                 _done(None)
+                return
             if submission.status not in (
                     JudgeStatus.Waiting, JudgeStatus.Running,
                     JudgeStatus.InternalError):
                 _done(None)
+                return
             env = s.query(Environment).filter(
                 Environment.id == submission.environment_id).first()
             problem = s.query(Problem).filter(
                 Problem.contest_id == contest_id,
                 Problem.id == problem_id).first()
             assert env and problem  # env/problemは外部キー制約によって常に取得可能
+            reused = _reuse_judge_results(s, submission, problem, env)
+            if not reused:
+                # ワーカーダウン等ですべてのテストのジャッジが完了していない場合は
+                # ジャッジ済みのテストは結果を流用する
+                existed_results = {
+                    jr.test_id: jr
+                    for jr in s.query(JudgeResult).filter(
+                            JudgeResult.contest_id == contest_id,
+                            JudgeResult.problem_id == problem_id,
+                            JudgeResult.submission_id == submission_id)}
 
-            # ワーカーダウン等ですべてのテストのジャッジが完了していない場合は
-            # ジャッジ済みのテストは結果を流用する
-            existed_results = {
-                jr.test_id: jr
-                for jr in s.query(JudgeResult).filter(
-                        JudgeResult.contest_id == contest_id,
-                        JudgeResult.problem_id == problem_id,
-                        JudgeResult.submission_id == submission_id)}
-
-            task = JudgeTask(
-                id=submission_id,
-                contest_id=contest_id,
-                problem_id=problem_id,
-                user_id=submission.user_id,
-                code=submission.code,
-                compile_image_name=env.compile_image_name,
-                test_image_name=env.test_image_name,
-                time_limit=problem.time_limit,
-                memory_limit=problem.memory_limit,
-                tests=[])
-            submission.status = JudgeStatus.Running
-            testcases = s.query(TestCase).filter(
-                TestCase.contest_id == contest_id,
-                TestCase.problem_id == problem_id).all()
-            for test in testcases:
-                jr = existed_results.get(test.id, None)
-                if not jr:
-                    s.add(JudgeResult(
-                        contest_id=contest_id, problem_id=problem_id,
-                        submission_id=submission_id, test_id=test.id))
-                if not jr or jr.status in (
-                        JudgeStatus.Waiting, JudgeStatus.Running,
-                        JudgeStatus.InternalError):
-                    task.tests.append(JudgeTestInfo(
-                        id=test.id, input=test.input, output=test.output))
+                task = JudgeTask(
+                    id=submission_id,
+                    contest_id=contest_id,
+                    problem_id=problem_id,
+                    user_id=submission.user_id,
+                    code=submission.code,
+                    code_dictionary_id=submission.code_dictionary_id,
+                    compile_image_name=env.compile_image_name,
+                    test_image_name=env.test_image_name,
+                    time_limit=problem.time_limit,
+                    memory_limit=problem.memory_limit,
+                    fail_fast=problem.fail_fast,
+                    tests=[])
+                submission.status = JudgeStatus.Running
+                notify_submission(
+                    s, contest_id, problem_id, submission_id,
+                    submission.user_id, status=JudgeStatus.Running)
+                testcases = s.query(
+                    TestCase.id, TestCase.input_hash, TestCase.output_hash
+                ).filter(
+                    TestCase.contest_id == contest_id,
+                    TestCase.problem_id == problem_id).all()
+                for test in testcases:
+                    jr = existed_results.get(test.id, None)
+                    if not jr:
+                        s.add(JudgeResult(
+                            contest_id=contest_id, problem_id=problem_id,
+                            submission_id=submission_id, test_id=test.id))
+                    if not jr or jr.status in (
+                            JudgeStatus.Waiting, JudgeStatus.Running,
+                            JudgeStatus.InternalError):
+                        task.tests.append(JudgeTestInfo(
+                            id=test.id, input_hash=test.input_hash,
+                            output_hash=test.output_hash))
+        if reused:
+            self._task_reused += 1
+            _done(None)
+            return
 
         # テストの実行順序をシャッフルする
         shuffle(task.tests)
 
-        def _submit() -> None:
-            LOGGER.info('submit to child process (submission.id={})'.format(
-                submission_id))
-            future = self._executor.submit(run, DockerJudgeDriver, task)
-            future.add_done_callback(_done)
-        asyncio.get_event_loop().call_soon_threadsafe(_submit)
+        task.parallelism = max(1, min(
+            self._test_parallelism, len(task.tests)))
+        self._enqueue(priority, task, _done)
+
 
+def _reuse_judge_results(s: scoped_session, submission: Submission,
+                         problem: Problem, env: Environment) -> bool:
+    """同じコードのジャッジ済みの提出があればジャッジ結果を複製する
 
-def _initializer(db_config: dict) -> None:
+    言語環境(のイメージ)と問題のtests_versionが同じで、InternalError以外で
+    ジャッジが完了した提出を対象とする
+    """
+    submission.tests_version = problem.tests_version
+    submission.compile_image_name = env.compile_image_name
+    submission.test_image_name = env.test_image_name
+    if not submission.code_hash or not s.query(
+            Contest.reuse_judge_results).filter(
+                Contest.id == submission.contest_id).scalar():
+        return False
+    source = s.query(
+        Submission.id, Submission.status, Submission.compile_time,
+        Submission.max_time, Submission.max_memory,
+    ).filter(
+        Submission.code_hash == submission.code_hash,
+        Submission.contest_id == submission.contest_id,
+        Submission.problem_id == submission.problem_id,
+        Submission.environment_id == submission.environment_id,
+        Submission.compile_image_name.isnot_distinct_from(
+            env.compile_image_name),
+        Submission.test_image_name == env.test_image_name,
+        Submission.tests_version == problem.tests_version,
+        Submission.id != submission.id,
+        Submission.status.notin_([
+            JudgeStatus.Waiting, JudgeStatus.Running,
+            JudgeStatus.InternalError]),
+    ).order_by(Submission.id).first()
+    if not source:
+        return False
+
+    table = JudgeResult.__table__
+    s.execute(table.delete().where(and_(
+        table.c.contest_id == submission.contest_id,
+        table.c.problem_id == submission.problem_id,
+        table.c.submission_id == submission.id)))
+    columns = ['contest_id', 'problem_id', 'test_id', 'status', 'time',
+               'memory']
+    s.execute(table.insert().from_select(
+        columns + ['submission_id'],
+        select([table.c[k] for k in columns] + [
+            literal(submission.id)]).where(and_(
+                table.c.contest_id == submission.contest_id,
+                table.c.problem_id == submission.problem_id,
+                table.c.submission_id == source.id))))
+    for key in ('status', 'compile_time', 'max_time', 'max_memory'):
+        setattr(submission, key, getattr(source, key))
+    tests = [dict(id=test_id, status=status, time=time, memory=memory)
+             for test_id, status, time, memory in s.query(
+                 JudgeResult.test_id, JudgeResult.status, JudgeResult.time,
+                 JudgeResult.memory).filter(
+                     JudgeResult.contest_id == submission.contest_id,
+                     JudgeResult.problem_id == submission.problem_id,
+                     JudgeResult.submission_id == source.id)]
+    notify_submission(
+        s, submission.contest_id, submission.problem_id, submission.id,
+        submission.user_id, tests=tests, status=source.status,
+        max_time=source.max_time, max_memory=source.max_memory)
+    LOGGER.info('judge results reused (submission_id={}, source={})'.format(
+        submission.id, source.id))
+    return True
+
+
+def _initializer(config: Dict[str, str]) -> None:
+    from penguin_judge.blob import configure as configure_blob
     from penguin_judge.models import configure
-    configure(**db_config)
+    configure_blob(**config)
+    configure(**config)
+    configure_cache(**config)
+    configure_judge(**config)
+
+
+def _parse_image_sizes(s: str) -> Dict[str, int]:
+    # "image0:tag=2, image1=0" 形式
+    ret = {}
+    for item in s.split(','):
+        if not item.strip():
+            continue
+        name, size = item.rsplit('=', maxsplit=1)
+        ret[name.strip()] = int(size)
+    return ret
 
 
-def main(db_config: dict, max_processes: int) -> None:
-    with Worker(db_config, max_processes) as worker:
+def main(config: Mapping[str, str], max_processes: int) -> None:
+    with Worker(config, max_processes) as worker:
         worker.start()
@@ -1,15 +1,37 @@
-from base64 import b64encode
+import asyncio
+from base64 import b64decode, b64encode, urlsafe_b64encode
+from copy import deepcopy
 from http.cookiejar import CookieJar
 from datetime import datetime, timezone, timedelta
 import unittest
 import unittest.mock
 from functools import partial
+from hashlib import sha256
+from io import BytesIO
+import gzip
+import json
+import os
+import pickle
+import select
+from tempfile import mkdtemp
+import threading
+import time
+from zipfile import ZipFile
 from webtest import TestApp
-from zstandard import ZstdCompressor  # type: ignore
-from penguin_judge.api import app as _app, _kdf
+from zstandard import ZstdDecompressor  # type: ignore
+from penguin_judge import events
+from penguin_judge.blob import configure as configure_blob, get_blob_store
+from penguin_judge.compression import (
+    compress_code, decompress_code, train_code_dictionary)
+from penguin_judge.api import app as _app, _get_token_cache, _kdf
+from penguin_judge.events import notify_submission
+from penguin_judge.judge import JudgeTask, JudgeTestInfo
+from penguin_judge.judge.main import _JudgeResultWriter
 from penguin_judge.models import (
     User, Environment, Contest, Problem, TestCase, Submission, JudgeResult,
-    Token, JudgeStatus, configure, transaction)
+    Token, JudgeStatus, CodeDictionary, Session, configure,
+    get_standings_version, summarize_judge_results, transaction,
+    update_standings)
 from . import TEST_DB_URL
 
 app = TestApp(_app, cookiejar=CookieJar())
@@ -18,6 +40,7 @@ app = TestApp(_app, cookiejar=CookieJar())
 class TestAPI(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
+        configure_blob(blob_store='file://' + mkdtemp())
         configure(**{'sqlalchemy.url': TEST_DB_URL}, drop_all=True)
 
     def setUp(self):
@@ -25,8 +48,8 @@ class TestAPI(unittest.TestCase):
         app.reset()
         _configure_app({})
         tables = (
-            JudgeResult, Submission, TestCase, Problem, Contest, Environment,
-            Token, User)
+            JudgeResult, Submission, CodeDictionary, TestCase, Problem,
+            Contest, Environment, Token, User)
         admin_token = bytes([i for i in range(32)])
         salt = b'penguin'
         passwd = _kdf('penguinpenguin', salt)
@@ -111,6 +134,20 @@ class TestAPI(unittest.TestCase):
                 'expires': datetime.now(tz=timezone.utc)})
         app.get('/user', headers={'X-Auth-Token': token}, status=401)
 
+        # ログアウト後はキャッシュされたトークンも利用できない
+        token = app.post_json(
+            '/auth', {'id': uid, 'password': pw}).json['token']
+        headers = {'X-Auth-Token': token}
+        other = app.post_json(
+            '/auth', {'id': uid, 'password': pw}).json['token']
+        self.assertEqual(u, app.get('/user', headers=headers).json)
+        self.assertEqual(u, app.get(
+            '/user', headers={'X-Auth-Token': other}).json)
+        app.delete('/auth', headers=headers, status=204)
+        app.get('/user', headers=headers, status=401)
+        # 他のトークンのキャッシュは破棄しない
+        self.assertIsNotNone(_get_token_cache().get(b64decode(other)))
+
     def test_get_user(self):
         app.get('/users/invalid_user', status=404)
         u = app.get('/users/admin').json
@@ -162,6 +199,7 @@ class TestAPI(unittest.TestCase):
         c2 = _post(c).json
         c['published'] = False
         c['penalty'] = 300.0
+        c['reuse_judge_results'] = True
         self.assertEqual(c, c2)
 
         _invalid_patch(c['id'], dict(end_time=start_time.isoformat()))
@@ -182,6 +220,7 @@ class TestAPI(unittest.TestCase):
 
         c4.pop('description')
         c4.pop('penalty')
+        c4.pop('reuse_judge_results')
         contests = app.get('/contests').json
         self.assertEqual(len(contests), 1)
         self.assertEqual(contests[0], c4)
@@ -231,12 +270,18 @@ class TestAPI(unittest.TestCase):
             ret = [ret[1], ret[0]]
         p0['memory_limit'] = 256
         p0['contest_id'] = p1['contest_id'] = contest_id
+        p0['fail_fast'] = p1['fail_fast'] = False
+        p0['tests_version'] = p1['tests_version'] = 1
         self.assertEqual([p0, p1], ret)
 
         _invalid_patch(contest_id, 'invalid-id', {}, status=404)
         ret = _patch(contest_id, p0['id'], {'title': 'AAAA'}).json
         p0['title'] = 'AAAA'
         self.assertEqual(ret, p0)
+        ret = _patch(contest_id, p0['id'], {'fail_fast': True}).json
+        p0['fail_fast'] = True
+        p0['tests_version'] = 2
+        self.assertEqual(ret, p0)
 
         app.delete('/contests/{}/problems/{}'.format(contest_id, p1['id']),
                    headers=self.admin_headers)
@@ -266,8 +311,672 @@ class TestAPI(unittest.TestCase):
         app.get('/contests/{}/problems'.format(contest_id), status=404)
         app.get('/contests/{}/problems/A'.format(contest_id), status=404)
 
+    def test_test_dataset(self):
+        start_time = datetime.now(tz=timezone.utc)
+        with transaction() as s:
+            s.add(Contest(
+                id='abc000', title='ABC000', description='',
+                start_time=start_time,
+                end_time=start_time + timedelta(hours=1)))
+            s.flush()
+            s.add(Problem(
+                contest_id='abc000', id='A', title='A', description='',
+                time_limit=2, memory_limit=256, score=100))
+        url = '/contests/abc000/problems/A/tests'
+
+        f = BytesIO()
+        with ZipFile(f, 'w') as z:
+            z.writestr('tests/1.in', b'1 2\n')
+            z.writestr('tests/1.out', b'3\n')
+            z.writestr('tests/2.in', b'')
+            z.writestr('tests/2.out', b'3\n')
+            z.writestr('tests/3.in', b'no output')
+        ret = app.put(url, f.getvalue(), headers=dict(
+            self.admin_headers, **{'Content-Type': 'application/zip'})).json
+        self.assertEqual(sorted(ret), ['1', '2'])
+        self.assertEqual(sorted(app.get(
+            url, headers=self.admin_headers).json), ['1', '2'])
+        self.assertEqual(app.get(
+            url + '/1/in', headers=self.admin_headers).body, b'1 2\n')
+        self.assertEqual(app.get(
+            url + '/2/in', headers=self.admin_headers).body, b'')
+        app.get(url + '/3/in', headers=self.admin_headers, status=404)
+
+        # テストデータは内容のSHA256をアドレスとしてblobストアに保存される
+        with transaction() as s:
+            tests = {t.id: t for t in s.query(TestCase)}
+            self.assertEqual(tests['1'].output_hash, tests['2'].output_hash)
+            self.assertEqual(tests['1'].input_size, 4)
+            store = get_blob_store()
+            self.assertEqual(
+                bytes(store.map(tests['1'].input_hash)), b'1 2\n')
+            self.assertEqual(store.get(tests['2'].input_hash), b'')
+
+    def _create_judge_task(self, test_ids, fail_fast=False):
+        """ジャッジ待ちの提出を作成し、対応するJudgeTaskを返す"""
+        start_time = datetime.now(tz=timezone.utc)
+        store = get_blob_store()
+        with transaction() as s:
+            env = Environment(name='Python', test_image_name='python')
+            s.add(env)
+            s.add(Contest(
+                id='abc000', title='ABC000', description='',
+                start_time=start_time,
+                end_time=start_time + timedelta(hours=1)))
+            s.flush()
+            s.add(Problem(
+                contest_id='abc000', id='A', title='A', description='',
+                time_limit=2, memory_limit=256, score=100,
+                fail_fast=fail_fast))
+            s.flush()
+            s.add_all([TestCase(
+                contest_id='abc000', problem_id='A', id=test_id,
+                input_hash=store.put(test_id.encode()),
+                output_hash=store.put(test_id.encode()),
+                input_size=len(test_id), output_size=len(test_id))
+                for test_id in test_ids])
+            submission = Submission(
+                contest_id='abc000', problem_id='A', user_id='admin',
+                code=b'', code_bytes=0, environment_id=env.id)
+            s.add(submission)
+            s.flush()
+            s.add_all([JudgeResult(
+                contest_id='abc000', problem_id='A',
+                submission_id=submission.id, test_id=test_id)
+                for test_id in test_ids])
+            task = JudgeTask(
+                id=submission.id, contest_id='abc000', problem_id='A',
+                user_id='admin', code=compress_code(b'', None),
+                compile_image_name=None, test_image_name='python',
+                time_limit=2, memory_limit=256, fail_fast=fail_fast,
+                tests=[JudgeTestInfo(
+                    id=test_id, input_hash=store.put(test_id.encode()),
+                    output_hash=store.put(test_id.encode()),
+                    output=test_id.encode()) for test_id in test_ids])
+        return task
+
+    def _judge_results(self, task):
+        with transaction() as s:
+            return {r.test_id: r.status for r in s.query(JudgeResult).filter(
+                JudgeResult.submission_id == task.id)}
+
+    def test_judge_result_writer(self):
+        task = self._create_judge_task(['1', '2'])
+        writer = _JudgeResultWriter(task, 3600, 100)
+        writer.update('1', status=JudgeStatus.Running)
+        # コミットに失敗した更新はバッファに残り、次回のflushで書き込まれる
+        with unittest.mock.patch(
+                'penguin_judge.judge.main.notify_submission',
+                side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                writer.flush()
+        self.assertEqual(self._judge_results(task)['1'], JudgeStatus.Waiting)
+        writer.update('2', status=JudgeStatus.Accepted)
+        writer.flush()
+        self.assertEqual(self._judge_results(task), {
+            '1': JudgeStatus.Running, '2': JudgeStatus.Accepted})
+        with unittest.mock.patch(
+                'penguin_judge.judge.main.notify_submission') as notify:
+            writer.flush()
+            notify.assert_not_called()
+        # 呼び出し元の変更と同じトランザクションで書き込み、
+        # コミットに失敗した場合はバッファに残す
+        writer.update('1', status=JudgeStatus.Accepted)
+        with self.assertRaises(RuntimeError):
+            with writer.flushing() as s:
+                s.query(Submission).filter(Submission.id == task.id).update(
+                    {Submission.status: JudgeStatus.Accepted},
+                    synchronize_session=False)
+                raise RuntimeError
+        self.assertEqual(self._judge_results(task)['1'], JudgeStatus.Running)
+        with writer.flushing() as s:
+            s.query(Submission).filter(Submission.id == task.id).update(
+                {Submission.status: JudgeStatus.Accepted},
+                synchronize_session=False)
+        self.assertEqual(self._judge_results(task)['1'], JudgeStatus.Accepted)
+        with transaction() as s:
+            self.assertEqual(
+                s.query(Submission).get(task.id).status,
+                JudgeStatus.Accepted)
+
+    def test_fail_fast(self):
+        from penguin_judge.judge import AgentTestResult, JudgeDriver
+        from penguin_judge.judge.main import _tests
+
+        class StubDriver(JudgeDriver):
+            def __init__(self, outputs):
+                self.outputs = outputs
+                self.executed = []
+
+            def compile(self, task):
+                raise NotImplementedError
+
+            def tests(self, task, start_test_callback,
+                      judge_complete_callback):
+                for test in task.tests:
+                    self.executed.append(test.id)
+                    start_test_callback(test.id)
+                    resp = AgentTestResult(
+                        output=self.outputs[test.id], time=0.5,
+                        memory_bytes=2048)
+                    if not judge_complete_callback(test, resp):
+                        break
+
+        # 最初の不正解で残りのテストを実行せずSkippedにする
+        task = self._create_judge_task(['1', '2', '3', '4'], fail_fast=True)
+        driver = StubDriver({'1': b'1', '2': b'x', '3': b'3', '4': b'4'})
+        self.assertEqual(_tests(driver, task), JudgeStatus.WrongAnswer)
+        self.assertEqual(driver.executed, ['1', '2'])
+        self.assertEqual(self._judge_results(task), {
+            '1': JudgeStatus.Accepted, '2': JudgeStatus.WrongAnswer,
+            '3': JudgeStatus.Skipped, '4': JudgeStatus.Skipped})
+        # Skippedは提出のステータスの集計では無視する
+        with transaction() as s:
+            submission = s.query(Submission).get(task.id)
+            self.assertEqual(submission.status, JudgeStatus.WrongAnswer)
+            self.assertEqual(submission.max_time, timedelta(seconds=0.5))
+            self.assertEqual(submission.max_memory, 2)
+        self.assertEqual(summarize_judge_results([
+            (JudgeStatus.Accepted, timedelta(seconds=1), 1),
+            (JudgeStatus.Skipped, None, None),
+        ]), (JudgeStatus.Accepted, timedelta(seconds=1), 1))
+
+    def test_file_cache(self):
+        from penguin_judge.judge.cache import FileCache
+        path = mkdtemp()
+        cache = FileCache(path, 10)
+        cache.put(('a', 1), b'aaaa')
+        cache.put(('b', 1), b'bbbb')
+        self.assertEqual(cache.get(('a', 1)), b'aaaa')
+        # 合計サイズを超えたら参照が古いエントリから削除する
+        cache.put(('c', 1), b'cccc')
+        self.assertIsNone(cache.get(('b', 1)))
+        self.assertEqual(cache.get(('a', 1)), b'aaaa')
+        # キーの最後の要素だけが異なる古いエントリは置き換える
+        cache.put(('a', 2), b'AA')
+        self.assertIsNone(cache.get(('a', 1)))
+        # 他のプロセスが格納したエントリも含めてディレクトリ全体で
+        # 合計サイズを超えないようにする
+        other = FileCache(path, 10)
+        other.put(('d', 1), b'dddddd')
+        self.assertIsNone(cache.get(('c', 1)))
+        self.assertEqual(cache.get(('a', 2)), b'AA')
+        self.assertEqual(cache.get(('d', 1)), b'dddddd')
+        cache.put(('e', 1), b'eee')
+        self.assertIsNone(other.get(('a', 2)))
+        self.assertEqual(other.get(('e', 1)), b'eee')
+        self.assertEqual(sum(
+            os.path.getsize(os.path.join(path, name))
+            for name in os.listdir(path) if not name.startswith('.')), 9)
+
+    def test_binary_cache(self):
+        from penguin_judge.judge import (
+            AgentCompilationResult, AgentTestResult, JudgeDriver)
+        from penguin_judge.judge.cache import FileCache, binary_key
+        from penguin_judge.judge.main import run
+
+        class StubDriver(JudgeDriver):
+            image = 'sha256:1'
+            compiled = []
+            executed = []
+
+            def image_id(self, image_name):
+                return self.image
+
+            def compile(self, task):
+                self.compiled.append(task.code)
+                return AgentCompilationResult(
+                    binary=b'binary:' + task.code, time=1.5)
+
+            def tests(self, task, start_test_callback,
+                      judge_complete_callback):
+                self.executed.append(task.code)
+                for test in task.tests:
+                    start_test_callback(test.id)
+                    judge_complete_callback(test, AgentTestResult(
+                        output=test.output, time=0.1, memory_bytes=1024))
+
+        task = self._create_judge_task(['1'])
+        task.code = compress_code(b'code', None)
+        task.compile_image_name = 'gcc'
+        cache = FileCache(mkdtemp(), 2**20)
+        with unittest.mock.patch(
+                'penguin_judge.judge.main.get_binary_cache',
+                return_value=cache):
+            # 初回はコンパイルしてバイナリをキャッシュする
+            self.assertEqual(
+                run(StubDriver, deepcopy(task)), JudgeStatus.Accepted)
+            self.assertEqual(StubDriver.compiled, [b'code'])
+            # 同じイメージとコードではコンパイルを省略する
+            self.assertEqual(
+                run(StubDriver, deepcopy(task)), JudgeStatus.Accepted)
+            self.assertEqual(StubDriver.compiled, [b'code'])
+            self.assertEqual(StubDriver.executed, [b'binary:code'] * 2)
+            with transaction() as s:
+                self.assertEqual(
+                    s.query(Submission).get(task.id).compile_time,
+                    timedelta(seconds=1.5))
+            # イメージが更新された場合はコンパイルし直し、古いバイナリを破棄する
+            StubDriver.image = 'sha256:2'
+            self.assertEqual(
+                run(StubDriver, deepcopy(task)), JudgeStatus.Accepted)
+            self.assertEqual(StubDriver.compiled, [b'code'] * 2)
+            self.assertIsNone(
+                cache.get(binary_key('gcc', 'sha256:1', b'code')))
+            self.assertIsNotNone(
+                cache.get(binary_key('gcc', 'sha256:2', b'code')))
+
+    def test_blob_cache(self):
+        from penguin_judge.judge.cache import FileCache, blob_key
+        from penguin_judge.judge.main import _load_tests
+        task = self._create_judge_task(['1', '2'])
+        cache = FileCache(mkdtemp(), 2**20)
+        with unittest.mock.patch(
+                'penguin_judge.judge.main.get_blob_cache',
+                return_value=cache):
+            _load_tests(task)
+            self.assertEqual(
+                cache.get(blob_key(task.tests[0].input_hash)), b'1')
+            # キャッシュ済みのテストデータはストアから読み込まない
+            with unittest.mock.patch.object(
+                    get_blob_store(), 'get', side_effect=RuntimeError):
+                _load_tests(task)
+        self.assertEqual(
+            [(bytes(t.input), bytes(t.output)) for t in task.tests],
+            [(b'1', b'1'), (b'2', b'2')])
+
+    @unittest.mock.patch('penguin_judge.judge.docker.docker_client')
+    def test_judge_kills_assigned_containers(self, mock_client):
+        from penguin_judge.judge.docker import DockerJudgeDriver
+        from penguin_judge.judge.main import run
+        client = mock_client.return_value
+
+        def _killed():
+            ret = sorted(c[0][0] for c in client.kill.call_args_list)
+            client.kill.reset_mock()
+            return ret
+
+        # テストデータを読み込めない場合もワーカーが割り当てたコンテナを破棄する
+        task = self._create_judge_task(['1', '2'])
+        task.tests[0].input_hash = b'\0' * 32
+        task.compile_container_id = 'c'
+        task.test_container_ids = ['t1', 't2']
+        self.assertEqual(
+            run(DockerJudgeDriver, task), JudgeStatus.InternalError)
+        self.assertEqual(_killed(), ['c', 't1', 't2'])
+
+        # prepareの途中で失敗した場合も未使用のコンテナを破棄する
+        task.tests[0].input_hash = get_blob_store().put(b'1')
+        task.code = compress_code(b'', None)
+        task.compile_image_name = 'compile'
+        client.update_container.side_effect = RuntimeError
+        client.create_container.side_effect = RuntimeError
+        self.assertEqual(
+            run(DockerJudgeDriver, task), JudgeStatus.InternalError)
+        self.assertEqual(_killed(), ['c', 't1', 't2'])
+
+    @unittest.mock.patch('penguin_judge.judge.docker.docker_client')
+    def test_parallel_tests(self, mock_client):
+        from penguin_judge.judge import AgentTestResult
+        from penguin_judge.judge.docker import DockerJudgeDriver
+        from penguin_judge.judge.main import _tests
+        client = mock_client.return_value
+        client.create_container.side_effect = [
+            {'Id': 'new1'}, {'Id': 'new2'}]
+        assigned = {}
+        active = []
+        overlapped = []
+
+        def _run_tests(self, container, task, tests, start_test_callback,
+                       judge_complete_callback):
+            assigned[container] = [t.id for t in tests]
+            for test in tests:
+                start_test_callback(test.id)
+                time.sleep(0.01)
+                resp = AgentTestResult(
+                    output=b'x' if test.id == '4' else test.output,
+                    time=0.1, memory_bytes=1024)
+                if not judge_complete_callback(test, resp):
+                    break
+
+        def _wrap(f):
+            def _callback(*args):
+                # コールバックが同時に呼び出されていないことを確認する
+                if active:
+                    overlapped.append(args)
+                active.append(None)
+                time.sleep(0.001)
+                try:
+                    return f(*args)
+                finally:
+                    active.pop()
+            return _callback
+
+        task = self._create_judge_task(['1', '2', '3', '4', '5'])
+        task.parallelism = 3
+        task.test_container_ids = ['pooled']
+        driver = DockerJudgeDriver()
+        driver.take_containers(task)
+        driver.prepare(task)
+        # 起動済みのコンテナを優先し、不足分を新規に作成する
+        self.assertEqual(driver.test_containers, ['pooled', 'new1', 'new2'])
+
+        original_tests = driver.tests
+
+        def _tests_with_check(task, start, complete):
+            original_tests(task, _wrap(start), _wrap(complete))
+        driver.tests = _tests_with_check
+        with unittest.mock.patch.object(
+                DockerJudgeDriver, '_run_tests', _run_tests):
+            self.assertEqual(_tests(driver, task), JudgeStatus.WrongAnswer)
+        # テストケースを重複なくコンテナに分割して実行する
+        self.assertEqual(assigned, {
+            'pooled': ['1', '4'], 'new1': ['2', '5'], 'new2': ['3']})
+        self.assertEqual(overlapped, [])
+        self.assertEqual(self._judge_results(task), {
+            '1': JudgeStatus.Accepted, '2': JudgeStatus.Accepted,
+            '3': JudgeStatus.Accepted, '4': JudgeStatus.WrongAnswer,
+            '5': JudgeStatus.Accepted})
+
+        # fail_fastで停止した場合は他のコンテナも残りのテストを実行しない
+        with transaction() as s:
+            s.query(Problem).update({Problem.fail_fast: True})
+        task.fail_fast = True
+        task.tests = sorted(
+            (t for t in task.tests if t.id != '3'),
+            key=lambda t: (t.id != '4', t.id))
+        driver.test_containers = ['a', 'b']
+        executed = []
+
+        def _run_tests_ff(self, container, task, tests, start_test_callback,
+                          judge_complete_callback):
+            for test in tests:
+                if test.id != '4':
+                    time.sleep(0.05)
+                executed.append(test.id)
+                start_test_callback(test.id)
+                resp = AgentTestResult(
+                    output=b'x' if test.id == '4' else test.output,
+                    time=0.1, memory_bytes=1024)
+                if not judge_complete_callback(test, resp):
+                    break
+        with unittest.mock.patch.object(
+                DockerJudgeDriver, '_run_tests', _run_tests_ff):
+            self.assertEqual(_tests(driver, task), JudgeStatus.WrongAnswer)
+        # 'a'は['4', '2']、'b'は['1', '5']を担当する。
+        # 'b'は実行中だった'1'を終えた時点で停止する
+        self.assertEqual(sorted(executed), ['1', '4'])
+
+    @unittest.mock.patch('penguin_judge.judge.docker.docker_client')
+    def test_worker_dispatch_priority(self, _):
+        from penguin_judge.worker import Worker
+        started = []
+        finishes = {}
+
+        async def _run_async(judge_class, task):
+            started.append(task.id)
+            finishes[task.id] = asyncio.get_event_loop().create_future()
+            return await finishes[task.id]
+
+        def _task(task_id):
+            return JudgeTask(
+                id=task_id, contest_id='abc000', problem_id='A',
+                user_id='admin', code=b'', compile_image_name=None,
+                test_image_name='python', time_limit=2, memory_limit=256,
+                tests=[])
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        done = []
+        try:
+            with unittest.mock.patch(
+                    'penguin_judge.worker.run_async', _run_async):
+                worker = Worker(dict(
+                    async_judge='true', async_concurrency='1'), 1)
+                # 空きスロットが無い間に受信したタスクは、受信順に関わらず
+                # 通常の提出(優先度0)をリジャッジ(優先度1)より先に開始する
+                worker._enqueue(1, _task(1), done.append)
+                worker._enqueue(1, _task(2), done.append)
+                worker._enqueue(0, _task(3), done.append)
+                worker._enqueue(1, _task(4), done.append)
+                worker._enqueue(0, _task(5), done.append)
+                for _ in range(6):
+                    loop.run_until_complete(asyncio.sleep(0))
+                    if started and not finishes[started[-1]].done():
+                        finishes[started[-1]].set_result(
+                            JudgeStatus.Accepted)
+                    loop.run_until_complete(asyncio.sleep(0))
+                self.assertEqual(started, [1, 3, 5, 2, 4])
+                self.assertEqual(len(done), 5)
+                self.assertEqual(worker._running, 0)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    @unittest.mock.patch('penguin_judge.judge.docker.docker_client')
+    def test_container_pool_backoff(self, mock_client):
+        from penguin_judge.judge.docker import DockerContainerPool
+        client = mock_client.return_value
+        created = []
+
+        def _create(image_name, **kwargs):
+            created.append(image_name)
+            if image_name == 'broken':
+                raise RuntimeError
+            return {'Id': '{}{}'.format(image_name, len(created))}
+        client.create_container.side_effect = _create
+
+        # 作成に失敗するイメージがあっても他のイメージの補充は止まらず、
+        # 失敗したイメージはバックオフが明けるまで再試行しない
+        pool = DockerContainerPool(2)
+        pool.set_images(['broken'], ['ok'])
+        pool.start()
+        try:
+            for _ in range(100):
+                if pool.stats()['test:ok']['ready'] == 2:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(pool.stats()['test:ok']['ready'], 2)
+            self.assertEqual(created.count('broken'), 1)
+            self.assertEqual(created.count('ok'), 2)
+        finally:
+            pool.close()
+
+    @unittest.mock.patch('penguin_judge.mq.get_mq_conn_params')
+    @unittest.mock.patch('pika.BlockingConnection')
+    def test_publisher(self, mock_conn, _):
+        from pika.exceptions import AMQPError
+        from penguin_judge import mq
+        conn = mock_conn.return_value
+        ch = conn.channel.return_value
+        publisher = mq._Publisher()
+        with unittest.mock.patch.object(mq._Publisher, '_start_keepalive'), \
+                unittest.mock.patch.object(mq, 'PUBLISH_BATCH_SIZE', 2):
+            # 接続とチャネルを使い回し、メッセージはまとめてコミットする
+            publisher.publish('q', [b'1'])
+            publisher.publish('q', [b'2', b'3', b'4'])
+            self.assertEqual(mock_conn.call_count, 1)
+            ch.tx_select.assert_called_once_with()
+            ch.queue_declare.assert_called_once_with(queue='q')
+            self.assertEqual(
+                [c[1]['body'] for c in ch.basic_publish.call_args_list],
+                [b'1', b'2', b'3', b'4'])
+            self.assertEqual(ch.tx_commit.call_count, 3)
+
+            # 失敗した場合は再接続し、コミットしていないメッセージから送り直す
+            ch.basic_publish.reset_mock()
+            ch.tx_commit.side_effect = [None, AMQPError, None, None]
+            publisher.publish('q', [b'5', b'6', b'7', b'8'])
+            self.assertEqual(mock_conn.call_count, 2)
+            conn.close.assert_called_once_with()
+            self.assertEqual(
+                [c[1]['body'] for c in ch.basic_publish.call_args_list],
+                [b'5', b'6', b'7', b'8', b'7', b'8'])
+
+            # 再接続後も失敗する場合は例外を送出する
+            ch.tx_commit.side_effect = AMQPError
+            with self.assertRaises(AMQPError):
+                publisher.publish('q', [b'9'])
+            self.assertEqual(mock_conn.call_count, 3)
+
+            # アイドル中もハートビートを処理し、失敗した場合は接続を破棄する
+            ch.tx_commit.side_effect = None
+            publisher.publish('q', [b'10'])
+            publisher.process_data_events()
+            conn.process_data_events.assert_called_once_with(0)
+            conn.process_data_events.side_effect = AMQPError
+            publisher.process_data_events()
+            publisher.publish('q', [b'11'])
+            self.assertEqual(mock_conn.call_count, 5)
+
+    @unittest.mock.patch('penguin_judge.api.publish')
+    def test_rejudge(self, mock_publish):
+        start_time = datetime.now(tz=timezone.utc)
+        with transaction() as s:
+            env = Environment(name='Python', test_image_name='python')
+            s.add(env)
+            s.add(Contest(
+                id='abc000', title='ABC000', description='',
+                start_time=start_time,
+                end_time=start_time + timedelta(hours=1)))
+            s.flush()
+            env_id = env.id
+            s.add(Problem(
+                contest_id='abc000', id='A', title='A', description='',
+                time_limit=2, memory_limit=256, score=100))
+        url = '/contests/abc000/problems/A'
+
+        def _upload(tests):
+            f = BytesIO()
+            with ZipFile(f, 'w') as z:
+                for k, v in tests.items():
+                    z.writestr('{}.in'.format(k), k)
+                    z.writestr('{}.out'.format(k), v)
+            app.put(url + '/tests', f.getvalue(), headers=dict(
+                self.admin_headers, **{'Content-Type': 'application/zip'}))
+            with transaction() as s:
+                return s.query(Problem.tests_version).scalar()
+
+        def _rejudge(full=False):
+            app.post(url + '/rejudge' + ('?full=true' if full else ''),
+                     headers=self.admin_headers)
+            (_, ids), _ = mock_publish.call_args
+            with transaction() as s:
+                return sorted(pickle.loads(x)[2] for x in ids), {
+                    x.id: (x.status, sorted(
+                        r.test_id for r in s.query(JudgeResult).filter(
+                            JudgeResult.submission_id == x.id)))
+                    for x in s.query(Submission)}
+
+        version = _upload({'1': '1', '2': '2', '3': '3'})
+        self.assertEqual(version, 2)
+        self.assertEqual(_upload({'1': '1', '2': '2', '3': '3'}), version)
+        with transaction() as s:
+            submissions = [Submission(
+                contest_id='abc000', problem_id='A', user_id='admin',
+                code=b'', code_bytes=0, environment_id=env_id,
+                status=status, tests_version=version)
+                for status in (JudgeStatus.WrongAnswer, JudgeStatus.Accepted)]
+            s.add_all(submissions)
+            s.flush()
+            wa, ac = [x.id for x in submissions]
+            for test_id in ('1', '2', '3'):
+                for x in submissions:
+                    s.add(JudgeResult(
+                        contest_id='abc000', problem_id='A',
+                        submission_id=x.id, test_id=test_id,
+                        status=(JudgeStatus.WrongAnswer
+                                if x.id == wa and test_id == '3'
+                                else JudgeStatus.Accepted)))
+
+        # 削除したテストケースの結果を除いてステータスを再計算する
+        self.assertEqual(_upload({'1': '1', '2': '2'}), version + 1)
+        self.assertEqual(_rejudge(), ([], {
+            wa: (JudgeStatus.Accepted, ['1', '2']),
+            ac: (JudgeStatus.Accepted, ['1', '2'])}))
+
+        # 内容が変わったテストケースと追加したテストケースのみ再実行する
+        _upload({'1': '1', '2': 'x', '4': '4'})
+        self.assertEqual(_rejudge(), ([wa, ac], {
+            wa: (JudgeStatus.Waiting, ['1']),
+            ac: (JudgeStatus.Waiting, ['1'])}))
+
+        self.assertEqual(_rejudge(full=True), ([wa, ac], {
+            wa: (JudgeStatus.Waiting, []),
+            ac: (JudgeStatus.Waiting, [])}))
+
+    def test_request_validators(self):
+        from flask import request
+        from openapi_core.contrib.flask import FlaskOpenAPIRequest
+        from werkzeug.exceptions import HTTPException
+        from penguin_judge.api import (
+            _compiled_validator, _request_validator, _validate_request)
+
+        def _validate(method, path, body=None, headers={}):
+            with _app.test_request_context(
+                    path, method=method, json=body, headers=headers):
+                request.url_rule, request.view_args = _app.url_map.bind(
+                    'localhost').match(
+                    path.split('?')[0], method=method, return_rule=True)
+                compiled = _compiled_validator.validate(request)
+                generic = _request_validator.validate(
+                    FlaskOpenAPIRequest(request))
+                try:
+                    _validate_request()
+                    status = 200
+                except HTTPException as e:
+                    status = e.code
+                return compiled, generic, status
+
+        def _valid(*args, **kwargs):
+            compiled, generic, status = _validate(*args, **kwargs)
+            self.assertEqual(status, 200)
+            self.assertEqual(generic.errors, [])
+            self.assertIsNotNone(compiled)
+            params, body = compiled
+            self.assertEqual(params.path, generic.parameters.path)
+            self.assertEqual(params.query, dict(generic.parameters.query))
+            self.assertEqual(_fields(body), _fields(generic.body))
+
+        def _fields(body):
+            # ボディはModel(属性)またはdictで返る
+            if body is None or isinstance(body, dict):
+                return body
+            return vars(body)
+
+        def _invalid(*args, **kwargs):
+            # 高速パスは受理せず、RequestValidatorのエラーで400を返す
+            compiled, generic, status = _validate(*args, **kwargs)
+            self.assertIsNone(compiled)
+            self.assertNotEqual(generic.errors, [])
+            self.assertEqual(status, 400)
+
+        auth = {'X-Auth-Token': self.admin_token}
+        body = {'problem_id': 'A', 'code': 'print(1)', 'environment_id': 1}
+        _valid('GET', '/contests?page=2&per_page=10')
+        _valid('GET', '/contests/abc/submissions?sort=-created,max_time'
+               '&status=Accepted', headers=auth)
+        _valid('GET', '/contests/abc/submissions/1', headers=auth)
+        _valid('POST', '/contests/abc/submissions', body, headers=auth)
+        _valid('GET', '/user', headers=auth)
+        # 不正なボディ
+        _invalid('POST', '/contests/abc/submissions',
+                 dict(body, environment_id='1'), headers=auth)
+        _invalid('POST', '/contests/abc/submissions',
+                 {'problem_id': 'A'}, headers=auth)
+        # 不正なクエリ
+        _invalid('GET', '/contests?page=0')
+        _invalid('GET', '/contests?per_page=abc')
+        _invalid('GET', '/contests/abc/submissions?status=Unknown',
+                 headers=auth)
+        # 不正なパスパラメータ
+        _invalid('GET', '/contests/abc/submissions/abc', headers=auth)
+        # 認証情報なし
+        _invalid('GET', '/user')
+        _invalid('DELETE', '/auth')
+
     @unittest.mock.patch('pika.BlockingConnection')
-    @unittest.mock.patch('penguin_judge.api.get_mq_conn_params')
+    @unittest.mock.patch('penguin_judge.mq.get_mq_conn_params')
     def test_submission(self, mock_conn, mock_get_params):
         # TODO(kazuki): API経由に書き換える
         env = dict(name='Python 3.7', test_image_name='docker-image')
@@ -294,14 +1003,16 @@ class TestAPI(unittest.TestCase):
             ), headers=self.admin_headers)
 
         # TODO(kazuki): API経由に書き換える
-        ctx = ZstdCompressor()
+        store = get_blob_store()
         with transaction() as s:
             s.add(TestCase(
                 contest_id=contest_id,
                 problem_id='A',
                 id='1',
-                input=ctx.compress(b'1'),
-                output=ctx.compress(b'2')))
+                input_hash=store.put(b'1'),
+                output_hash=store.put(b'2'),
+                input_size=1,
+                output_size=1))
 
         app.get('{}/submissions'.format(prefix), status=403)
         self.assertEqual([], app.get(
@@ -335,6 +1046,15 @@ class TestAPI(unittest.TestCase):
         }, headers=self.admin_headers, status=400)
         app.get('{}/submissions/99999'.format(prefix), status=404)
 
+        # ジャッジ待ちの提出数が上限を超えている場合は受け付けない
+        _app.config['user_judge_queue_limit'] = 0
+        app.post_json('{}/submissions'.format(prefix), {
+            'problem_id': 'A',
+            'environment_id': env['id'],
+            'code': code,
+        }, headers=self.admin_headers, status=429)
+        _app.config['user_judge_queue_limit'] = 10
+
         contest_id2 = app.post_json('/contests', {
             'id': 'abc001',
             'title': 'ABC001',
@@ -350,6 +1070,279 @@ class TestAPI(unittest.TestCase):
             s.query(Contest).update({'end_time': start_time})
         app.get('{}/submissions'.format(prefix))
 
+    @unittest.mock.patch('pika.BlockingConnection')
+    @unittest.mock.patch('penguin_judge.mq.get_mq_conn_params')
+    def test_submission_code_dictionary(self, mock_conn, mock_get_params):
+        start_time = datetime.now(tz=timezone.utc)
+        with transaction() as s:
+            env = Environment(name='Python', test_image_name='python')
+            s.add(env)
+            s.add(Contest(
+                id='abc000', title='ABC000', description='',
+                start_time=start_time,
+                end_time=start_time + timedelta(hours=1)))
+            s.flush()
+            env_id = env.id
+            s.add(Problem(
+                contest_id='abc000', id='A', title='A', description='',
+                time_limit=2, memory_limit=256, score=100))
+            s.flush()
+            for i in range(50):
+                code = 'n = int(input())\nprint(n * {})\n'.format(i)
+                s.add(Submission(
+                    contest_id='abc000', problem_id='A', user_id='admin',
+                    code=compress_code(code.encode(), None),
+                    code_bytes=len(code), environment_id=env_id,
+                    status=JudgeStatus.Accepted))
+
+        dictionary_id = train_code_dictionary(env_id)
+        self.assertIsNotNone(dictionary_id)
+        # 改善しない場合は辞書を追加しない
+        self.assertIsNone(train_code_dictionary(env_id))
+
+        code = 'n = int(input())\nprint(n * 100)\n'
+        ret = app.post_json('/contests/abc000/submissions', {
+            'problem_id': 'A', 'environment_id': env_id, 'code': code,
+        }, headers=self.admin_headers).json
+        with transaction() as s:
+            submission = s.query(Submission).filter(
+                Submission.id == ret['id']).one()
+            self.assertEqual(submission.code_dictionary_id, dictionary_id)
+            self.assertEqual(decompress_code(
+                submission.code, dictionary_id), code.encode())
+        ret = app.get('/contests/abc000/submissions/{}'.format(ret['id']),
+                      headers=self.admin_headers).json
+        self.assertEqual(ret['code'], code)
+        self.assertNotIn('code_dictionary_id', ret)
+
+    def test_reuse_judge_results(self):
+        from penguin_judge.worker import _reuse_judge_results
+        start_time = datetime.now(tz=timezone.utc)
+        code = b'print(input())'
+        with transaction() as s:
+            env = Environment(name='Python', test_image_name='python')
+            s.add(env)
+            s.add(Contest(
+                id='abc000', title='ABC000', description='',
+                start_time=start_time,
+                end_time=start_time + timedelta(hours=1)))
+            s.flush()
+            s.add(Problem(
+                contest_id='abc000', id='A', title='A', description='',
+                time_limit=2, memory_limit=256, score=100))
+            s.flush()
+            store = get_blob_store()
+            s.add_all([TestCase(
+                contest_id='abc000', problem_id='A', id=str(i),
+                input_hash=store.put(b''), output_hash=store.put(b''),
+                input_size=0, output_size=0) for i in range(2)])
+            s.flush()
+            submissions = [Submission(
+                contest_id='abc000', problem_id='A', user_id='admin',
+                code=compress_code(code, None), code_bytes=len(code),
+                code_hash=sha256(code).digest(), environment_id=env.id,
+            ) for _ in range(3)]
+            s.add_all(submissions)
+            s.flush()
+            source, dup, dup2 = [x.id for x in submissions]
+            submissions[0].status = JudgeStatus.WrongAnswer
+            submissions[0].tests_version = 1
+            submissions[0].test_image_name = 'python'
+            submissions[0].compile_time = timedelta(seconds=1)
+            submissions[0].max_time = timedelta(seconds=0.5)
+            s.add_all([JudgeResult(
+                contest_id='abc000', problem_id='A', submission_id=source,
+                test_id=str(i), status=status, time=timedelta(seconds=0.5),
+                memory=1024)
+                for i, status in enumerate([
+                    JudgeStatus.Accepted, JudgeStatus.WrongAnswer])])
+
+        def _reuse(submission_id):
+            with transaction() as s:
+                return _reuse_judge_results(
+                    s, s.query(Submission).get(submission_id),
+                    s.query(Problem).get(('abc000', 'A')),
+                    s.query(Environment).first())
+
+        self.assertTrue(_reuse(dup))
+        with transaction() as s:
+            submission = s.query(Submission).get(dup)
+            self.assertEqual(submission.status, JudgeStatus.WrongAnswer)
+            self.assertEqual(submission.max_time, timedelta(seconds=0.5))
+            self.assertEqual(submission.compile_time, timedelta(seconds=1))
+            self.assertEqual(sorted(
+                (r.test_id, r.status) for r in s.query(JudgeResult).filter(
+                    JudgeResult.submission_id == dup)), [
+                        ('0', JudgeStatus.Accepted),
+                        ('1', JudgeStatus.WrongAnswer)])
+
+        # テストデータや制限値が変わった場合は流用しない
+        with transaction() as s:
+            s.query(Problem).update(
+                {Problem.tests_version: Problem.tests_version + 1})
+        self.assertFalse(_reuse(dup2))
+        with transaction() as s:
+            s.query(Problem).update({Problem.tests_version: 1})
+        # 言語環境のイメージが変わった場合も流用しない
+        with transaction() as s:
+            s.query(Environment).update(
+                {Environment.test_image_name: 'python:new'})
+        self.assertFalse(_reuse(dup2))
+        with transaction() as s:
+            s.query(Environment).update(
+                {Environment.test_image_name: 'python'})
+        self.assertTrue(_reuse(dup2))
+        with transaction() as s:
+            s.query(Contest).update({Contest.reuse_judge_results: False})
+        self.assertFalse(_reuse(dup2))
+
+    def test_submission_events(self):
+        start_time = datetime.now(tz=timezone.utc)
+        app.post_json('/contests', {
+            'id': 'id0',
+            'title': 'Test Contest',
+            'description': 'Events',
+            'start_time': start_time.isoformat(),
+            'end_time': (start_time + timedelta(hours=1)).isoformat(),
+            'published': True,
+        }, headers=self.admin_headers)
+        app.post_json('/contests/id0/problems', {
+            'id': 'A', 'title': 'Problem', 'description': '# A',
+            'time_limit': 2, 'score': 100
+        }, headers=self.admin_headers)
+        with transaction() as s:
+            env = Environment(name='Python 3.7', test_image_name='image')
+            s.add(env)
+            s.flush()
+            submission = Submission(
+                contest_id='id0', problem_id='A', user_id='admin',
+                code=b'dummy', code_bytes=1, environment_id=env.id)
+            s.add(submission)
+            s.flush()
+            submission_id, env_id = submission.id, env.id
+
+        def _judge():
+            # APIが購読を開始してからジャッジ結果を書き込む
+            for _ in range(100):
+                if ('id0', 'admin') in events._listener._subscribers:
+                    break
+                time.sleep(0.05)
+            with transaction() as s:
+                s.query(Submission).update(
+                    {'status': JudgeStatus.Running})
+                notify_submission(
+                    s, 'id0', 'A', submission_id, 'admin',
+                    tests=[{'id': '1', 'status': JudgeStatus.Accepted,
+                            'time': timedelta(seconds=0.5)}],
+                    status=JudgeStatus.Running)
+            with transaction() as s:
+                s.query(Submission).update(
+                    {'status': JudgeStatus.Accepted})
+                notify_submission(
+                    s, 'id0', 'A', submission_id, 'admin',
+                    status=JudgeStatus.Accepted)
+
+        def _events(resp):
+            return [json.loads(line[len('data: '):])
+                    for line in resp.text.splitlines()
+                    if line.startswith('data: ')]
+
+        url = '/contests/id0/submissions/{}/events'.format(submission_id)
+        t = threading.Thread(target=_judge)
+        t.start()
+        resp = app.get(url, headers=self.admin_headers)
+        t.join()
+        self.assertEqual(resp.content_type, 'text/event-stream')
+        ret = _events(resp)
+        self.assertEqual(
+            [e.get('status') for e in ret], ['Waiting', 'Running', 'Accepted'])
+        self.assertEqual(ret[0]['tests'], [])
+        self.assertEqual(
+            ret[1]['tests'], [{'id': '1', 'status': 'Accepted', 'time': 0.5}])
+
+        # ジャッジ済みの提出は現在の状態のみを返して終了する
+        ret = _events(app.get(url, headers=self.admin_headers))
+        self.assertEqual([e['status'] for e in ret], ['Accepted'])
+        app.get(url, status=404)
+        app.get('/contests/id0/submissions/99999/events', status=404)
+        app.get('/contests/id0/submissions/events', status=401)
+
+        def _event_ids(resp):
+            return [line[len('id: '):] for line in resp.text.splitlines()
+                    if line.startswith('id: ')]
+
+        # 初回の接続では以降の変化のみを返し、既知の提出IDをイベントIDで返す
+        _app.config['event_stream_timeout'] = 0.5
+        url = '/contests/id0/submissions/events'
+        resp = app.get(url, headers=self.admin_headers)
+        self.assertEqual(_events(resp), [])
+        self.assertEqual(_event_ids(resp), [str(submission_id)])
+
+        # 再接続時は切断中に追加された提出とジャッジ中の提出の状態を返す
+        with transaction() as s:
+            submission = Submission(
+                contest_id='id0', problem_id='A', user_id='admin',
+                code=b'dummy', code_bytes=1, environment_id=env_id)
+            s.add(submission)
+            s.flush()
+            new_id = submission.id
+        resp = app.get(url, headers=dict(
+            self.admin_headers, **{'Last-Event-ID': str(submission_id)}))
+        self.assertEqual(
+            [(e['id'], e['status']) for e in _events(resp)],
+            [(new_id, 'Waiting')])
+        last_event_id = '{0},{0}'.format(new_id)
+        self.assertEqual(_event_ids(resp), [
+            str(submission_id), last_event_id])
+        with transaction() as s:
+            s.query(Submission).filter(Submission.id == new_id).update(
+                {'status': JudgeStatus.Accepted})
+        resp = app.get(url, headers=dict(
+            self.admin_headers, **{'Last-Event-ID': last_event_id}))
+        self.assertEqual(
+            [(e['id'], e['status']) for e in _events(resp)],
+            [(new_id, 'Accepted')])
+        self.assertEqual(_event_ids(resp), [last_event_id, str(new_id)])
+
+        # 不正なLast-Event-IDは初回の接続として扱う
+        resp = app.get(url, headers=dict(
+            self.admin_headers, **{'Last-Event-ID': 'x'}))
+        self.assertEqual(_events(resp), [])
+        self.assertEqual(_event_ids(resp), [str(new_id)])
+
+    def test_notify_submission_payload_size(self):
+        task = self._create_judge_task(['1'])
+        conn = Session.get_bind().raw_connection()
+        conn.detach()  # LISTEN/autocommitにした接続をプールに戻さない
+        try:
+            conn.connection.autocommit = True
+            conn.cursor().execute('LISTEN {}'.format(events.CHANNEL))
+            # テストケースIDが長い場合もNOTIFYの上限を超えないように分割する
+            tests = [{'id': 'x' * 150 + str(i), 'status': 'Accepted'}
+                     for i in range(100)]
+            with transaction() as s:
+                notify_submission(
+                    s, 'abc000', 'A', task.id, 'admin', tests=tests,
+                    status=JudgeStatus.Accepted)
+                # 送信に失敗しても呼び出し元のトランザクションは継続する
+                notify_submission(
+                    s, 'abc000', 'A', task.id, 'admin',
+                    tests=[{'id': 'x' * 8000}])
+                s.query(Submission).update({'status': JudgeStatus.Accepted})
+            while select.select([conn.connection], [], [], 0.2)[0]:
+                conn.connection.poll()
+            payloads = [n.payload for n in conn.connection.notifies]
+        finally:
+            conn.close()
+        self.assertGreater(len(payloads), 1)
+        self.assertTrue(all(len(p.encode()) < 8000 for p in payloads))
+        self.assertEqual(sum(
+            [json.loads(p)['tests'] for p in payloads], []), tests)
+        self.assertEqual(json.loads(payloads[-1])['status'], 'Accepted')
+        with transaction() as s:
+            self.assertEqual(s.query(Submission.status).scalar(),
+                             JudgeStatus.Accepted)
+
     def test_contests_pagination(self):
         test_data = []
         base_time = datetime.now(tz=timezone.utc)
@@ -386,6 +1379,22 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(int(resp.headers['X-Total']), 100)
         self.assertEqual(int(resp.headers['X-Total-Pages']), 4)
 
+        ids = []
+        resp = app.get('/contests?per_page=30')
+        while True:
+            ids += [x['id'] for x in resp.json]
+            if 'X-Next-Cursor' not in resp.headers:
+                break
+            resp = app.get('/contests?per_page=30&cursor={}'.format(
+                resp.headers['X-Next-Cursor']))
+            self.assertNotIn('X-Total', resp.headers)
+        self.assertEqual(ids, [x['id'] for x in test_data])
+        app.get('/contests?cursor=invalid', status=400)
+        for values in (['2020-01-01', 1], [1, 'abc'], [None, 'abc'],
+                       ['2020-01-01', 'a\0']):
+            app.get('/contests?cursor=' + urlsafe_b64encode(
+                json.dumps(values).encode()).decode(), status=400)
+
     def test_submissions_pagination(self):
         test_data = []
         start_time = datetime.now(tz=timezone.utc)
@@ -435,6 +1444,38 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(int(resp.headers['X-Total']), 100)
         self.assertEqual(int(resp.headers['X-Total-Pages']), 4)
 
+        with transaction() as s:
+            for i, submission in enumerate(s.query(Submission)):
+                submission.code_bytes = i % 3
+                submission.max_time = (
+                    timedelta(seconds=i % 4) if i % 5 else None)
+        for sort in ('-created', 'code_bytes,-max_time', 'max_time'):
+            url = '/contests/id0/submissions?sort=' + sort
+            expected = [x['id'] for x in app.get(
+                url + '&per_page=100', headers=self.admin_headers).json]
+            url += '&per_page=7'
+            ids = []
+            resp = app.get(url, headers=self.admin_headers)
+            while True:
+                ids += [x['id'] for x in resp.json]
+                if 'X-Next-Cursor' not in resp.headers:
+                    break
+                resp = app.get(url + '&cursor={}'.format(
+                    resp.headers['X-Next-Cursor']), headers=self.admin_headers)
+            self.assertEqual(ids, expected)
+
+        # カラムの型と一致しない値を含むカーソルは400
+        def _cursor(values):
+            return urlsafe_b64encode(json.dumps(values).encode()).decode()
+        url = '/contests/id0/submissions?sort=max_time&cursor='
+        for values in (
+                [1.5, 'x'], ['1', 1], [True, 1], [1.5, None], [1e300, 1],
+                [[], 1], [1.5, 1.5]):
+            app.get(url + _cursor(values), headers=self.admin_headers,
+                    status=400)
+        app.get(url + _cursor([1.5, 1]), headers=self.admin_headers)
+        app.get(url + _cursor([None, 1]), headers=self.admin_headers)
+
     def test_ranking(self):
         salt = b'penguin'
         passwd = _kdf('penguinpenguin', salt)
@@ -531,3 +1572,179 @@ class TestAPI(unittest.TestCase):
             'D': {'penalties': 1},
             'E': {'penalties': 1},
         })
+
+        # ステータスの一括更新は update_standings で順位表に反映する
+        with transaction() as s:
+            s.query(Submission).filter(
+                Submission.user_id == 'user3',
+                Submission.problem_id == 'A',
+            ).update({Submission.status: JudgeStatus.Accepted},
+                     synchronize_session=False)
+            update_standings(s, 'abc000', 'A', 'user3')
+        ret = app.get('/contests/abc000/rankings').json
+        self.assertEquals(ret[2]['user_id'], 'user3')
+        self.assertEquals(ret[2]['ranking'], 3)
+        self.assertEquals(ret[2]['score'], 100)
+        self.assertEquals(ret[2]['problems']['A']['penalties'], 0)
+        self.assertEquals(ret[2]['problems']['B'], {'penalties': 2})
+        self.assertEquals(ret[3]['user_id'], 'user2')
+
+        # 順位表が更新されていなければ304を返す
+        resp = app.get('/contests/abc000/rankings')
+        etag = resp.headers['ETag']
+        app.get('/contests/abc000/rankings', headers={
+            'If-None-Match': etag}, status=304)
+        with transaction() as s:
+            s.query(Submission).filter(
+                Submission.user_id == 'user3',
+                Submission.problem_id == 'B',
+            ).update({Submission.status: JudgeStatus.Accepted},
+                     synchronize_session=False)
+            update_standings(s, 'abc000', 'B', 'user3')
+        resp = app.get('/contests/abc000/rankings', headers={
+            'If-None-Match': etag}, status=200)
+        self.assertNotEqual(etag, resp.headers['ETag'])
+        self.assertEquals(resp.json[2]['user_id'], 'user3')
+        self.assertEquals(resp.json[2]['score'], 300)
+
+        # ユーザの追加/変更/削除は未提出者として順位表に反映する
+        etag = resp.headers['ETag']
+        n_users = len(resp.json)
+        with transaction() as s:
+            s.add(User(id='user10', name='User10', salt=salt,
+                       password=passwd))
+        resp = app.get('/contests/abc000/rankings', headers={
+            'If-None-Match': etag}, status=200)
+        self.assertEqual(len(resp.json), n_users + 1)
+        etag = resp.headers['ETag']
+        with transaction() as s:
+            s.query(User).filter(User.id == 'user10').one().admin = True
+        resp = app.get('/contests/abc000/rankings', headers={
+            'If-None-Match': etag}, status=200)
+        self.assertEqual(len(resp.json), n_users)
+        etag = resp.headers['ETag']
+        with transaction() as s:
+            s.query(User).filter(User.id == 'user10').update(
+                {User.admin: False}, synchronize_session=False)
+        resp = app.get('/contests/abc000/rankings', headers={
+            'If-None-Match': etag}, status=200)
+        self.assertEqual(len(resp.json), n_users + 1)
+        etag = resp.headers['ETag']
+        with transaction() as s:
+            s.delete(s.query(User).filter(User.id == 'user10').one())
+        resp = app.get('/contests/abc000/rankings', headers={
+            'If-None-Match': etag}, status=200)
+        self.assertEqual(len(resp.json), n_users)
+
+        # バージョンは順位表の変更と同じトランザクションで加算し、
+        # ロールバックした場合は加算しない
+        with transaction() as s:
+            version = get_standings_version(s, 'abc000')
+        for commit in (False, True):
+            try:
+                with transaction() as s:
+                    s.query(Submission).filter(
+                        Submission.user_id == 'user3',
+                        Submission.problem_id == 'C',
+                    ).update({Submission.status: JudgeStatus.Accepted},
+                             synchronize_session=False)
+                    update_standings(s, 'abc000', 'C', 'user3')
+                    if not commit:
+                        raise RuntimeError
+            except RuntimeError:
+                pass
+            with transaction() as s:
+                self.assertEqual(
+                    get_standings_version(s, 'abc000'), version + commit)
+
+        # Accept-Encodingに応じて圧縮した順位表を返す
+        # (webtestは応答を自動で展開するのでflaskのテストクライアントを使う)
+        client = _app.test_client()
+        url = '/contests/abc000/rankings'
+        _app.config['compress_min_size'] = 1
+        try:
+            plain = client.get(url)
+            self.assertNotIn('Content-Encoding', plain.headers)
+            resp = client.get(url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            self.assertEqual(gzip.decompress(resp.data), plain.data)
+            resp = client.get(url, headers={
+                'Accept-Encoding': 'zstd, gzip;q=0.5'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'zstd')
+            self.assertEqual(
+                ZstdDecompressor().decompress(resp.data), plain.data)
+            zstd_etag = resp.headers['ETag']
+            self.assertNotEqual(zstd_etag, plain.headers['ETag'])
+
+            # 304も200と同じETagとVaryを返す
+            resp = client.get(url, headers={
+                'Accept-Encoding': 'zstd', 'If-None-Match': zstd_etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], zstd_etag)
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            self.assertNotIn('Content-Encoding', resp.headers)
+            resp = client.get(url, headers={
+                'If-None-Match': plain.headers['ETag']})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], plain.headers['ETag'])
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+
+            # 保持している表現とエンコーディングが異なる場合は本文を返す
+            resp = client.get(url, headers={
+                'Accept-Encoding': 'gzip', 'If-None-Match': zstd_etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(resp.data), plain.data)
+            resp = client.get(url, headers={
+                'Accept-Encoding': 'br', 'If-None-Match': zstd_etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(resp.headers['ETag'], plain.headers['ETag'])
+
+            # 他のJSONレスポンスもAccept-Encodingに従って圧縮する
+            resp = client.get('/contests', headers={
+                'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            self.assertEqual(
+                json.loads(gzip.decompress(resp.data))[0]['id'], 'abc000')
+
+            # compress_min_size未満の本文は圧縮せず、Varyも付けない
+            _app.config['compress_min_size'] = len(plain.data) + 1
+            for path in (url, '/contests'):
+                resp = client.get(path, headers={'Accept-Encoding': 'gzip'})
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn('Content-Encoding', resp.headers)
+                self.assertNotIn('Vary', resp.headers)
+            resp = client.get(url, headers={
+                'Accept-Encoding': 'gzip', 'If-None-Match': zstd_etag})
+            self.assertEqual(resp.status_code, 200)
+            resp = client.get(url, headers={
+                'Accept-Encoding': 'gzip',
+                'If-None-Match': plain.headers['ETag']})
+            self.assertEqual(resp.status_code, 304)
+            self.assertNotIn('Vary', resp.headers)
+
+            # 0で圧縮を無効にする
+            _app.config['compress_min_size'] = 0
+            resp = client.get(url, headers={'Accept-Encoding': 'zstd'})
+            self.assertNotIn('Content-Encoding', resp.headers)
+        finally:
+            _app.config['compress_min_size'] = 1024
+
+        # 提出の一括削除は削除条件のコンテストのみ順位表を再計算する
+        with unittest.mock.patch(
+                'penguin_judge.models.update_standings',
+                wraps=update_standings) as mock_update:
+            with transaction() as s:
+                s.query(Submission).filter(
+                    Submission.contest_id == 'abc000',
+                    Submission.user_id == 'user0',
+                ).delete(synchronize_session=False)
+            self.assertEqual(
+                [c[0][1] for c in mock_update.call_args_list], ['abc000'])
+        ret = app.get('/contests/abc000/rankings').json
+        self.assertEquals(ret[0]['user_id'], 'user1')
+        self.assertNotIn('user0', [
+            r['user_id'] for r in ret if r['problems']])
@@ -43,6 +43,7 @@ export enum JudgeStatus {
   MemoryLimitExceeded = 'MemoryLimitExceeded',
   TimeLimitExceeded = 'TimeLimitExceeded',
   OutputLimitExceeded = 'OutputLimitExceeded',
+  Skipped = 'Skipped',
   InternalError = 'InternalError',
 }
 
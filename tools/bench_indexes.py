@@ -0,0 +1,181 @@
+"""インデックスのベンチマーク
+
+合成データ(既定で100万件の提出)を投入したデータベースで、
+頻出クエリの実行計画と実行時間をインデックスの追加前後で比較する。
+--urlに指定したデータベースのテーブルはすべて削除されるので注意
+"""
+from argparse import ArgumentParser
+import statistics
+from typing import Any, Dict, List, Tuple
+import warnings
+
+from sqlalchemy import engine_from_config, text
+
+from penguin_judge.models import Base, configure, migrate
+
+# 比較対象のインデックス(追加前の状態を作るために一旦削除する)
+INDEXES = [
+    'submissions_contest_created_idx',
+    'submissions_contest_user_idx',
+    'judge_results_submission_idx',
+]
+
+# APIが発行するクエリと同等のSQL
+QUERIES = [
+    ('post_submission (ジャッジ待ち件数)', '''
+        SELECT count(*) FROM (
+            SELECT id FROM submissions
+            WHERE user_id = :user_id AND status IN ('Waiting', 'Running')
+            LIMIT 11) AS q'''),
+    ('list_submissions (自分の提出)', '''
+        SELECT id, created FROM submissions
+        WHERE contest_id = :contest_id AND user_id = :user_id
+        ORDER BY created, id LIMIT 21'''),
+    ('list_submissions (カーソル)', '''
+        SELECT id, created FROM submissions
+        WHERE contest_id = :contest_id AND (created, id) > (:created, :id)
+        ORDER BY created, id LIMIT 21'''),
+    ('update_standings (セル)', '''
+        SELECT user_id, problem_id, status, created FROM submissions
+        WHERE contest_id = :contest_id AND created >= :start_time
+          AND created < :end_time AND problem_id = :problem_id
+          AND user_id = :user_id
+        ORDER BY created'''),
+    ('get_submission (テスト結果)', '''
+        SELECT * FROM judge_results WHERE submission_id = :id
+        ORDER BY status, test_id'''),
+    ('_validate_token', '''
+        SELECT tokens.expires, users.id, users.name, users.admin
+        FROM tokens JOIN users ON users.id = tokens.user_id
+        WHERE tokens.token = :token'''),
+]
+
+
+def _populate(conn: Any, args: Any) -> None:
+    conn.execute(text('''
+        INSERT INTO users (id, name, salt, password)
+        SELECT 'user' || i, 'user' || i, '', '' FROM generate_series(1, :n) i
+    '''), n=args.users)
+    conn.execute(text('''
+        INSERT INTO tokens (token, user_id, expires)
+        SELECT sha256(('user' || i)::bytea), 'user' || i,
+               now() + interval '1 day'
+        FROM generate_series(1, :n) i
+    '''), n=args.users)
+    conn.execute(text('''
+        INSERT INTO environments (id, name) VALUES (1, 'Python')'''))
+    conn.execute(text('''
+        INSERT INTO contests (id, title, description, start_time, end_time)
+        SELECT 'contest' || i, '', '',
+               now() - interval '1 day' * i, now() - interval '1 day' * i
+                                             + interval '2 hour'
+        FROM generate_series(1, :n) i
+    '''), n=args.contests)
+    conn.execute(text('''
+        INSERT INTO problems (contest_id, id, title, time_limit,
+                              memory_limit, description, score)
+        SELECT c.id, chr(65 + p), '', 2, 256, '', 100
+        FROM contests c, generate_series(0, :n - 1) p
+    '''), n=args.problems)
+    conn.execute(text('''
+        INSERT INTO tests (contest_id, problem_id, id, input_hash,
+                           output_hash, input_size, output_size)
+        SELECT p.contest_id, p.id, t::text, sha256(''::bytea),
+               sha256(''::bytea), 0, 0
+        FROM problems p, generate_series(1, :n) t
+    '''), n=args.tests)
+    # 提出は問題/ユーザ/コンテスト期間内に一様に分布させ、0.1%をジャッジ待ちにする
+    conn.execute(text('''
+        INSERT INTO submissions (contest_id, problem_id, user_id, code,
+                                 code_bytes, environment_id, status, created)
+        SELECT 'contest' || (1 + i % :contests),
+               chr(65 + floor(random() * :problems)::int),
+               'user' || (1 + floor(random() * :users)::int), '', 0, 1,
+               CASE WHEN i % 1000 = 0 THEN 'Waiting'
+                    ELSE 'Accepted' END::judgestatus,
+               c.start_time + (c.end_time - c.start_time) * random()
+        FROM generate_series(0, :n - 1) i
+        JOIN contests c ON c.id = 'contest' || (1 + i % :contests)
+    '''), n=args.submissions, contests=args.contests, problems=args.problems,
+                 users=args.users)
+    conn.execute(text('''
+        INSERT INTO judge_results (contest_id, problem_id, submission_id,
+                                   test_id, status)
+        SELECT s.contest_id, s.problem_id, s.id, t::text, 'Accepted'
+        FROM submissions s, generate_series(1, :n) t
+    '''), n=args.tests)
+
+
+def _summarize(plan: Dict[str, Any]) -> str:
+    node = plan['Node Type']
+    if 'Index Name' in plan:
+        node += '({})'.format(plan['Index Name'])
+    children = [_summarize(p) for p in plan.get('Plans', [])]
+    return node + (' > ' + ', '.join(children) if children else '')
+
+
+def _run(conn: Any, params: Dict[str, Any],
+         n: int) -> List[Tuple[str, float]]:
+    conn.execute('ANALYZE')
+    results = []
+    for _, sql in QUERIES:
+        times = []
+        plan = None
+        for _ in range(n + 1):
+            (plan,), = conn.execute(text(
+                'EXPLAIN (ANALYZE, FORMAT JSON) ' + sql), **params)
+            times.append(plan[0]['Execution Time'])
+        results.append((_summarize(plan[0]['Plan']),
+                        statistics.median(times[1:])))
+    return results
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--url', required=True,
+                        help='ベンチマーク用DBのsqlalchemy.url (全テーブルを削除)')
+    parser.add_argument('--submissions', type=int, default=1000000)
+    parser.add_argument('--contests', type=int, default=20)
+    parser.add_argument('--problems', type=int, default=8)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--tests', type=int, default=5,
+                        help='問題毎のテストケース数')
+    parser.add_argument('-n', type=int, default=20, help='繰り返し回数')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    config = {'sqlalchemy.url': args.url}
+    engine = engine_from_config(config)
+    Base.metadata.drop_all(engine)
+    configure(**config)
+    with engine.begin() as conn:
+        _populate(conn, args)
+        row = conn.execute(text('''
+            SELECT s.id, s.created, s.contest_id, s.problem_id, s.user_id,
+                   c.start_time, c.end_time
+            FROM submissions s JOIN contests c ON c.id = s.contest_id
+            WHERE s.contest_id = 'contest1'
+            ORDER BY s.created, s.id
+            OFFSET (SELECT count(*) / 2 FROM submissions
+                    WHERE contest_id = 'contest1')
+            LIMIT 1''')).first()
+    params = dict(row.items(), token=None)
+    (params['token'],), = engine.execute(text(
+        'SELECT token FROM tokens WHERE user_id = :user_id'), **params)
+
+    with engine.connect() as conn:
+        for name in INDEXES:
+            conn.execute('DROP INDEX {}'.format(name))
+        before = _run(conn, params, args.n)
+    migrate(engine)
+    with engine.connect() as conn:
+        after = _run(conn, params, args.n)
+
+    for (name, _), (p0, t0), (p1, t1) in zip(QUERIES, before, after):
+        print(name)
+        print('  before: {:9.3f}ms  {}'.format(t0, p0))
+        print('  after:  {:9.3f}ms  {}'.format(t1, p1))
+
+
+if __name__ == '__main__':
+    main()
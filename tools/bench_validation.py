@@ -0,0 +1,66 @@
+"""リクエスト検証のマイクロベンチマーク
+
+DBやAPIサーバを起動せずに、openapi_coreのRequestValidatorと
+事前構築した検証器(CompiledRequestValidator)の1要求あたりの処理時間を比較する
+"""
+from argparse import ArgumentParser
+import timeit
+
+from flask import request
+from openapi_core.contrib.flask import FlaskOpenAPIRequest  # type: ignore
+
+from penguin_judge.api import app, _compiled_validator, _request_validator
+
+AUTH = {'X-Auth-Token': 'dummy'}
+requests = [
+    ('GET', '/contests/abc/rankings', None, {}),
+    ('GET', '/contests?page=2&per_page=10', None, {}),
+    ('GET', '/contests/abc/submissions'
+     '?sort=-created,max_time&status=Accepted', None, AUTH),
+    ('POST', '/contests/abc/submissions',
+     {'problem_id': 'A', 'code': 'print(1)', 'environment_id': 1}, AUTH),
+    ('POST', '/auth', {'id': 'penguin', 'password': 'penguinpenguin'}, {}),
+]
+
+
+def _bench(method: str, path: str, body: object, headers: dict,
+           n: int) -> None:
+    with app.test_request_context(
+            path, method=method, json=body, headers=headers):
+        adapter = app.url_map.bind('localhost')
+        request.url_rule, request.view_args = adapter.match(
+            path.split('?')[0], method=method, return_rule=True)
+
+        def generic() -> object:
+            ret = _request_validator.validate(FlaskOpenAPIRequest(request))
+            assert not ret.errors, ret.errors
+            return ret
+
+        def compiled() -> object:
+            ret = _compiled_validator.validate(request)
+            assert ret is not None, 'fallback'
+            return ret
+
+        expected, actual = generic(), compiled()
+        for location in ('path', 'query'):
+            assert expected.parameters[location] == actual[0][location]
+        if expected.body is not None:
+            assert vars(expected.body) == vars(actual[1])
+        t0 = timeit.timeit(generic, number=n) / n * 1e6
+        t1 = timeit.timeit(compiled, number=n) / n * 1e6
+        print('{:<6} {:<64} {:8.1f}us {:8.1f}us {:6.1f}x'.format(
+            method, path, t0, t1, t0 / t1))
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('-n', type=int, default=1000, help='繰り返し回数')
+    args = parser.parse_args()
+    print('{:<6} {:<64} {:>10} {:>10} {:>7}'.format(
+        'method', 'path', 'generic', 'compiled', 'speedup'))
+    for method, path, body, headers in requests:
+        _bench(method, path, body, headers, args.n)
+
+
+if __name__ == '__main__':
+    main()
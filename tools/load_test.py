@@ -1,3 +1,4 @@
+from argparse import ArgumentParser
 from contextlib import contextmanager
 import multiprocessing as mp
 import os
@@ -43,7 +44,7 @@ problems = [
 
 # テストで叩くエンドポイントや処理の要求数比率調整
 _TABLE = None
-def test_table():
+def test_table(only=None):
     global _TABLE
     if _TABLE:
         return _TABLE
@@ -58,6 +59,8 @@ def test_table():
     ]
     _TABLE = []
     for t in table:
+        if only and t[-1] not in only:
+            continue
         for _ in range(t[0]):
             _TABLE.append(t[1:])
     return _TABLE
@@ -160,8 +163,14 @@ def execute_tests():
 
 
 def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--only', action='append',
+        help='指定したエンドポイントのみ試験する (例: "POST /contests/*/submissions")')
+    args = parser.parse_args()
+
     ENVIRONMENTS.extend(common.get('/environments').json())
-    test_table()
+    test_table(args.only)
     prepare_users()
 
     with ProcessPoolExecutor(